@@ -0,0 +1,109 @@
+# job_idで絞り込むクエリの読み取りバイト数を、パーティション・クラスタリングの有無で比較する
+# 従来のテーブル (tsが文字列でパーティション無し) と、新しいテーブル (tsがTIMESTAMPで日単位の
+# パーティションと job_id, user_id, channel_id のクラスタリング) に同じクエリを実行する
+#
+# 使い方:
+#   # 従来のテーブルから比較用のテーブルを作成する (実際にクエリを実行するため課金される)
+#   # 作成するDDLは移行スクリプト (migrations/partition_messages_table.py) と同じ
+#   python benchmarks/bytes_scanned.py --project my-project --job-id job123 \
+#       --baseline-table lake.messages --candidate-table lake.messages_partitioned --create-candidate
+#   # ドライランで読み取りバイト数を比較する
+#   python benchmarks/bytes_scanned.py --project my-project --job-id job123 \
+#       --baseline-table lake.messages --candidate-table lake.messages_partitioned
+#
+# ドライランの見積もりはパーティションの絞り込みだけを反映し、クラスタリングによる絞り込みは反映しない。
+# クラスタリングの効果を含めて計測する場合は --execute で実際に実行して処理バイト数を比較する
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "migrations"))
+from partition_messages_table import create_partitioned_copy_sql  # noqa: E402
+
+# 比較するクエリ (DataformのSQLXでjob_idで絞り込んでいる部分)
+QUERIES = {
+    "messages_dwh": """
+SELECT job_id, ts, user_id, text, reactions_concatenated, channel_id
+FROM `{table}`
+WHERE job_id = @job_id""",
+    "messages_export_to_gcs": """
+SELECT DISTINCT ts, user_id, text, reactions_concatenated, channel_id
+FROM `{table}`
+WHERE job_id = @job_id""",
+    # 期間を指定して読む場合 (パーティションの絞り込みが効く)
+    "messages_last_30_days": """
+SELECT ts, user_id, text, channel_id
+FROM `{table}`
+WHERE job_id = @job_id AND {ts_filter}""",
+}
+
+# tsの型ごとの期間の条件
+TS_FILTERS = {
+    "STRING": "ts >= FORMAT_TIMESTAMP('%Y-%m-%d %H:%M:%S', TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 30 DAY), 'Asia/Tokyo')",
+    "TIMESTAMP": "ts >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 30 DAY)",
+}
+
+def ts_type(client, table):
+    for field in client.get_table(table).schema:
+        if field.name == "ts":
+            return field.field_type
+    raise ValueError(f"{table} has no ts column")
+
+
+# 1つのクエリの処理バイト数を返す (execute の場合は実際に実行する)
+def bytes_processed(client, sql, job_id, execute):
+    from google.cloud import bigquery
+
+    job_config = bigquery.QueryJobConfig(
+        dry_run=not execute, use_query_cache=False,
+        query_parameters=[bigquery.ScalarQueryParameter("job_id", "STRING", job_id)])
+    job = client.query(sql, job_config=job_config)
+    if execute:
+        job.result()
+    return job.total_bytes_processed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", required=True)
+    parser.add_argument("--job-id", required=True)
+    parser.add_argument("--baseline-table", required=True,
+                        help="従来のテーブル (dataset.table)")
+    parser.add_argument("--candidate-table", required=True,
+                        help="パーティション・クラスタリングを設定したテーブル (dataset.table)")
+    parser.add_argument("--create-candidate", action="store_true",
+                        help="従来のテーブルから比較用のテーブルを作成する")
+    parser.add_argument("--execute", action="store_true",
+                        help="ドライランではなく実際に実行して処理バイト数を比較する")
+    args = parser.parse_args()
+
+    from google.cloud import bigquery
+
+    client = bigquery.Client(project=args.project)
+    baseline = f"{args.project}.{args.baseline_table}"
+    candidate = f"{args.project}.{args.candidate_table}"
+
+    if args.create_candidate:
+        client.query(create_partitioned_copy_sql(
+            client.get_table(baseline), candidate, replace=True)).result()
+
+    results = {}
+    for name, template in QUERIES.items():
+        measured = {}
+        for label, table in (("baseline", baseline), ("candidate", candidate)):
+            sql = template.format(
+                table=table, ts_filter=TS_FILTERS[ts_type(client, table)])
+            measured[f"{label}_bytes"] = bytes_processed(
+                client, sql, args.job_id, args.execute)
+        measured["ratio"] = round(measured["candidate_bytes"] / measured["baseline_bytes"], 4) \
+            if measured["baseline_bytes"] else None
+        results[name] = measured
+
+    print(json.dumps({"mode": "execute" if args.execute else "dry_run",
+                      "job_id": args.job_id, "results": results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
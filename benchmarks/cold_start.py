@@ -0,0 +1,148 @@
+# Cloud Functions のコールドスタート時の読み込みコストの計測
+# 関数ごとに新しいプロセスで main モジュールを読み込み、import にかかる時間、
+# 読み込み後のRSS、時間のかかっているパッケージを出力する
+#
+# 使い方:
+#   python benchmarks/cold_start.py --output cold_start.json
+#   python benchmarks/cold_start.py --baseline cold_start.json
+#
+# 認証情報が無い環境でもクライアントを作成できるよう、使い捨ての鍵で作成した
+# サービスアカウントの認証情報を GOOGLE_APPLICATION_CREDENTIALS に設定して計測する
+import argparse
+import importlib
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "cloud_functions")
+
+ENTRY_POINTS = ["slack_messages_to_bigquery", "download_file_from_drive",
+                "gemini_analysis", "kick_dataform_job"]
+
+IMPORTTIME_PATTERN = re.compile(
+    r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def write_throwaway_credentials(directory):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption()).decode()
+    path = os.path.join(directory, "credentials.json")
+    with open(path, "w") as f:
+        json.dump({
+            "type": "service_account",
+            "project_id": "cold-start-bench",
+            "private_key_id": "cold-start-bench",
+            "private_key": private_key,
+            "client_email": "cold-start-bench@cold-start-bench.iam.gserviceaccount.com",
+            "client_id": "0",
+            "token_uri": "https://oauth2.googleapis.com/token",
+        }, f)
+    return path
+
+
+# main モジュールを読み込んで計測する (子プロセスで実行される)
+def run_worker(function_dir):
+    sys.path.insert(0, function_dir)
+    modules_before = len(sys.modules)
+    started = time.perf_counter()
+    # 読み込み自体を計測するため、モジュールは使わない
+    importlib.import_module("main")
+    import_ms = (time.perf_counter() - started) * 1000
+    return {
+        "import_ms": round(import_ms, 1),
+        "modules_loaded": len(sys.modules) - modules_before,
+        # Linuxでは ru_maxrss はKB単位
+        "rss_after_import_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+# -X importtime の出力から main が読み込んだパッケージごとの読み込み時間を集計する
+def top_packages(importtime_output, limit):
+    totals = Counter()
+    children = []
+    for line in importtime_output.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if not match:
+            continue
+        depth, name = len(match.group(3)), match.group(4)
+        # 子モジュールは親モジュールより先に出力される
+        if depth == 1:
+            if name == "main":
+                for child, cumulative in children:
+                    totals[child.split(".")[0]] += cumulative
+            children = []
+        elif depth == 3:
+            children.append((name, int(match.group(2))))
+    return {name: round(us / 1000, 1) for name, us in totals.most_common(limit)}
+
+
+def measure(entry_point, credentials_path, top):
+    function_dir = os.path.abspath(os.path.join(FUNCTIONS_DIR, entry_point))
+    env = dict(os.environ, GOOGLE_APPLICATION_CREDENTIALS=credentials_path,
+               GOOGLE_CLOUD_PROJECT="cold-start-bench")
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.abspath(__file__),
+         "--worker", function_dir],
+        capture_output=True, text=True, env=env, cwd=function_dir)
+    if completed.returncode != 0:
+        raise RuntimeError(
+            f"{entry_point} failed to import:\n{completed.stderr[-2000:]}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["slowest_packages_ms"] = top_packages(completed.stderr, top)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entry-points", default=",".join(ENTRY_POINTS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=8)
+    parser.add_argument("--output", help="計測結果を保存するJSONファイル")
+    parser.add_argument("--baseline", help="比較対象のJSONファイル")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker)))
+        return 0
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        credentials_path = write_throwaway_credentials(directory)
+        for entry_point in args.entry_points.split(","):
+            # 最も速かった回を採用する (ファイルキャッシュなどの影響を減らすため)
+            runs = [measure(entry_point, credentials_path, args.top)
+                    for _ in range(args.repeat)]
+            results[entry_point] = min(runs, key=lambda run: run["import_ms"])
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for entry_point, result in results.items():
+            if entry_point not in baseline:
+                continue
+            before, after = baseline[entry_point]["import_ms"], result["import_ms"]
+            print(f"{entry_point:<30} import {before:>8.1f}ms -> {after:>8.1f}ms "
+                  f"({after / before:5.2f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+# kick_dataform_job / poll_dataform_job の完了検知のシミュレーション
+# 代替のDataformとCloud Tasksのクライアントを仮想時計で動かし、実行時間の異なるジョブについて
+# 30秒後に1度だけ確認する従来の方式と、バックオフしながら確認し直す方式の検知までの時間を比較する
+#
+# 使い方:
+#   python benchmarks/dataform_completion.py --durations 5,20,45,120,600
+import argparse
+import json
+import os
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..",
+                                "cloud_functions", "kick_dataform_job"))
+import completion_tracker  # noqa: E402
+import fakes  # noqa: E402
+
+# 従来の方式でポーリングする時刻 (キックからの秒数)
+LEGACY_POLL_SECONDS = 30
+
+
+# 従来の方式: 30秒後に1度だけ確認し、完了していなければそれ以上確認しない
+def simulate_legacy(duration):
+    detected = duration <= LEGACY_POLL_SECONDS
+    return {"detected": detected,
+            "detected_after_seconds": LEGACY_POLL_SECONDS if detected else None,
+            "polls": 1}
+
+
+# バックオフしながら確認し直す方式
+def simulate_tracker(duration, final_state, args, seed):
+    import random
+
+    clock = fakes.VirtualClock()
+    dataform = fakes.FakeDataformClient(clock, duration, final_state, "Query error")
+    tasks = fakes.FakeTasksClient()
+    scheduler = completion_tracker.TaskScheduler(
+        tasks, "bench-project", "asia-northeast1", "dataform-completion-checker",
+        "https://poll.example.com", clock=clock)
+    tracker = completion_tracker.CompletionTracker(
+        dataform, scheduler, clock=clock, rng=random.Random(seed).random,
+        initial_delay=args.initial_delay, max_delay=args.max_delay,
+        deadline_seconds=args.deadline)
+    kicked_at = clock()
+    tracker.start({"parent": "projects/bench", "job_id": "bench", "export_path": "exports/bench",
+                   "workflow_invocation_name": f"projects/bench/workflowInvocations/{seed}"})
+    while True:
+        task = tasks.pop_next()
+        clock.now = max(clock.now, task["schedule_time"].seconds)
+        outcome, details = tracker.poll(json.loads(task["http_request"]["body"]))
+        if outcome != completion_tracker.RESCHEDULED:
+            metrics = details["metrics"]
+            return {"outcome": outcome,
+                    "detected_after_seconds": round(clock() - kicked_at, 1),
+                    "detection_delay_seconds": metrics["detection_delay_seconds"],
+                    "polls": metrics["polls"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--durations", default="5,20,45,120,600,1800",
+                        help="ジョブの実行時間 (秒) のカンマ区切り")
+    parser.add_argument("--initial-delay", type=float, default=5)
+    parser.add_argument("--max-delay", type=float, default=60)
+    parser.add_argument("--deadline", type=float, default=3600)
+    parser.add_argument("--final-state", default="SUCCEEDED",
+                        choices=["SUCCEEDED", "FAILED", "CANCELLED"])
+    args = parser.parse_args()
+
+    results = []
+    for seed, duration in enumerate(float(value) for value in args.durations.split(",")):
+        results.append({"duration_seconds": duration,
+                        "legacy": simulate_legacy(duration),
+                        "tracker": simulate_tracker(duration, args.final_state, args, seed)})
+    print(json.dumps({"config": vars(args), "results": results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
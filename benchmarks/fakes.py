@@ -0,0 +1,635 @@
+# ベンチマーク用のローカルの代替実装
+# Slack Web API、AppSheetのファイル配信、Cloud Storage、BigQuery、Secret Manager、Gemini、
+# Dataform、Cloud Tasksを
+# プロセス内またはローカルのHTTPサーバーで置き換え、外部への呼び出し回数を記録する
+import base64
+import fnmatch
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# 外部サービスへの呼び出し回数 (サービス名.操作名 -> 回数)
+CALLS = Counter()
+CALLS_LOCK = threading.Lock()
+
+
+def record_call(name, count=1):
+    with CALLS_LOCK:
+        CALLS[name] += count
+
+
+# ローカルのHTTPサーバーを別スレッドで起動する基底クラス
+class LocalHttpServer:
+    def __init__(self, handler_class):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self.server.daemon_threads = True
+        self.server.owner = self
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# 合成したSlackワークスペース
+class SlackWorkspace:
+    """channels × messages のメッセージと、チャネルごとに threads 件のスレッドを生成する"""
+
+    def __init__(self, channels, messages, threads, replies, users=40, seed=0,
+                 start_ts=1704034800, interval=600):
+        rnd = random.Random(seed)
+        self.user_ids = [f"U{i:04d}" for i in range(users)]
+        self.history = {}
+        self.threads = {}
+        for c in range(channels):
+            channel_id = f"C{c:04d}"
+            history = []
+            thread_indexes = set(rnd.sample(
+                range(messages), min(threads, messages)))
+            for i in range(messages):
+                ts = f"{start_ts + i * interval}.{rnd.randint(0, 999999):06d}"
+                message = self._message(rnd, ts, f"message {c}-{i}")
+                if i in thread_indexes:
+                    thread = [message]
+                    for j in range(replies):
+                        reply_ts = f"{start_ts + i * interval + j + 1}.{rnd.randint(0, 999999):06d}"
+                        reply = self._message(
+                            rnd, reply_ts, f"reply {c}-{i}-{j}")
+                        reply["thread_ts"] = ts
+                        thread.append(reply)
+                    message["thread_ts"] = ts
+                    message["reply_count"] = replies
+                    if replies:
+                        message["latest_reply"] = thread[-1]["ts"]
+                    self.threads[(channel_id, ts)] = thread
+                history.append(message)
+            # conversations.history は新しい順に返す
+            history.reverse()
+            self.history[channel_id] = history
+
+    def _message(self, rnd, ts, text):
+        message = {"type": "message", "ts": ts,
+                   "user": rnd.choice(self.user_ids), "text": text}
+        if rnd.random() < 0.3:
+            message["reactions"] = [{"name": "+1", "count": rnd.randint(1, 5),
+                                     "users": []}]
+        return message
+
+    @property
+    def channel_ids(self):
+        return list(self.history)
+
+
+class _SlackHandler(_JsonHandler):
+    def do_GET(self):
+        owner = self.server.owner
+        parsed = urlparse(self.path)
+        method = parsed.path.rsplit("/", 1)[-1]
+        params = {key: values[0]
+                  for key, values in parse_qs(parsed.query).items()}
+        record_call(f"slack.{method}")
+        owner.received.append((method, self.headers.get("Authorization"), time.monotonic()))
+        if owner.latency:
+            time.sleep(owner.latency)
+
+        fault = owner.next_fault()
+        if fault is not None:
+            if fault["disconnect"]:
+                # レスポンスを返さずに接続を切る (クライアントでは ConnectionError になる)
+                self.close_connection = True
+                return
+            self.send_json({"ok": fault["error"] is None, "error": fault["error"]},
+                           status=fault["status"], headers=fault["headers"])
+        elif owner.token and self.headers.get("Authorization") != f"Bearer {owner.token}":
+            self.send_json({"ok": False, "error": "invalid_auth"})
+        elif method == "conversations.history":
+            self.send_json(owner.history_page(params))
+        elif method == "conversations.replies":
+            self.send_json(owner.replies(params))
+        else:
+            self.send_json({"ok": False, "error": "unknown_method"})
+
+
+# Slack Web APIの代替サーバー
+class FakeSlackServer(LocalHttpServer):
+    """conversations.history をカーソルでページングし、conversations.replies を返す
+
+    token を指定した場合は、異なるトークンのリクエストに invalid_auth を返す
+    """
+
+    def __init__(self, workspace, latency_ms=0, token=None):
+        super().__init__(_SlackHandler)
+        self.workspace = workspace
+        self.latency = latency_ms / 1000.0
+        self.token = token
+        # 受信したリクエスト (メソッド, Authorizationヘッダー, 受信時刻)
+        self.received = []
+        self.faults = []
+        self.faults_lock = threading.Lock()
+
+    def fail_next(self, status=200, headers=None, error=None, disconnect=False):
+        """次のリクエストに障害を返す (登録した順に1件ずつ消費する)"""
+        with self.faults_lock:
+            self.faults.append({"status": status, "headers": headers or {},
+                                "error": error, "disconnect": disconnect})
+
+    def next_fault(self):
+        with self.faults_lock:
+            return self.faults.pop(0) if self.faults else None
+
+    def history_page(self, params):
+        history = self.workspace.history.get(params.get("channel"))
+        if history is None:
+            return {"ok": False, "error": "channel_not_found"}
+        oldest = float(params.get("oldest", 0))
+        latest = float(params.get("latest", 1e12))
+        messages = [m for m in history if oldest <= float(m["ts"]) <= latest]
+        offset = int(params.get("cursor") or 0)
+        limit = int(params.get("limit", 100))
+        page = messages[offset:offset + limit]
+        has_more = offset + limit < len(messages)
+        return {"ok": True, "messages": page, "has_more": has_more,
+                "response_metadata": {"next_cursor": str(offset + limit) if has_more else ""}}
+
+    def replies(self, params):
+        thread = self.workspace.threads.get(
+            (params.get("channel"), params.get("ts")))
+        if thread is None:
+            return {"ok": False, "error": "thread_not_found"}
+        oldest = float(params.get("oldest", 0))
+        messages = [thread[0]] + [m for m in thread[1:]
+                                  if float(m["ts"]) > oldest]
+        return {"ok": True, "messages": messages, "has_more": False}
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        owner = self.server.owner
+        record_call("appsheet.get")
+        body = owner.content
+        etag = f'"{hashlib.md5(body).hexdigest()}"' if owner.etag else None
+        if etag and self.headers.get("If-None-Match") == etag:
+            record_call("appsheet.not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# AppSheetのファイルURLの代替サーバー
+class FakeAppSheetFileServer(LocalHttpServer):
+    """どのパスにも同じ内容のファイルを返す (etag=True の場合は If-None-Match に304を返す)"""
+
+    def __init__(self, size_bytes, seed=0, etag=True):
+        super().__init__(_FileHandler)
+        self.content = random.Random(seed).randbytes(size_bytes)
+        self.etag = etag
+
+    def file_url(self, file_name):
+        return f"{self.url}/fileDownload?appName=bench&fileName={file_name.replace('/', '%2F')}"
+
+
+# Cloud Storageのインメモリ実装
+class InMemoryBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+        self._metadata = None
+
+    def _stored(self):
+        return self.bucket.objects.get(self.name)
+
+    @property
+    def metadata(self):
+        if self._metadata is not None:
+            return self._metadata
+        stored = self._stored()
+        return stored["metadata"] if stored else None
+
+    @metadata.setter
+    def metadata(self, value):
+        self._metadata = value
+
+    def patch(self, *args, **kwargs):
+        record_call("gcs.patch")
+        with self.bucket.lock:
+            stored = self._stored()
+            if stored is None:
+                raise _not_found(self.name)
+            stored["metadata"] = dict(stored["metadata"] or {}, **(self._metadata or {}))
+
+    @property
+    def generation(self):
+        stored = self._stored()
+        return stored["generation"] if stored else None
+
+    @property
+    def size(self):
+        stored = self._stored()
+        return len(stored["data"]) if stored else None
+
+    @property
+    def md5_hash(self):
+        stored = self._stored()
+        if not stored:
+            return None
+        return base64.b64encode(hashlib.md5(stored["data"]).digest()).decode()
+
+    def exists(self, *args, **kwargs):
+        record_call("gcs.get")
+        return self._stored() is not None
+
+    def reload(self, *args, **kwargs):
+        record_call("gcs.get")
+        if self._stored() is None:
+            raise _not_found(self.name)
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode()
+        self.bucket.put(self.name, data, content_type or self.content_type,
+                        self._metadata, if_generation_match)
+
+    def upload_from_file(self, file_obj, content_type=None, **kwargs):
+        self.upload_from_string(file_obj.read(), content_type, **kwargs)
+
+    def open(self, mode="rb", chunk_size=None, content_type=None, **kwargs):
+        if mode == "rb":
+            return io.BytesIO(self.download_as_bytes())
+        if mode != "wb":
+            raise ValueError(f"Unsupported mode: {mode}")
+        return InMemoryBlobWriter(self, chunk_size, content_type)
+
+    def download_as_bytes(self, *args, if_generation_match=None, **kwargs):
+        from google.api_core import exceptions
+        record_call("gcs.download")
+        stored = self._stored()
+        if stored is None:
+            raise _not_found(self.name)
+        if if_generation_match is not None and if_generation_match != stored["generation"]:
+            raise exceptions.PreconditionFailed(f"Generation mismatch: {self.name}")
+        return stored["data"]
+
+    def download_as_text(self, *args, **kwargs):
+        return self.download_as_bytes().decode()
+
+    def delete(self, *args, **kwargs):
+        record_call("gcs.delete")
+        with self.bucket.lock:
+            if self.bucket.objects.pop(self.name, None) is None:
+                raise _not_found(self.name)
+
+
+def _not_found(name):
+    from google.api_core import exceptions
+    return exceptions.NotFound(f"No such object: {name}")
+
+
+class InMemoryBlobWriter:
+    """blob.open("wb") の代替 (チャンクごとに再開可能アップロードの呼び出しとして数える)"""
+
+    def __init__(self, blob, chunk_size, content_type):
+        self.blob = blob
+        self.chunk_size = chunk_size or 100 * 1024 * 1024
+        self.content_type = content_type
+        self.parts = []
+        self.pending = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.pending += len(data)
+        while self.pending >= self.chunk_size:
+            record_call("gcs.upload_chunk")
+            self.pending -= self.chunk_size
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.blob.upload_from_string(
+                b"".join(self.parts), content_type=self.content_type)
+
+    def terminate(self):
+        self.closed = True
+        self.parts = []
+
+
+class InMemoryBucket:
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def blob(self, name, *args, **kwargs):
+        return InMemoryBlob(self, name)
+
+    def get_blob(self, name, *args, **kwargs):
+        record_call("gcs.get")
+        if name not in self.objects:
+            return None
+        return InMemoryBlob(self, name)
+
+    def put(self, name, data, content_type=None, metadata=None, if_generation_match=None):
+        from google.api_core import exceptions
+        record_call("gcs.upload")
+        with self.lock:
+            current = self.objects.get(name)
+            current_generation = current["generation"] if current else 0
+            if if_generation_match is not None and if_generation_match != current_generation:
+                raise exceptions.PreconditionFailed(
+                    f"Generation mismatch: {name}")
+            self.generation += 1
+            self.objects[name] = {"data": data, "content_type": content_type,
+                                  "metadata": metadata, "generation": self.generation}
+
+    def copy_blob(self, blob, destination_bucket, new_name=None, **kwargs):
+        record_call("gcs.copy")
+        stored = blob._stored()
+        if stored is None:
+            raise _not_found(blob.name)
+        destination_bucket.put(new_name or blob.name, stored["data"], stored["content_type"],
+                               stored["metadata"])
+        return InMemoryBlob(destination_bucket, new_name or blob.name)
+
+    def list_blobs(self, prefix="", match_glob=None, **kwargs):
+        record_call("gcs.list")
+        with self.lock:
+            names = sorted(name for name in self.objects
+                           if name.startswith(prefix or "")
+                           and (match_glob is None or _match_glob(name, match_glob)))
+        return [InMemoryBlob(self, name) for name in names]
+
+
+# Cloud Storageの match_glob の代替 ("**" と "{a,b}" の選択肢に対応する)
+def _match_glob(name, pattern):
+    head, brace, rest = pattern.partition("{")
+    if brace:
+        options, _, tail = rest.partition("}")
+        return any(_match_glob(name, head + option + tail) for option in options.split(","))
+    return fnmatch.fnmatchcase(name, pattern.replace("**", "*"))
+
+
+class InMemoryStorageClient:
+    """プロセス内で共有されるバケットを返す storage.Client の代替"""
+
+    buckets = {}
+
+    def __init__(self, *args, **kwargs):
+        self.project = kwargs.get("project", "bench-project")
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, InMemoryBucket(name))
+
+    def list_blobs(self, bucket_or_name, prefix="", **kwargs):
+        name = bucket_or_name if isinstance(
+            bucket_or_name, str) else bucket_or_name.name
+        return self.bucket(name).list_blobs(prefix=prefix, **kwargs)
+
+
+# BigQueryへのロードを記録するクライアント
+class CapturingBigQueryClient:
+    """ロードジョブの代わりに行数とバイト数を記録する bigquery.Client の代替"""
+
+    loads = []
+
+    def __init__(self, *args, **kwargs):
+        self.project = kwargs.get("project", "bench-project")
+
+    def get_table(self, table_ref):
+        # ロード先のテーブルは存在しない (ロードジョブで作成する) ものとする
+        from google.api_core import exceptions as api_exceptions
+
+        raise api_exceptions.NotFound(f"Table {table_ref} not found")
+
+    def load_table_from_dataframe(self, df, table_ref, job_config=None, **kwargs):
+        record_call("bigquery.load")
+        self.loads.append({"table": table_ref, "rows": len(df),
+                           "bytes": int(df.memory_usage(deep=True).sum())})
+        return _DoneJob()
+
+    def load_table_from_json(self, rows, table_ref, job_config=None, **kwargs):
+        record_call("bigquery.load")
+        rows = list(rows)
+        self.loads.append({"table": table_ref, "rows": len(rows),
+                           "bytes": sum(len(json.dumps(row, default=str)) for row in rows)})
+        return _DoneJob()
+
+
+class _DoneJob:
+    def result(self, *args, **kwargs):
+        return self
+
+
+# Secret Managerの代替
+class FakeSecretManagerClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def access_secret_version(self, request=None, name=None, **kwargs):
+        record_call("secretmanager.access")
+        secret_path = name or request["name"]
+
+        class _Payload:
+            data = f"fake-secret-for-{secret_path}".encode()
+
+        class _Response:
+            payload = _Payload()
+
+        return _Response()
+
+
+# Cloud Loggingの代替 (標準のloggingのみを使う)
+class FakeLoggingClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def setup_logging(self, *args, **kwargs):
+        pass
+
+
+# Geminiの代替
+class FakeGenerativeModel:
+    """一定の待ち時間の後に入力の要約を返す GenerativeModel の代替"""
+
+    latency = 0.0
+    # ストリーミングの場合に分割して返すチャンク数 (待ち時間はチャンクごとに均等に分ける)
+    stream_chunks = 4
+
+    def __init__(self, model_name, generation_config=None, **kwargs):
+        self.model_name = model_name
+        self.generation_config = generation_config
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        record_call("gemini.generate_content")
+        text = f"analysis of {len(contents)} parts by {self.model_name}"
+        if stream:
+            return self._stream(text)
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeResponse(text)
+
+    def _stream(self, text):
+        size = -(-len(text) // self.stream_chunks)
+        for start in range(0, len(text), size):
+            if self.latency:
+                time.sleep(self.latency / self.stream_chunks)
+            yield FakeResponse(text[start:start + size])
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        part = type("FakeContentPart", (), {"text": text})()
+        content = type("FakeContent", (), {"parts": [part]})()
+        self.candidates = [type("FakeCandidate", (), {"content": content})()]
+
+
+class FakePart:
+    def __init__(self, uri=None, mime_type=None, data=None):
+        self.uri = uri
+        self.mime_type = mime_type
+        self.data = data
+
+    @classmethod
+    def from_uri(cls, uri, mime_type):
+        return cls(uri=uri, mime_type=mime_type)
+
+    @classmethod
+    def from_data(cls, data, mime_type):
+        return cls(data=data, mime_type=mime_type)
+
+    def __repr__(self):
+        return f"FakePart({self.uri or len(self.data)}, {self.mime_type})"
+
+
+# 仮想時計 (Dataformの完了追跡のシミュレーション用)
+class VirtualClock:
+    def __init__(self, now=1700000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+# Dataformの代替
+class FakeDataformClient:
+    """キックされてから duration 秒後に final_state になるワークフローを返す DataformClient の代替"""
+
+    def __init__(self, clock, duration, final_state="SUCCEEDED", failure_reason=""):
+        self.clock = clock
+        self.started_at = clock()
+        self.duration = duration
+        self.final_state = final_state
+        self.failure_reason = failure_reason
+        self.cancelled = False
+
+    def _ended_at(self):
+        return self.started_at + self.duration
+
+    def get_workflow_invocation(self, name=None, request=None, **kwargs):
+        record_call("dataform.get_workflow_invocation")
+        done = self.clock() >= self._ended_at()
+        state = "CANCELLED" if self.cancelled else (
+            self.final_state if done else "RUNNING")
+        start_time = _FakeTimestamp(self.started_at)
+        end_time = _FakeTimestamp(self._ended_at()) if done else None
+        timing = type("FakeInterval", (), {"start_time": start_time, "end_time": end_time})()
+        return type("FakeWorkflowInvocation", (), {"name": name, "state": state,
+                                                   "invocation_timing": timing})()
+
+    def query_workflow_invocation_actions(self, request=None, **kwargs):
+        record_call("dataform.query_workflow_invocation_actions")
+        target = type("FakeTarget", (), {"name": "messages_export"})()
+        return [type("FakeAction", (), {"target": target, "state": "FAILED",
+                                        "failure_reason": self.failure_reason})()]
+
+    def cancel_workflow_invocation(self, request=None, **kwargs):
+        record_call("dataform.cancel_workflow_invocation")
+        self.cancelled = True
+
+
+class _FakeTimestamp:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def timestamp(self):
+        return self.seconds
+
+
+# Cloud Tasksの代替
+class FakeTasksClient:
+    """作成されたタスクを記録する CloudTasksClient の代替 (同じ名前のタスクは AlreadyExists にする)"""
+
+    def __init__(self, *args, **kwargs):
+        self.tasks = []
+        # Cloud Tasksと同様に、実行済みのタスクの名前も再利用できない
+        self.names = set()
+
+    def queue_path(self, project, location, queue):
+        return f"projects/{project}/locations/{location}/queues/{queue}"
+
+    def create_task(self, parent=None, task=None, **kwargs):
+        from google.api_core import exceptions as api_exceptions
+
+        record_call("tasks.create_task")
+        if task.get("name") in self.names:
+            raise api_exceptions.AlreadyExists(task["name"])
+        self.names.add(task.get("name"))
+        self.tasks.append(task)
+        return task
+
+    # 最も早く実行される未実行のタスクを取り出す
+    def pop_next(self):
+        if not self.tasks:
+            return None
+        task = min(self.tasks, key=lambda task: task["schedule_time"].seconds)
+        self.tasks.remove(task)
+        return task
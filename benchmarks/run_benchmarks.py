@@ -0,0 +1,357 @@
+# Cloud Functions のベンチマーク
+# ローカルの代替実装 (benchmarks/fakes.py) に対して functions_framework のテストクライアントから
+# 各関数を呼び出し、スループット、レイテンシ(p50/p99)、TTFB、ピークRSS、外部呼び出し回数を計測する
+#
+# 使い方:
+#   python benchmarks/run_benchmarks.py --output results.json
+#   python benchmarks/run_benchmarks.py --baseline results.json --tolerance 0.2
+#
+# 計測対象ごとに別プロセスで実行するため、ピークRSSやimport時間は関数ごとに独立して計測される
+import argparse
+import gzip
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from unittest import mock
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(BENCHMARK_DIR, "..", "cloud_functions")
+
+TARGETS = {
+    "slack": "slack_messages_to_bigquery",
+    "download": "download_file_from_drive",
+    "gemini": "gemini_analysis",
+    "gemini_map_reduce": "gemini_analysis",
+    "gemini_blocking": "gemini_analysis",
+    "gemini_stream": "gemini_analysis",
+    "gemini_gzip": "gemini_analysis",
+}
+
+# ベースラインと比較する指標 (値が大きいほど悪いもの)
+COMPARED_METRICS = ["app_load_ms", "latency_ms.p50",
+                    "latency_ms.p99", "peak_rss_mb"]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+# 外部サービスをローカルの代替実装に差し替える
+def install_fakes(target):
+    import fakes
+
+    patches = [
+        mock.patch("google.cloud.logging.Client", fakes.FakeLoggingClient),
+        mock.patch("google.cloud.storage.Client", fakes.InMemoryStorageClient),
+    ]
+    if target in ("slack", "download"):
+        patches.append(mock.patch("google.cloud.secretmanager.SecretManagerServiceClient",
+                                  fakes.FakeSecretManagerClient))
+    if target == "slack":
+        patches.append(mock.patch("google.cloud.bigquery.Client",
+                                  fakes.CapturingBigQueryClient))
+    if target.startswith("gemini"):
+        patches += [
+            mock.patch("vertexai.init", lambda *args, **kwargs: None),
+            mock.patch("vertexai.generative_models.GenerativeModel",
+                       fakes.FakeGenerativeModel),
+            mock.patch("vertexai.generative_models.Part", fakes.FakePart),
+        ]
+    for patch in patches:
+        patch.start()
+
+
+def load_app(target):
+    from functions_framework import create_app
+
+    source = os.path.join(FUNCTIONS_DIR, TARGETS[target], "main.py")
+    started = time.perf_counter()
+    app = create_app(target="main", source=source)
+    return app, (time.perf_counter() - started) * 1000
+
+
+# Slackメッセージ取得関数のシナリオ
+def setup_slack(config):
+    import fakes
+
+    workspace = fakes.SlackWorkspace(config["slack_channels"], config["slack_messages"],
+                                     config["slack_threads"], config["slack_replies"])
+    server = fakes.FakeSlackServer(
+        workspace, config["slack_latency_ms"]).start()
+    os.environ.update({
+        "GCP_PROJECT_ID": "bench-project",
+        "SLACK_TOKEN_SECRET_NAME": "slack-token",
+        "BIGQUERY_DATASET_ID": "lake",
+        "BIGQUERY_TABLE_ID": "messages",
+        "SLACK_API_BASE_URL": f"{server.url}/api",
+        "SLACK_THREAD_FETCH_CONCURRENCY": str(config["concurrency"]),
+        "SLACK_REPLIES_RATE_PER_MINUTE": "1000000",
+        "SYNC_STATE_BUCKET": "bench-state",
+    })
+    body = {
+        "channel_ids": ",".join(workspace.channel_ids),
+        "target_user_ids": "ALL",
+        "job_id": "bench",
+        "start_date": "2024/01/01",
+        "end_date": "2099/12/31",
+    }
+    return lambda i: body
+
+
+def after_load_slack(config):
+    # 実際のレート制限で待たされないようにティアのレートを引き上げる
+    import slack_client
+
+    for tier in slack_client.TIER_RATES_PER_MINUTE:
+        slack_client.TIER_RATES_PER_MINUTE[tier] = 1000000
+
+
+# AppSheetファイル取得関数のシナリオ
+def setup_download(config):
+    import fakes
+
+    server = fakes.FakeAppSheetFileServer(
+        int(config["file_size_mb"] * 1024 * 1024)).start()
+    os.environ.update({"GCP_PROJECT_ID": "bench-project",
+                      "BUCKET_NAME": "bench-assets"})
+    return lambda i: {
+        "target_table_name": "user",
+        "dest_column_name": "strength_pdf_path",
+        "appsheet_file_path": server.file_url(f"user{i % 4}/strengths.pdf"),
+        "key_name": "user_id",
+        "key_value": f"user{i % 4}",
+    }
+
+
+# Gemini分析関数のシナリオ
+def setup_gemini(config):
+    import fakes
+
+    fakes.FakeGenerativeModel.latency = config["gemini_latency_ms"] / 1000.0
+    bucket = fakes.InMemoryStorageClient().bucket("bench-messages")
+    compressed = config.get("export_compression") == "gzip"
+    for shard in range(config["gemini_shards"]):
+        data = ("ts,user_name,text,reactions_concatenated,channel_name\n" +
+                "".join(f"2024-01-01 00:00:{i % 60:02d},user,message {i},,general\n"
+                        for i in range(1000))).encode()
+        if compressed:
+            bucket.blob(f"exports/bench/{shard:012d}.csv.gz").upload_from_string(
+                gzip.compress(data))
+        else:
+            bucket.blob(f"exports/bench/{shard:012d}.csv").upload_from_string(data)
+    if compressed:
+        # poll_dataform_job が書き込むマニフェストと同じ形式
+        files = [{"name": blob.name, "generation": blob.generation, "size": blob.size, "rows": 1000}
+                 for blob in bucket.list_blobs(prefix="exports/bench/")]
+        bucket.blob("exports/bench/_manifest.json").upload_from_string(
+            json.dumps({"export_path": "exports/bench", "compression": "GZIP", "files": files}))
+    fakes.CALLS.clear()
+    os.environ.update({"PROJECT_ID": "bench-project",
+                      "GCS_BUCKET_NAME": "bench-messages",
+                      "RESULT_CACHE_DIR": tempfile.mkdtemp(prefix="gemini_result_cache_")})
+    return lambda i: {
+        "prompt": "強みを分析してください",
+        "analysis_mode": config.get("analysis_mode", "single"),
+        "stream": config.get("stream", False),
+        "analysis_id": f"analysis-{i}",
+        "strength_flag": "Y",
+        "strength_pdf_path": "gs://bench-assets/user0/strengths.pdf",
+        "analysis_target": "slack messages",
+        "target_file_path": "exports/bench",
+    }
+
+
+# Gemini分析関数のMap-Reduce方式のシナリオ (キャッシュを使わず毎回分割して分析する)
+def setup_gemini_map_reduce(config):
+    make_body = setup_gemini(dict(config, analysis_mode="map_reduce"))
+    os.environ.update({"RESULT_CACHE_BACKEND": "none",
+                       "MAP_REDUCE_CHUNK_TOKENS": str(config["map_reduce_chunk_tokens"]),
+                       "MAP_REDUCE_CONCURRENCY": str(config["concurrency"])})
+    return make_body
+
+
+# Gemini分析関数の一括で返す方式とストリーミング方式のシナリオ (キャッシュを使わず毎回生成する)
+# ttfb_ms (最初のバイトを受け取るまでの時間) を比較する
+def setup_gemini_blocking(config):
+    make_body = setup_gemini(config)
+    os.environ["RESULT_CACHE_BACKEND"] = "none"
+    return make_body
+
+
+def setup_gemini_stream(config):
+    return setup_gemini_blocking(dict(config, stream=True))
+
+
+# GZIP圧縮してエクスポートしたCSVをマニフェストから読み込むMap-Reduce方式のシナリオ
+def setup_gemini_gzip(config):
+    return setup_gemini_map_reduce(dict(config, export_compression="gzip"))
+
+
+SCENARIOS = {
+    "slack": (setup_slack, after_load_slack),
+    "download": (setup_download, None),
+    "gemini": (setup_gemini, None),
+    "gemini_map_reduce": (setup_gemini_map_reduce, None),
+    "gemini_blocking": (setup_gemini_blocking, None),
+    "gemini_stream": (setup_gemini_stream, None),
+    "gemini_gzip": (setup_gemini_gzip, None),
+}
+
+
+# 1つの関数を計測する (子プロセスで実行される)
+def run_worker(target, config):
+    import logging
+
+    sys.path.insert(0, BENCHMARK_DIR)
+    logging.getLogger().setLevel(logging.WARNING)
+    install_fakes(target)
+
+    import fakes
+
+    setup, after_load = SCENARIOS[target]
+    make_body = setup(config)
+    app, app_load_ms = load_app(target)
+    if after_load:
+        after_load(config)
+    client = app.test_client()
+
+    latencies = []
+    ttfbs = []
+    fakes.CALLS.clear()
+    started = time.perf_counter()
+    for i in range(config["iterations"]):
+        request_started = time.perf_counter()
+        # ストリーミングのレスポンスも計測できるように、本文はチャンクごとに受け取る
+        response = client.post("/", json=make_body(i), buffered=False)
+        body = []
+        for chunk in response.response:
+            if not body:
+                ttfbs.append((time.perf_counter() - request_started) * 1000)
+            body.append(chunk if isinstance(chunk, bytes) else chunk.encode())
+        latencies.append((time.perf_counter() - request_started) * 1000)
+        text = b"".join(body).decode()
+        if response.status_code != 200 or "event: error" in text:
+            raise RuntimeError(
+                f"{target} returned {response.status_code}: {text}")
+    elapsed = time.perf_counter() - started
+
+    result = {
+        "iterations": config["iterations"],
+        "app_load_ms": round(app_load_ms, 2),
+        "throughput_rps": round(config["iterations"] / elapsed, 3),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "mean": round(sum(latencies) / len(latencies), 2),
+        },
+        "ttfb_ms": {
+            "p50": round(percentile(ttfbs, 50), 2),
+            "p99": round(percentile(ttfbs, 99), 2),
+        },
+        # Linuxでは ru_maxrss はKB単位
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "outbound_calls": dict(sorted(fakes.CALLS.items())),
+    }
+    if target == "slack":
+        rows = sum(load["rows"] for load in fakes.CapturingBigQueryClient.loads)
+        result["rows_loaded"] = rows
+        result["rows_per_second"] = round(rows / elapsed, 1)
+    return result
+
+
+def run_target(target, config):
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", target,
+         "--config", json.dumps(config)],
+        capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{target} benchmark failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def metric_value(result, path):
+    group, _, name = path.partition(".")
+    value = result.get(group)
+    if name:
+        value = value.get(name) if isinstance(value, dict) else None
+    return value
+
+
+# ベースラインと比較し、許容範囲を超えて悪化した指標を返す
+def compare(results, baseline, tolerance):
+    regressions = []
+    for target, result in results.items():
+        base = baseline.get("results", {}).get(target)
+        if base is None:
+            continue
+        paths = COMPARED_METRICS + [f"outbound_calls.{name}" for name in
+                                    sorted(set(result["outbound_calls"]) | set(base["outbound_calls"]))]
+        for path in paths:
+            current, previous = metric_value(
+                result, path) or 0, metric_value(base, path) or 0
+            ratio = current / previous if previous else (
+                1.0 if not current else float("inf"))
+            regressed = ratio > 1 + tolerance
+            print(f"{target:<10} {path:<45} {previous:>12} -> {current:>12} "
+                  f"({ratio:6.2f}x){'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append((target, path))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--targets", default=",".join(TARGETS))
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--slack-channels", type=int, default=3)
+    parser.add_argument("--slack-messages", type=int, default=1000)
+    parser.add_argument("--slack-threads", type=int, default=100)
+    parser.add_argument("--slack-replies", type=int, default=5)
+    parser.add_argument("--slack-latency-ms", type=float, default=5)
+    parser.add_argument("--file-size-mb", type=float, default=16)
+    parser.add_argument("--gemini-shards", type=int, default=10)
+    parser.add_argument("--gemini-latency-ms", type=float, default=50)
+    parser.add_argument("--map-reduce-chunk-tokens", type=int, default=5000)
+    parser.add_argument("--output", help="計測結果を保存するJSONファイル")
+    parser.add_argument("--baseline", help="比較対象のJSONファイル")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, json.loads(args.config))))
+        return 0
+
+    config = {key: value for key, value in vars(args).items()
+              if key not in ("targets", "output", "baseline", "tolerance", "worker", "config")}
+    results = {}
+    for target in args.targets.split(","):
+        results[target] = run_target(target, config)
+
+    report = {"created_at": datetime.now(timezone.utc).isoformat(),
+              "config": config, "results": results}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
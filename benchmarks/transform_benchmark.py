@@ -0,0 +1,128 @@
+# slack_messages_to_bigquery のメッセージ変換処理のベンチマーク
+# 行ごとの apply による従来の変換とベクトル化した変換を合成データで比較する
+#
+# 使い方:
+#   python benchmarks/transform_benchmark.py --messages 100000 --repeat 3
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "slack_messages_to_bigquery"))
+from transform import messages_to_dataframe  # noqa: E402
+
+# ベクトル化する前の実装の出力の列
+LEGACY_COLUMNS = ['ts', 'user_id', 'text',
+                  'reactions_concatenated', 'channel_id', 'job_id']
+
+REACTION_NAMES = ["+1", "eyes", "pray", "tada", "ok_hand", "white_check_mark"]
+
+
+# 合成したSlackのメッセージを生成する関数
+def generate_messages(count, seed=0):
+    rnd = random.Random(seed)
+    base = 1704034800  # 2024/01/01 00:00:00 JST
+    messages = []
+    for i in range(count):
+        message = {
+            "ts": f"{base + rnd.randint(0, 365 * 86400)}.{rnd.randint(0, 999999):06d}",
+            "user": f"U{rnd.randint(1, 40):04d}",
+            "text": f"message {i}",
+            "channel_id": f"C{rnd.randint(1, 10):04d}",
+            "job_id": "bench",
+        }
+        if rnd.random() < 0.4:
+            message["reactions"] = [
+                {"name": name, "count": rnd.randint(1, 5), "users": []}
+                for name in rnd.sample(REACTION_NAMES, rnd.randint(1, 3))]
+        messages.append(message)
+    return messages
+
+
+# 従来の行ごとの apply による変換 (比較用)
+# ベクトル化する前の実装そのままで、tsはJSTの文字列、text_hashの列は無い
+def legacy_messages_to_dataframe(messages):
+    sorted_messages = sorted(messages, key=lambda msg: float(msg['ts']))
+    df = pd.DataFrame(sorted_messages)
+
+    def concatenate_reactions(reactions):
+        if isinstance(reactions, list):
+            return ', '.join([f"{reaction['name']}:{reaction['count']}" for reaction in reactions])
+        return ''
+
+    if 'reactions' in df.columns:
+        df['reactions_concatenated'] = df['reactions'].apply(
+            concatenate_reactions)
+    else:
+        df['reactions_concatenated'] = ''
+
+    def convert_to_jst(timestamp):
+        utc_dt = datetime.fromtimestamp(float(timestamp), timezone.utc)
+        jst = timezone(timedelta(hours=9))
+        return utc_dt.astimezone(jst).strftime('%Y-%m-%d %H:%M:%S')
+
+    df['ts'] = df['ts'].apply(convert_to_jst)
+    df.rename(columns={'user': 'user_id'}, inplace=True)
+    return df[LEGACY_COLUMNS]
+
+
+# 現在の変換結果を従来の形式 (JSTの文字列のts、text_hash無し) に揃える関数 (結果の比較用)
+def to_legacy_format(df):
+    df = df.copy()
+    df['ts'] = df['ts'].dt.tz_convert('Asia/Tokyo').dt.strftime('%Y-%m-%d %H:%M:%S')
+    return df[LEGACY_COLUMNS]
+
+
+# マイクロ秒まで保持していることを確認する関数
+def assert_microseconds_preserved(messages, df):
+    expected = sorted(int(seconds) * 1000000 + int(micros.ljust(6, '0'))
+                      for seconds, _, micros in (message['ts'].partition('.') for message in messages))
+    actual = (df['ts'] - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(microseconds=1)
+    assert actual.tolist() == expected
+
+
+def measure(func, messages, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(messages)
+        timings.append(time.perf_counter() - started)
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    messages = generate_messages(args.messages, args.seed)
+
+    legacy_df, legacy_seconds = measure(
+        legacy_messages_to_dataframe, messages, args.repeat)
+    vectorized_df, vectorized_seconds = measure(
+        messages_to_dataframe, messages, args.repeat)
+
+    # 両方の実装が同じ結果を返すことを確認する (tsは秒単位のJSTの文字列にして比較する)
+    pd.testing.assert_frame_equal(
+        legacy_df.reset_index(drop=True), to_legacy_format(vectorized_df).reset_index(drop=True),
+        check_dtype=False)
+    assert_microseconds_preserved(messages, vectorized_df)
+
+    print(json.dumps({
+        "messages": args.messages,
+        "legacy_seconds": round(legacy_seconds, 4),
+        "vectorized_seconds": round(vectorized_seconds, 4),
+        "speedup": round(legacy_seconds / vectorized_seconds, 2),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
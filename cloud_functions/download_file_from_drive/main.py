@@ -2,16 +2,16 @@ import os
 import re
 import requests
 import logging
-from google.cloud import storage
-from google.cloud import secretmanager
 from flask import Request
 import functions_framework
-import google.cloud.logging
 import mimetypes
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import clients
+import transfer
 
-# Cloud Loggingの初期化
-logging_client = google.cloud.logging.Client()
-logging_client.setup_logging()
+# アップロード中のファイルを置く一時オブジェクトのプレフィックス (ユーザーID配下の外に置く)
+STAGING_PREFIX = ".staging"
 
 # ファイル名のサニタイズ
 def sanitize_filename(filename):
@@ -46,39 +46,125 @@ def get_mime_type(file_name):
             f"Could not determine MIME type for file: {file_name}, using 'application/octet-stream'")
         return 'application/octet-stream'
 
-# AppSheetのファイルURLからファイルをバイナリでダウンロードする関数
-def download_file_from_appsheet(file_url):
-    """AppSheetのURLからファイルをバイナリでダウンロード"""
+# AppSheetのファイルURLからファイルをストリーミングでダウンロードする関数
+def open_appsheet_file(file_url, headers=None):
+    """AppSheetのURLからファイルをダウンロードするレスポンスを返す (本文は読み込まない)
+
+    条件付きリクエストで未更新の場合はステータス304のレスポンスを返す
+    """
     try:
         logging.info(f"Downloading file from AppSheet URL: {file_url}")
-        response = requests.get(file_url)
+        response = requests.get(file_url, headers=headers, stream=True, timeout=(10, 300))
         if response.status_code == 200:
-            file_content = response.content  # バイナリデータを取得
-            logging.info(f"File downloaded from AppSheet. Size: {len(file_content)} bytes.")
-            return file_content
+            logging.info(
+                f"File download started from AppSheet. Content-Length: {response.headers.get('Content-Length')}")
+            return response
+        elif response.status_code == 304:
+            logging.info("File on AppSheet is not modified")
+            response.close()
+            return response
         else:
             logging.error(f"Failed to download file from AppSheet. Status code: {response.status_code}")
+            response.close()
             return None
     except Exception as e:
         logging.error(f"Error downloading file: {e}")
         raise
 
-# 指定されたユーザーID配下のすべてのファイルを削除する関数
-def delete_existing_files(bucket, user_id):
-    """ユーザーID配下のすべてのファイルを削除"""
-    try:
-        blobs = bucket.list_blobs(prefix=f"{user_id}/")
-        for blob in blobs:
+# 前回同じURLから取得したファイルを探す関数
+def find_file_from_source(blobs, file_url):
+    """ETagかLast-Modifiedが記録されているファイルのみを返す"""
+    for blob in blobs:
+        metadata = blob.metadata or {}
+        if metadata.get("appsheet_file_path") == file_url and \
+                (metadata.get("appsheet_etag") or metadata.get("appsheet_last_modified")):
+            return blob
+    return None
+
+# 前回の取得結果から条件付きリクエストのヘッダーを作成する関数
+def conditional_headers(blob):
+    headers = {}
+    if blob is None:
+        return headers
+    if blob.metadata.get("appsheet_etag"):
+        headers["If-None-Match"] = blob.metadata["appsheet_etag"]
+    if blob.metadata.get("appsheet_last_modified"):
+        headers["If-Modified-Since"] = blob.metadata["appsheet_last_modified"]
+    return headers
+
+# 取得元の情報をオブジェクトのメタデータとして記録する形式に変換する関数
+def source_metadata(file_url, response):
+    metadata = {"appsheet_file_path": file_url}
+    if response.headers.get("ETag"):
+        metadata["appsheet_etag"] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        metadata["appsheet_last_modified"] = response.headers["Last-Modified"]
+    return metadata
+
+# 複数のファイルを並列に削除する関数
+def delete_blobs(blobs, concurrency=8):
+    """1件ずつ順に削除せず、スレッドプールで並列に削除する (既に削除済みのものは無視する)"""
+    from google.api_core import exceptions as gcs_exceptions
+
+    def delete(blob):
+        try:
             logging.info(f"Deleting file: {blob.name}")
             blob.delete()
-        logging.info(f"All files under user_id {user_id} have been deleted.")
+        except gcs_exceptions.NotFound:
+            logging.info(f"File already deleted: {blob.name}")
+
+    if not blobs:
+        return
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(blobs))) as executor:
+        # 例外が発生した場合は呼び出し元へ送出する
+        list(executor.map(delete, blobs))
+
+# 一時オブジェクトにアップロードしたファイルでユーザーのファイルを置き換える関数
+def replace_user_file(bucket, user_id, existing_blobs, staging_blob, blob_name, result, metadata,
+                      delete_concurrency=8):
+    """同じ内容 (SHA-256) のファイルが既にある場合はそのファイルを残し、他のファイルと一時オブジェクトを削除する
+
+    残したファイルのオブジェクト名を返す
+    """
+    try:
+        metadata = dict(metadata, sha256=result.sha256)
+        # ファイル名が変わっていても内容が同じであれば既存のファイルを使う
+        same_content = [blob for blob in existing_blobs
+                        if (blob.metadata or {}).get("sha256") == result.sha256]
+        same_content.sort(key=lambda blob: blob.name != blob_name)
+        current = next(
+            (blob for blob in existing_blobs if blob.name == blob_name), None)
+        if not same_content and current is not None and current.md5_hash == result.md5_hash:
+            # SHA-256が記録されていないファイルはMD5で比較する
+            same_content = [current]
+
+        if same_content:
+            kept = same_content[0]
+            logging.info(f"File {kept.name} has the same content, skipping replace")
+            # 次回の条件付きリクエストのため取得元の情報を更新する
+            if any((kept.metadata or {}).get(key) != value for key, value in metadata.items()):
+                kept.metadata = metadata
+                kept.patch()
+        else:
+            # コピーが完了するまで既存のファイルはそのまま参照できる
+            kept = bucket.copy_blob(staging_blob, bucket, blob_name)
+            kept.metadata = metadata
+            kept.patch()
+            logging.info(f"Promoted {staging_blob.name} to {blob_name}")
+
+        stale_blobs = [blob for blob in existing_blobs if blob.name != kept.name]
+        delete_blobs(stale_blobs + [staging_blob], delete_concurrency)
+        logging.info(f"Deleted {len(stale_blobs)} old files under user_id {user_id}.")
+        return kept.name
     except Exception as e:
-        logging.error(f"Error deleting files for user_id {user_id}: {e}")
+        logging.error(f"Error replacing files for user_id {user_id}: {e}")
         raise
 
 # HTTPトリガー用のメイン関数
 @functions_framework.http
 def main(request: Request):
+    # Cloud Loggingの設定は最初のリクエストで1度だけ行う
+    clients.setup_logging()
     try:
         logging.info(f"Received request: {request}")
         request_json = request.get_json(silent=True)
@@ -110,36 +196,55 @@ def main(request: Request):
         # MIMEタイプをファイル名から決定
         mime_type = get_mime_type(file_name)
 
-        # AppSheetのファイルURLからファイルをダウンロード
-        file_content = download_file_from_appsheet(appsheet_file_path)
-        if not file_content:
-            logging.error("Failed to download file from AppSheet")
-            return "Failed to download file from AppSheet", 404
-
         # ファイル名のサニタイズ
         safe_file_name = sanitize_filename(file_name)
         logging.info(f"Sanitized file name: {safe_file_name}")
 
-        # Cloud Storageにバイナリデータとしてアップロード
         bucket_name = os.getenv('BUCKET_NAME')
         if not bucket_name:
             logging.error("Environment variable BUCKET_NAME is not set")
             return "Environment variable BUCKET_NAME is not set", 500
 
-        storage_client = storage.Client()
+        storage_client = clients.storage_client()
         bucket = storage_client.bucket(bucket_name)
 
-        # ユーザーID配下のすべてのファイルを削除
-        delete_existing_files(bucket, key_value)
+        # ユーザーID配下の既存のファイル (内容のハッシュと取得元の情報をメタデータに持つ)
+        existing_blobs = list(bucket.list_blobs(prefix=f"{key_value}/"))
+        previous_blob = find_file_from_source(existing_blobs, appsheet_file_path)
 
-        # 新しいファイルをアップロード
-        logging.info(f"Uploading file to Cloud Storage bucket '{bucket_name}' at path '{key_value}/{safe_file_name}'")
-        blob = bucket.blob(f"{key_value}/{safe_file_name}")
-        blob.upload_from_string(file_content, content_type=mime_type)  # MIMEタイプを指定してアップロード
-        logging.info(f"File uploaded to Cloud Storage: gs://{bucket_name}/{key_value}/{safe_file_name}")
+        # AppSheetのファイルURLからファイルのダウンロードを開始
+        # 前回と同じURLの場合は条件付きリクエストにし、未更新であれば既存のファイルを返す
+        response = open_appsheet_file(
+            appsheet_file_path, conditional_headers(previous_blob))
+        if response is None:
+            logging.error("Failed to download file from AppSheet")
+            return "Failed to download file from AppSheet", 404
+        if response.status_code == 304:
+            cloud_storage_path = f"gs://{bucket_name}/{previous_blob.name}"
+            logging.info(f"Reusing unchanged file: {cloud_storage_path}")
+            return {"status": "success", dest_column_name: cloud_storage_path}, 200
+
+        # ダウンロードしながら一時オブジェクトへアップロード (ファイル全体をメモリに載せない)
+        # 転送に失敗した場合でもユーザーの既存のファイルはそのまま残る
+        blob_name = f"{key_value}/{safe_file_name}"
+        staging_blob = bucket.blob(f"{STAGING_PREFIX}/{key_value}/{uuid.uuid4().hex}")
+        logging.info(f"Uploading file to Cloud Storage bucket '{bucket_name}' at path '{staging_blob.name}'")
+        chunk_size = transfer.upload_chunk_size(
+            float(os.getenv('TRANSFER_CHUNK_SIZE_MB', 8)))
+        metadata = source_metadata(appsheet_file_path, response)
+        result = transfer.stream_to_blob(
+            response, staging_blob, mime_type, chunk_size,
+            queue_depth=int(os.getenv('TRANSFER_QUEUE_DEPTH', 4)),
+            verify_checksum=os.getenv('TRANSFER_VERIFY_CHECKSUM', 'true').lower() == 'true')
+
+        # 一時オブジェクトを本来のパスへ反映し、ユーザーID配下の古いファイルを削除
+        # 同じ内容のファイルが既にある場合はそのパスを返す
+        kept_name = replace_user_file(bucket, key_value, existing_blobs, staging_blob, blob_name,
+                                      result, metadata, int(os.getenv('DELETE_CONCURRENCY', 8)))
+        logging.info(f"File uploaded to Cloud Storage: gs://{bucket_name}/{kept_name} ({result.size} bytes)")
 
         # アップロードしたファイルのパスを生成
-        cloud_storage_path = f"gs://{bucket_name}/{key_value}/{safe_file_name}"
+        cloud_storage_path = f"gs://{bucket_name}/{kept_name}"
 
         logging.info("AppSheet table updated successfully")
         return {"status": "success", dest_column_name: cloud_storage_path}, 200
@@ -0,0 +1,126 @@
+import base64
+import hashlib
+import logging
+import queue
+import threading
+
+# Cloud Storageの再開可能アップロードのチャンクサイズは256KiBの倍数である必要がある
+CHUNK_SIZE_MULTIPLE = 256 * 1024
+
+# ダウンロードの終了を表す目印
+_END_OF_STREAM = object()
+
+
+# 転送に失敗した場合の例外
+class TransferError(Exception):
+    pass
+
+
+# 転送結果
+class TransferResult:
+    def __init__(self, size, md5_hash, sha256):
+        self.size = size
+        # Cloud Storageの md5_hash と同じbase64形式
+        self.md5_hash = md5_hash
+        # 内容のアドレスとして使う16進数形式のSHA-256
+        self.sha256 = sha256
+
+
+def upload_chunk_size(chunk_size_mb):
+    chunk_size = int(chunk_size_mb * 1024 * 1024)
+    return max(CHUNK_SIZE_MULTIPLE, chunk_size // CHUNK_SIZE_MULTIPLE * CHUNK_SIZE_MULTIPLE)
+
+
+# HTTPレスポンスの本文をCloud Storageへストリーミングで転送する関数
+def stream_to_blob(response, blob, content_type, chunk_size, queue_depth=4, verify_checksum=True):
+    """ダウンロード用のスレッドで読み込んだチャンクを上限付きのキューで受け取り、再開可能アップロードで書き込む
+
+    メモリ使用量はファイルサイズによらず (queue_depth + 2) * chunk_size 程度に抑えられる
+    """
+    chunks = queue.Queue(maxsize=queue_depth)
+    cancelled = threading.Event()
+
+    def put(item):
+        # アップロード側が失敗した場合はキューの空きを待たずに終了する
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def download():
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if cancelled.is_set():
+                    return
+                if chunk:
+                    put(chunk)
+            put(_END_OF_STREAM)
+        except Exception as e:
+            put(e)
+
+    downloader = threading.Thread(target=download, daemon=True)
+    downloader.start()
+
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    size = 0
+    writer = blob.open("wb", chunk_size=chunk_size, content_type=content_type)
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _END_OF_STREAM:
+                break
+            if isinstance(chunk, Exception):
+                raise TransferError(f"Download interrupted: {chunk}") from chunk
+            md5.update(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+            writer.write(chunk)
+
+        # 圧縮して転送された場合は Content-Length と展開後のサイズが一致しないため比較しない
+        expected_size = response.headers.get("Content-Length")
+        if expected_size is not None and not response.headers.get("Content-Encoding") \
+                and int(expected_size) != size:
+            raise TransferError(
+                f"Downloaded {size} bytes but Content-Length was {expected_size}")
+    except BaseException:
+        cancelled.set()
+        # 途中までの内容でオブジェクトが作成されないようアップロードを中止する
+        abort_upload(writer)
+        raise
+    finally:
+        response.close()
+
+    writer.close()
+    downloader.join()
+    result = TransferResult(
+        size, base64.b64encode(md5.digest()).decode("ascii"), sha256.hexdigest())
+    logging.info(
+        f"Streamed {size} bytes to gs://{blob.bucket.name}/{blob.name} (sha256: {result.sha256})")
+
+    if verify_checksum:
+        verify_upload(blob, result)
+    return result
+
+
+def abort_upload(writer):
+    # terminate() が無いバージョンのクライアントでは、完了させなかったセッションは期限切れで破棄される
+    terminate = getattr(writer, "terminate", None)
+    try:
+        if terminate is not None:
+            terminate()
+    except Exception as e:
+        logging.warning(f"Failed to cancel resumable upload: {e}")
+
+
+# アップロード後のオブジェクトのMD5を転送中に計算した値と比較する関数
+def verify_upload(blob, result):
+    blob.reload()
+    if blob.md5_hash != result.md5_hash or blob.size != result.size:
+        logging.error(
+            f"Checksum mismatch for {blob.name}: expected {result.md5_hash} ({result.size} bytes), "
+            f"got {blob.md5_hash} ({blob.size} bytes)")
+        blob.delete()
+        raise TransferError(f"Checksum mismatch for {blob.name}")
@@ -0,0 +1,241 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import clients
+
+# ジョブの状態
+PENDING = "PENDING"
+RUNNING = "RUNNING"
+SUCCEEDED = "SUCCEEDED"
+FAILED = "FAILED"
+
+# ジョブの実行権の取得 (claim) の結果
+CLAIMED = "CLAIMED"
+ALREADY_RUNNING = "ALREADY_RUNNING"
+ALREADY_FINISHED = "ALREADY_FINISHED"
+NOT_FOUND = "NOT_FOUND"
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+# 分析ジョブを作成する関数
+def new_job(request_json):
+    job_id = uuid.uuid4().hex
+    timestamp = now_iso()
+    return {
+        "job_id": job_id,
+        "analysis_id": request_json.get("analysis_id"),
+        "status": PENDING,
+        "request": {key: value for key, value in request_json.items() if key != "async"},
+        "result": None,
+        "error": None,
+        # 実行中のジョブの実行権の期限 (UNIX時間の秒)
+        "lease_expires_at": None,
+        "created_at": timestamp,
+        "updated_at": timestamp,
+    }
+
+
+# ジョブの実行権を取得できるかを判定し、取得できる場合はジョブを実行中にする関数
+# 実行中のジョブは期限 (lease_seconds) が切れるまで他の呼び出しが実行しない
+def try_claim(job, lease_seconds):
+    if job["status"] in (SUCCEEDED, FAILED):
+        return ALREADY_FINISHED
+    now = time.time()
+    if job["status"] == RUNNING and (job.get("lease_expires_at") or 0) > now:
+        return ALREADY_RUNNING
+    job["status"] = RUNNING
+    job["lease_expires_at"] = now + lease_seconds
+    job["attempts"] = job.get("attempts", 0) + 1
+    return CLAIMED
+
+
+# Cloud Storageにジョブを保存するストア
+class GcsJobStore:
+    """gs://<bucket>/<prefix>/<job_id>.json にジョブの状態と結果を保存する"""
+
+    def __init__(self, bucket_name, prefix="analysis_jobs", client=None):
+        self.bucket = (client or clients.storage_client()).bucket(bucket_name)
+        self.prefix = prefix.strip("/")
+
+    def _blob(self, job_id):
+        return self.bucket.blob(f"{self.prefix}/{job_id}.json")
+
+    def save(self, job):
+        job["updated_at"] = now_iso()
+        self._blob(job["job_id"]).upload_from_string(
+            json.dumps(job, ensure_ascii=False), content_type="application/json")
+
+    def load(self, job_id):
+        from google.api_core import exceptions as gcs_exceptions
+
+        try:
+            return json.loads(self._blob(job_id).download_as_bytes())
+        except gcs_exceptions.NotFound:
+            return None
+
+    # 読み込んだ世代を条件に書き込むことで、同時に実行された呼び出しのうち1つだけが実行権を取得する
+    def claim(self, job_id, lease_seconds):
+        from google.api_core import exceptions as gcs_exceptions
+
+        blob = self.bucket.get_blob(self._blob(job_id).name)
+        if blob is None:
+            return NOT_FOUND, None
+        generation = blob.generation
+        try:
+            job = json.loads(blob.download_as_bytes(if_generation_match=generation))
+            outcome = try_claim(job, lease_seconds)
+            if outcome != CLAIMED:
+                return outcome, job
+            job["updated_at"] = now_iso()
+            self._blob(job_id).upload_from_string(
+                json.dumps(job, ensure_ascii=False), content_type="application/json",
+                if_generation_match=generation)
+        except gcs_exceptions.PreconditionFailed:
+            # 読み込んだ後に他の呼び出しがジョブを更新した
+            return ALREADY_RUNNING, None
+        return CLAIMED, job
+
+
+# プロセス内にジョブを保存するストア (ローカル検証用)
+class InMemoryJobStore:
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def save(self, job):
+        job["updated_at"] = now_iso()
+        with self.lock:
+            self.jobs[job["job_id"]] = json.loads(json.dumps(job))
+
+    def load(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job is not None else None
+
+    def claim(self, job_id, lease_seconds):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return NOT_FOUND, None
+            outcome = try_claim(job, lease_seconds)
+            if outcome == CLAIMED:
+                job["updated_at"] = now_iso()
+            return outcome, json.loads(json.dumps(job))
+
+
+# Cloud Tasksのキュー
+class CloudTasksQueue:
+    """ジョブIDを本文にしたHTTPタスクを作成し、分析関数自身を呼び出させる"""
+
+    def __init__(self, project, location, queue, service_account_email=None,
+                 dispatch_deadline_seconds=600):
+        self.project = project
+        self.location = location
+        self.queue = queue
+        self.service_account_email = service_account_email
+        self.dispatch_deadline_seconds = dispatch_deadline_seconds
+
+    def enqueue(self, target_url, payload):
+        from google.cloud import tasks_v2
+        from google.protobuf import duration_pb2
+
+        tasks_client = clients.tasks_client()
+        http_request = {
+            "http_method": tasks_v2.HttpMethod.POST,
+            "url": target_url,
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps(payload).encode(),
+        }
+        if self.service_account_email:
+            http_request["oidc_token"] = {
+                "service_account_email": self.service_account_email}
+        task = {
+            "http_request": http_request,
+            # Geminiの生成に時間がかかるため、タスクの応答待ちの上限を延ばす
+            "dispatch_deadline": duration_pb2.Duration(seconds=self.dispatch_deadline_seconds),
+        }
+        parent = tasks_client.queue_path(
+            self.project, self.location, self.queue)
+        tasks_client.create_task(parent=parent, task=task)
+        logging.info(f"Analysis task created for job {payload.get('job_id')}")
+
+
+# OIDCトークンのクレームを返す関数 (署名を検証できない場合は例外)
+# 関数の呼び出しに認証を必須にしている場合、Cloud Runが署名を検証した上で署名を取り除いて渡す
+# 署名が取り除かれたトークンは誰でも作成できるため、認証を必須にしている場合 (trust_platform_auth) のみクレームを読む
+def decode_oidc_token(token, audience, trust_platform_auth=False):
+    parts = token.split(".")
+    if len(parts) == 3 and parts[2] == "SIGNATURE_REMOVED_BY_GOOGLE":
+        if not trust_platform_auth:
+            raise ValueError("Token signature was removed but platform authentication is not enforced")
+        return json.loads(base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4)))
+
+    from google.auth.transport import requests as google_requests
+    from google.oauth2 import id_token
+
+    return id_token.verify_oauth2_token(token, google_requests.Request(), audience=audience)
+
+
+# Cloud Tasksから呼び出されたリクエストかを確認する関数
+# Cloud Tasksが付けるキュー名のヘッダーと、タスクに設定したサービスアカウントのOIDCトークンを確認する
+def verify_task_request(headers, audience, queue_name, service_account_email, trust_platform_auth=False):
+    if not service_account_email:
+        logging.warning("ANALYSIS_TASK_SERVICE_ACCOUNT is not set, task requests are rejected")
+        return False
+    if headers.get("X-CloudTasks-QueueName") != queue_name:
+        return False
+    authorization = headers.get("Authorization", "")
+    if not authorization.startswith("Bearer "):
+        return False
+    try:
+        claims = decode_oidc_token(authorization[len("Bearer "):], audience, trust_platform_auth)
+    except Exception as e:
+        logging.warning(f"Invalid OIDC token on task request: {e}")
+        return False
+    return claims.get("email") == service_account_email and bool(claims.get("email_verified"))
+
+
+# プロセス内のスレッドで実行するキュー (ローカル検証用)
+class InProcessQueue:
+    """タスクをHTTPで呼び出す代わりに handler(payload) をバックグラウンドのスレッドで実行する"""
+
+    def __init__(self, handler, max_workers=2):
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+
+    def enqueue(self, target_url, payload):
+        self.futures.append(self.executor.submit(self.handler, payload))
+
+    def join(self):
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+
+# 環境変数の設定からジョブのストアを作成する関数
+def create_job_store():
+    # プロセス内のキューを使う場合はジョブもプロセス内に保存する
+    if os.getenv("ANALYSIS_QUEUE_BACKEND", "cloud_tasks") == "in_process":
+        return InMemoryJobStore()
+    bucket_name = os.getenv("ANALYSIS_JOB_BUCKET") or os.getenv("GCS_BUCKET_NAME")
+    return GcsJobStore(bucket_name, os.getenv("ANALYSIS_JOB_PREFIX", "analysis_jobs"))
+
+
+# 環境変数の設定からキューを作成する関数
+def create_task_queue(handler):
+    if os.getenv("ANALYSIS_QUEUE_BACKEND", "cloud_tasks") == "in_process":
+        return InProcessQueue(handler)
+    return CloudTasksQueue(os.getenv("GCP_PROJECT_ID"), os.getenv("REGION"),
+                           os.getenv("ANALYSIS_QUEUE_NAME", "gemini-analysis"),
+                           os.getenv("ANALYSIS_TASK_SERVICE_ACCOUNT"))
@@ -0,0 +1,120 @@
+import csv
+import hashlib
+import io
+import json
+import logging
+
+import clients
+import export_files
+
+# 圧縮後のファイル名 (.csv 以外にして、次回のCSVファイルの一覧に含まれないようにする)
+COMPACT_OBJECT_NAME = "_compact/messages.txt"
+
+# エクスポートされるCSVの列
+TS_COLUMN = "ts"
+USER_COLUMN = "user_name"
+TEXT_COLUMN = "text"
+REACTIONS_COLUMN = "reactions_concatenated"
+CHANNEL_COLUMN = "channel_name"
+
+
+# 圧縮の結果
+class CompactionResult:
+    def __init__(self, uri, stats, reused):
+        self.uri = uri
+        self.stats = stats
+        self.reused = reused
+
+
+# 入力ファイルの世代と設定から、圧縮済みファイルが最新かどうかを判定する値を作成する関数
+def source_fingerprint(csv_files, max_message_chars):
+    payload = json.dumps({"inputs": [[uri, str(generation)] for uri, generation, _ in csv_files],
+                          "max_message_chars": max_message_chars}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# 複数のCSVファイルのメッセージを1つのテキストにまとめる関数
+def compact_messages(csv_texts, max_message_chars=0, chars_per_token=2.0):
+    """ユーザー名とチャネル名を辞書化し、重複したメッセージと空のメッセージを除いて時刻順に並べる
+
+    圧縮後のテキストと、圧縮前後の文字数・見積もりトークン数などの統計を返す
+    """
+    users = {}
+    channels = {}
+    seen = set()
+    rows = []
+    stats = {"input_chars": 0, "input_rows": 0, "empty_removed": 0,
+             "duplicates_removed": 0, "truncated": 0}
+
+    for text in csv_texts:
+        stats["input_chars"] += len(text)
+        for row in csv.DictReader(io.StringIO(text)):
+            stats["input_rows"] += 1
+            message = (row.get(TEXT_COLUMN) or "").strip()
+            if not message:
+                stats["empty_removed"] += 1
+                continue
+            key = (row.get(TS_COLUMN), row.get(USER_COLUMN),
+                   row.get(CHANNEL_COLUMN), message)
+            if key in seen:
+                stats["duplicates_removed"] += 1
+                continue
+            seen.add(key)
+            if max_message_chars and len(message) > max_message_chars:
+                message = message[:max_message_chars] + "…"
+                stats["truncated"] += 1
+            user_id = users.setdefault(
+                row.get(USER_COLUMN) or "", f"u{len(users) + 1}")
+            channel_id = channels.setdefault(
+                row.get(CHANNEL_COLUMN) or "", f"c{len(channels) + 1}")
+            rows.append((row.get(TS_COLUMN) or "", user_id, channel_id, message,
+                         row.get(REACTIONS_COLUMN) or ""))
+
+    rows.sort(key=lambda row: row[0])
+
+    output = io.StringIO()
+    output.write("# Slackメッセージ (ユーザーとチャネルは以下の略称で表記)\n")
+    output.write("# users: " + ", ".join(f"{short}={name}" for name, short in users.items()) + "\n")
+    output.write("# channels: " + ", ".join(f"{short}={name}" for name, short in channels.items()) + "\n")
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(["ts", "user", "channel", "text", "reactions"])
+    writer.writerows(rows)
+    compacted = output.getvalue()
+
+    stats["output_chars"] = len(compacted)
+    stats["output_rows"] = len(rows)
+    stats["input_tokens_estimate"] = round(stats["input_chars"] / chars_per_token)
+    stats["output_tokens_estimate"] = round(len(compacted) / chars_per_token)
+    stats["tokens_saved_estimate"] = stats["input_tokens_estimate"] - stats["output_tokens_estimate"]
+    return compacted, stats
+
+
+# エクスポートされたCSVファイルを圧縮して1つのオブジェクトに保存する関数
+def compact_export(bucket_name, target_path, csv_files, max_message_chars=0, chars_per_token=2.0):
+    """同じ入力から作成済みの場合は作成し直さずに再利用する
+
+    csv_files は (gs:// のURI, オブジェクトの世代, サイズ) のリスト
+    """
+    bucket = clients.storage_client().bucket(bucket_name)
+    blob_name = f"{target_path.rstrip('/')}/{COMPACT_OBJECT_NAME}"
+    uri = f"gs://{bucket_name}/{blob_name}"
+    fingerprint = source_fingerprint(csv_files, max_message_chars)
+
+    existing = bucket.get_blob(blob_name)
+    if existing is not None and (existing.metadata or {}).get("source_fingerprint") == fingerprint:
+        stats = json.loads(existing.metadata.get("stats", "{}"))
+        logging.info(f"Reusing compacted export: {uri}")
+        return CompactionResult(uri, stats, reused=True)
+
+    # GZIP圧縮されたファイルは1つずつ展開して読み込む
+    csv_texts = (export_files.read_export_text(csv_uri)
+                 for csv_uri, _, _ in csv_files)
+    compacted, stats = compact_messages(
+        csv_texts, max_message_chars, chars_per_token)
+
+    blob = bucket.blob(blob_name)
+    blob.metadata = {"source_fingerprint": fingerprint,
+                     "stats": json.dumps(stats)}
+    blob.upload_from_string(compacted, content_type="text/plain; charset=utf-8")
+    logging.info(f"Compacted {len(csv_files)} CSV files into {uri}: {json.dumps(stats)}")
+    return CompactionResult(uri, stats, reused=False)
@@ -0,0 +1,96 @@
+import gzip
+import json
+import logging
+import threading
+import time
+
+import clients
+
+# Dataformのジョブ完了時に書き込まれるエクスポートファイルの一覧
+MANIFEST_NAME = "_manifest.json"
+
+# エクスポートされるファイルの拡張子 (GZIP圧縮したCSVと圧縮していないCSV)
+EXPORT_SUFFIXES = (".csv", ".csv.gz")
+
+# 一覧取得のキャッシュ ((バケット名, プレフィックス) -> (有効期限, ファイルの一覧))
+_listing_cache = {}
+_listing_cache_lock = threading.Lock()
+
+
+def manifest_name(target_path):
+    return f"{target_path.rstrip('/')}/{MANIFEST_NAME}"
+
+
+def is_export_file(name):
+    return name.endswith(EXPORT_SUFFIXES)
+
+
+def is_compressed(uri):
+    return uri.endswith(".gz")
+
+
+# エクスポートされたファイルを読み込み、圧縮されている場合は展開して返す関数
+def read_export_bytes(uri):
+    bucket_name, _, blob_name = uri[len("gs://"):].partition("/")
+    data = clients.storage_client().bucket(bucket_name).blob(blob_name).download_as_bytes()
+    # Content-Encoding: gzip のオブジェクトはダウンロード時に展開済みのため、先頭のバイトで判定する
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    return data
+
+
+def read_export_text(uri):
+    return read_export_bytes(uri).decode("utf-8")
+
+
+# マニフェストからエクスポートされたCSVファイルの一覧を読み込む関数 (無い場合はNone)
+def read_manifest(bucket, target_path):
+    from google.api_core import exceptions as gcs_exceptions
+
+    try:
+        manifest = json.loads(bucket.blob(
+            manifest_name(target_path)).download_as_bytes())
+    except gcs_exceptions.NotFound:
+        return None
+    return [(f"gs://{bucket.name}/{file['name']}", file.get("generation"), file.get("size"))
+            for file in manifest.get("files", []) if is_export_file(file["name"])]
+
+
+# プレフィックス配下のCSVファイルを一覧取得する関数
+def list_csv_blobs(bucket, target_path):
+    # .csv / .csv.gz 以外のオブジェクトはサーバー側で除外し、必要な項目だけを返させる
+    blobs = bucket.list_blobs(prefix=target_path, match_glob="**.{csv,csv.gz}",
+                              fields="items(name,generation,size),nextPageToken")
+    return [(f"gs://{bucket.name}/{blob.name}", blob.generation, blob.size) for blob in blobs]
+
+
+# エクスポートされたCSVファイルの (URI, 世代, サイズ) のリストを返す関数 (サイズは圧縮後のバイト数)
+def list_export_csv_files(bucket_name, target_path, ttl_seconds=60):
+    """マニフェストがあればそれを読み、無ければ一覧を取得する。結果は ttl_seconds の間キャッシュする"""
+    cache_key = (bucket_name, target_path)
+    now = time.monotonic()
+    with _listing_cache_lock:
+        cached = _listing_cache.get(cache_key)
+        if cached is not None and cached[0] > now:
+            logging.info(f"Listing cache hit for gs://{bucket_name}/{target_path}")
+            return cached[1]
+
+    bucket = clients.storage_client().bucket(bucket_name)
+    csv_files = read_manifest(bucket, target_path)
+    if csv_files is not None:
+        logging.info(f"Read {len(csv_files)} CSV files from the export manifest")
+    else:
+        csv_files = list_csv_blobs(bucket, target_path)
+
+    if ttl_seconds > 0:
+        with _listing_cache_lock:
+            # 期限切れのものを削除してから追加する
+            for key in [key for key, (expires_at, _) in _listing_cache.items() if expires_at <= now]:
+                del _listing_cache[key]
+            _listing_cache[cache_key] = (now + ttl_seconds, csv_files)
+    return csv_files
+
+
+def clear_listing_cache():
+    with _listing_cache_lock:
+        _listing_cache.clear()
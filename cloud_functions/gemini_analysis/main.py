@@ -1,16 +1,22 @@
 import os
 import logging
-from google.cloud import storage
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part
-from flask import Request
+import re
+import time
+from flask import Request, Response
 import functions_framework
-import google.cloud.logging
-import logging
+import clients
+import result_cache
+import map_reduce
+import compaction
+import export_files
+import analysis_jobs
+import secret_cache
+import tracing
+import json
+import requests
 
-# Cloud Loggingの初期化
-logging_client = google.cloud.logging.Client()
-logging_client.setup_logging()
+# 分析に使うモデル
+MODEL_NAME = "gemini-1.5-pro"
 
 # MIMEタイプの判定
 
@@ -29,24 +35,453 @@ def get_mime_type(file_uri):
 
 
 def list_csv_files_in_gcs(bucket_name, target_path):
+    """CSVファイルのURI、オブジェクトの世代、サイズの組のリストを返す"""
     try:
         logging.info(
             f"Fetching CSV files from GCS path: {target_path} in bucket: {bucket_name}")
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=target_path)
-
-        csv_files = [
-            f"gs://{bucket_name}/{blob.name}" for blob in blobs if blob.name.endswith(".csv")]
-        logging.info(f"CSV files found: {csv_files}")
+        csv_files = export_files.list_export_csv_files(
+            bucket_name, target_path, float(os.getenv("LISTING_CACHE_TTL_SECONDS", 60)))
+        logging.info(f"CSV files found: {[uri for uri, _, _ in csv_files]}")
         return csv_files
     except Exception as e:
         logging.error(f"Error listing CSV files: {e}")
         raise
 
+# 分析に使うモデルを作成する関数 (ローカルの代替モデルに差し替えて検証できる)
+
+
+def create_analysis_model(generation_config):
+    return map_reduce.VertexAIModel(MODEL_NAME, generation_config)
+
+# 分析方法を決める関数
+# auto の場合はCSVの合計サイズが閾値を超えるときにMap-Reduce方式で分析する
+
+
+def resolve_analysis_mode(mode, csv_files):
+    if mode != "auto":
+        return mode
+    total_bytes = sum(size or 0 for _, _, size in csv_files)
+    threshold = int(os.getenv("MAP_REDUCE_THRESHOLD_BYTES", 1000000))
+    return "map_reduce" if total_bytes > threshold else "single"
+
+# gs:// のURIからオブジェクトの世代を取得する関数 (存在しない場合はNone)
+
+
+def get_object_generation(gcs_uri):
+    bucket_name, _, blob_name = gcs_uri[len("gs://"):].partition("/")
+    blob = clients.storage_client().bucket(bucket_name).get_blob(blob_name)
+    return blob.generation if blob else None
+
+# 応答までの時間 (TTFB) と全体の処理時間を記録する関数
+# mode は stream (ストリーミング) または blocking (生成の完了後に一括で返す)
+
+
+def record_latency(mode, started, first_byte_at, cache_hit=False):
+    finished = time.perf_counter()
+    metrics = {
+        "mode": mode,
+        "cache_hit": cache_hit,
+        "ttfb_ms": round(((first_byte_at or finished) - started) * 1000, 1),
+        "total_ms": round((finished - started) * 1000, 1),
+    }
+    logging.info(f"Analysis latency metrics: {json.dumps(metrics)}")
+    return metrics
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# 生成されたテキストをServer-Sent Eventsとして順に返すレスポンスを作成する関数
+# chunk イベントで生成途中のテキストを送り、完了したら on_complete(全体のテキスト) を呼んで done イベントを送る
+
+
+def stream_response(chunks, started, on_complete=None, extra=None, cache_hit=False):
+    # 送信は関数のスパンが終了した後に行われるため、呼び出し時のスパンを親にして記録する
+    parent = tracing.current_span()
+
+    def events():
+        parts = []
+        first_byte_at = None
+        try:
+            with tracing.span("gemini.stream", parent=parent, cache_hit=cache_hit) as stream_span:
+                try:
+                    for chunk in chunks:
+                        if first_byte_at is None:
+                            first_byte_at = time.perf_counter()
+                        parts.append(chunk)
+                        yield sse_event("chunk", {"text": chunk})
+                    if on_complete is not None:
+                        on_complete("".join(parts))
+                    metrics = record_latency("stream", started, first_byte_at, cache_hit)
+                    stream_span.set_attribute("ttfb_ms", metrics["ttfb_ms"])
+                    yield sse_event("done", dict(extra or {}, status="success", metrics=metrics))
+                except Exception as e:
+                    # ステータスコードは送信済みのため、エラーはイベントとして返す
+                    logging.error(f"An error occurred while streaming: {e}", exc_info=True)
+                    stream_span.status = "ERROR"
+                    stream_span.error = f"{type(e).__name__}: {e}"
+                    yield sse_event("error", {"error": str(e)})
+        finally:
+            tracing.tracer.flush()
+
+    # プロキシでバッファリングされないようにする
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# 分析を実行する関数 (同期実行とジョブの実行で共通)
+# レスポンスの本文とステータスコードを返す (stream の場合の本文はServer-Sent Eventsのレスポンス)
+
+
+def run_analysis(request_json, stream=False):
+    started = time.perf_counter()
+    prompt = request_json.get("prompt")
+
+    # Vertex AIの初期化 (vertexaiの読み込みは必要になるまで遅らせる)
+    from vertexai.generative_models import Part
+
+    project_id = os.getenv("PROJECT_ID")
+    clients.init_vertexai(project_id, "asia-northeast1")
+    logging.info(f"Vertex AI initialized with project: {project_id}")
+
+    contents = [prompt]
+    # キャッシュキーに使う入力ファイルのURIと世代
+    inputs = []
+    # Map-Reduce方式で最終的な統合の際に渡すファイル
+    extra_parts = []
+    csv_file_uris = []
+
+    # Handle strength PDF if strength_flag is "Y"
+    strength_flag = request_json.get("strength_flag", "N")
+    if strength_flag == "Y":
+        strength_pdf_path = request_json.get("strength_pdf_path")
+        if not strength_pdf_path:
+            logging.error("Missing strength_pdf_path in the request")
+            return "Invalid request: Missing strength_pdf_path", 400
+
+        logging.info(
+            f"Strength PDF Path from Cloud Storage: {strength_pdf_path}")
+        mime_type = get_mime_type(strength_pdf_path)
+        pdf_part = Part.from_uri(strength_pdf_path, mime_type=mime_type)
+        contents.append(pdf_part)
+        extra_parts.append(pdf_part)
+        inputs.append(
+            (strength_pdf_path, get_object_generation(strength_pdf_path)))
+
+    # Handle CSV files if analysis_target is "slack messages"
+    analysis_target = request_json.get("analysis_target")
+    if analysis_target == "slack messages":
+        logging.info(
+            f"Listing CSV files in GCS path: {request_json.get('target_file_path')}")
+        with tracing.span("gcs.list_exports") as list_span:
+            csv_file_uris = list_csv_files_in_gcs(
+                os.getenv("GCS_BUCKET_NAME"), request_json.get("target_file_path"))
+            list_span.set_attribute("files", len(csv_file_uris))
+        if not csv_file_uris:
+            logging.error(
+                f"No CSV files found at the specified path: {request_json.get('target_file_path')}")
+            return "No CSV files found at the specified path", 404
+
+        for csv_uri, generation, _ in csv_file_uris:
+            inputs.append((csv_uri, generation))
+
+    # 分析方法 (single: 1回のリクエストで分析、map_reduce: 分割して分析した結果を統合、auto: サイズで選択)
+    analysis_mode = resolve_analysis_mode(
+        request_json.get("analysis_mode", os.getenv("ANALYSIS_MODE", "single")), csv_file_uris)
+    if analysis_mode not in ("single", "map_reduce"):
+        return f"Invalid request: Unknown analysis_mode {analysis_mode}", 400
+    if analysis_mode == "map_reduce" and not csv_file_uris:
+        return "Invalid request: map_reduce mode requires slack messages", 400
+    logging.info(f"Analysis mode: {analysis_mode}")
+
+    # 1回のリクエストで分析する場合は、CSVファイルを圧縮した1つのファイルを渡す
+    compact_exports = bool(csv_file_uris) and analysis_mode == "single" and \
+        os.getenv("COMPACT_EXPORTS", "true").lower() == "true"
+    max_message_chars = int(os.getenv("COMPACTION_MAX_MESSAGE_CHARS", 0))
+
+    # Set up generation model configuration
+    generation_config = {
+        "temperature": 0,
+        "top_p": 0.95,
+        "top_k": 40,
+        "candidate_count": 1,
+        "max_output_tokens": 8192,
+    }
+    logging.info(f"Generation Config: {generation_config}")
+
+    # 同じプロンプトと同じ世代の入力ファイルに対する結果はキャッシュから返す
+    # bypass_cache が指定された場合はキャッシュを読まずに生成し、結果で上書きする
+    cache = clients.get_client(
+        "result_cache", result_cache.create_result_cache)
+    chunk_tokens = int(os.getenv("MAP_REDUCE_CHUNK_TOKENS", 200000))
+    if analysis_mode == "map_reduce":
+        cache_settings = dict(
+            generation_config, analysis_mode=analysis_mode, chunk_tokens=chunk_tokens)
+    elif compact_exports:
+        cache_settings = dict(
+            generation_config, compact_exports=True, max_message_chars=max_message_chars)
+    else:
+        cache_settings = generation_config
+    key = result_cache.cache_key(
+        MODEL_NAME, cache_settings, prompt, inputs)
+    if cache is not None and not request_json.get("bypass_cache", False):
+        with tracing.span("result_cache.get") as cache_span:
+            cached_content = cache.get(key)
+            cache_span.set_attribute("hit", cached_content is not None)
+        if cached_content is not None:
+            logging.info(f"Result cache hit: {key}")
+            if stream:
+                return stream_response(iter([cached_content]), started, cache_hit=True), 200
+            return {"status": "success", "generated_content": cached_content}, 200
+
+    # CSVファイルは圧縮した1つのファイルにまとめて渡す (作成済みの場合は再利用する)
+    compaction_stats = None
+    if compact_exports:
+        with tracing.span("exports.compact"):
+            compacted = compaction.compact_export(
+                os.getenv("GCS_BUCKET_NAME"), request_json.get("target_file_path"),
+                csv_file_uris, max_message_chars,
+                float(os.getenv("MAP_REDUCE_CHARS_PER_TOKEN", 2.0)))
+        compaction_stats = compacted.stats
+        contents.append(Part.from_uri(
+            compacted.uri, mime_type="text/plain"))
+    elif analysis_mode == "single":
+        for csv_uri, _, _ in csv_file_uris:
+            # GZIP圧縮されたファイルはGeminiが読めないため、展開してリクエストに含める
+            if export_files.is_compressed(csv_uri):
+                part = Part.from_data(
+                    data=export_files.read_export_bytes(csv_uri), mime_type="text/csv")
+            else:
+                mime_type = get_mime_type(csv_uri)
+                part = Part.from_uri(csv_uri, mime_type=mime_type)
+            contents.append(part)
+
+    model = create_analysis_model(generation_config)
+
+    def generate(stream):
+        if analysis_mode == "map_reduce":
+            return map_reduce.analyze_map_reduce(
+                model, prompt, [uri for uri, _, _ in csv_file_uris], extra_parts,
+                max_tokens=chunk_tokens,
+                chars_per_token=float(
+                    os.getenv("MAP_REDUCE_CHARS_PER_TOKEN", 2.0)),
+                concurrency=int(os.getenv("MAP_REDUCE_CONCURRENCY", 4)),
+                stream=stream)
+        logging.info(
+            f"Generating content with prompt and files: {contents}")
+        return model.generate_stream(contents) if stream else model.generate(contents)
+
+    # 生成が完了した結果をキャッシュに保存する
+    def store_result(generated_content):
+        logging.info("Content generated successfully")
+        if cache is not None:
+            cache.put(key, generated_content)
+            logging.info(f"Result cache metrics: {cache.counters}")
+
+    extra = {"compaction": compaction_stats} if compaction_stats is not None else {}
+
+    # Generate content
+    if stream:
+        # 生成はレスポンスの送信を始めてから行う
+        def chunks():
+            yield from generate(stream=True)
+
+        return stream_response(chunks(), started, store_result, extra), 200
+
+    with tracing.span("gemini.generate", analysis_mode=analysis_mode):
+        generated_content = generate(stream=False)
+    store_result(generated_content)
+    response_json = {"status": "success",
+                     "generated_content": generated_content,
+                     **extra,
+                     "metrics": record_latency("blocking", started, None)}
+    return response_json, 200
+
+# シークレットマネージャーからAPIキーを取得する関数
+# 取得した値は SECRET_CACHE_TTL_SECONDS の間プロセス内にキャッシュする
+
+
+def get_secret(secret_name):
+    project_id = os.getenv("GCP_PROJECT_ID")
+    secret_path = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
+
+    def load():
+        try:
+            response = clients.secret_manager_client().access_secret_version(name=secret_path)
+            return response.payload.data.decode("UTF-8")
+        except Exception as e:
+            logging.error(f"Failed to retrieve secret: {e}")
+            raise
+
+    return secret_cache.cache.get(secret_path, load)
+
+# 非同期モードの分析結果をAppSheetに書き込む関数 (analysis_idをPKとして使用)
+# APPSHEET_ANALYSIS_TABLE が設定されていない場合は書き込まない
+
+
+def update_appsheet_analysis_data(job):
+    app_id = os.getenv("APP_ID")
+    table_name = os.getenv("APPSHEET_ANALYSIS_TABLE")
+    if not app_id or not table_name:
+        return
+    try:
+        url = f"https://api.appsheet.com/api/v2/apps/{app_id}/tables/{table_name}/records"
+        succeeded = job["status"] == analysis_jobs.SUCCEEDED
+        payload = {
+            "Action": "Edit",
+            "Properties": {
+                "Locale": "en-US",
+                "Location": "47.6154086,-122.3349685",
+                "Timezone": "Pacific Standard Time"
+            },
+            "Rows": [
+                {
+                    "analysis_id": job["analysis_id"],
+                    os.getenv("APPSHEET_ANALYSIS_RESULT_COLUMN", "result"):
+                        job["result"] if succeeded else job["error"],
+                    "status": "成功" if succeeded else "エラー"
+                }
+            ]
+        }
+        # 認証エラーの場合はAPIキーが更新された可能性があるため、取得し直して1度だけ再試行する
+        for attempt in range(2):
+            api_key = get_secret("appsheet-api-key")
+            headers = {
+                "ApplicationAccessKey": api_key,
+                "Content-Type": "application/json",
+            }
+            response = requests.post(url, headers=headers, json=payload, timeout=60)
+            if response.status_code not in (401, 403) or attempt == 1:
+                break
+            secret_cache.cache.invalidate(
+                f"projects/{os.getenv('GCP_PROJECT_ID')}/secrets/appsheet-api-key/versions/latest", api_key)
+
+        if response.status_code == 200:
+            logging.info(
+                f"Successfully updated analysis_id {job['analysis_id']} in AppSheet.")
+        else:
+            logging.error(
+                f"Failed to update analysis_id {job['analysis_id']}. Status code: {response.status_code}")
+            logging.error(response.text)
+    except Exception as e:
+        # 結果はジョブのストアに保存済みのため、AppSheetへの書き込みに失敗しても処理は続行する
+        logging.error(f"Failed to update AppSheet: {e}")
+
+
+def job_store():
+    return clients.get_client("analysis_job_store", analysis_jobs.create_job_store)
+
+
+def task_queue():
+    return clients.get_client(
+        "analysis_task_queue",
+        lambda: analysis_jobs.create_task_queue(handle_analysis_task))
+
+# タスクから呼び出すURL (未設定の場合はこの関数自身のURL)
+
+
+def analysis_task_url(request):
+    return os.getenv("ANALYSIS_TASK_URL") or f"https://{request.host}{request.path}"
+
+# 分析ジョブを登録する関数
+
+
+def submit_analysis_job(request_json, task_url):
+    job = analysis_jobs.new_job(request_json)
+    job_store().save(job)
+    # ジョブの実行を登録したリクエストのスパンの子として記録するため traceparent を引き継ぐ
+    task_queue().enqueue(task_url, tracing.inject(
+        {"task": "run_analysis_job", "job_id": job["job_id"]}))
+    logging.info(
+        f"Analysis job {job['job_id']} submitted for analysis_id {job['analysis_id']}")
+    return {"status": "accepted", "job_id": job["job_id"], "analysis_id": job["analysis_id"]}, 202
+
+# 分析ジョブを実行する関数 (タスクから呼び出される)
+
+
+def run_analysis_job(job_id):
+    store = job_store()
+    # 実行中のジョブは実行権の期限が切れるまで再実行しない (関数のタイムアウトより長く実行されることは無い)
+    outcome, job = store.claim(
+        job_id, float(os.getenv("ANALYSIS_JOB_LEASE_SECONDS", 600)))
+    if outcome == analysis_jobs.NOT_FOUND:
+        # 存在しないジョブはリトライしても成功しないため、正常終了としてタスクを完了させる
+        logging.error(f"Analysis job {job_id} not found")
+        return {"job_id": job_id, "status": "NOT_FOUND"}, 200
+    if outcome == analysis_jobs.ALREADY_FINISHED:
+        logging.info(f"Analysis job {job_id} has already finished")
+        return {"job_id": job_id, "status": job["status"]}, 200
+    if outcome == analysis_jobs.ALREADY_RUNNING:
+        # 実行中の呼び出しが期限までに終わらなかった場合に再実行できるよう、タスクは再試行させる
+        logging.warning(f"Analysis job {job_id} is already running")
+        return {"job_id": job_id, "status": analysis_jobs.RUNNING}, 409
+
+    try:
+        body, status_code = run_analysis(job["request"])
+    except Exception as e:
+        logging.error(f"Analysis job {job_id} failed: {e}", exc_info=True)
+        body, status_code = {"error": str(e)}, 500
+
+    if status_code == 200:
+        job["status"] = analysis_jobs.SUCCEEDED
+        job["result"] = body["generated_content"]
+    else:
+        job["status"] = analysis_jobs.FAILED
+        job["error"] = body if isinstance(body, str) else body.get("error")
+    job["lease_expires_at"] = None
+    store.save(job)
+    logging.info(f"Analysis job {job_id} finished with status {job['status']}")
+
+    update_appsheet_analysis_data(job)
+    return {"job_id": job_id, "status": job["status"]}, 200
+
+# プロセス内のキューから分析ジョブを実行する関数 (タスクの本文の traceparent を親にする)
+
+
+def handle_analysis_task(payload):
+    with tracing.start_request("gemini_analysis", payload):
+        return run_analysis_job(payload["job_id"])
+
+# 分析ジョブの状態と結果を返す関数
+
+
+def get_analysis_job(job_id):
+    job = job_store().load(job_id)
+    if job is None:
+        return {"error": f"Analysis job {job_id} not found"}, 404
+    response_json = {"job_id": job_id, "analysis_id": job["analysis_id"],
+                     "status": job["status"]}
+    if job["status"] == analysis_jobs.SUCCEEDED:
+        response_json["generated_content"] = job["result"]
+    elif job["status"] == analysis_jobs.FAILED:
+        response_json["error"] = job["error"]
+    return response_json, 200
+
+# エクスポート先のパス (exports/{job_id}_{タイムスタンプ}) からDataformジョブのjob_idを取得する関数
+# traceparent が渡されない場合も、同じjob_idのSlackの取り込みやDataformと同じトレースになる
+
+
+def export_job_id(target_file_path):
+    match = re.search(r"exports/(.+)_\d{17}/?$", target_file_path or "")
+    return match.group(1) if match else None
+
 # HTTPトリガー用のメイン関数
 @functions_framework.http
 def main(request: Request):
+    request_json = request.get_json(silent=True)
+    # JSONがオブジェクトでない場合の検証は handle_request に任せる
+    request_json = request_json if isinstance(request_json, dict) else {}
+    with tracing.start_request("gemini_analysis", request_json,
+                               job_id=export_job_id(request_json.get("target_file_path"))) as root:
+        body, status_code = handle_request(request)
+        root.set_attribute("http.status_code", status_code)
+        return body, status_code
+
+# リクエストの内容に応じて分析、ジョブの登録・実行・状態の取得を行う関数
+
+
+def handle_request(request: Request):
+    # Cloud Loggingの設定は最初のリクエストで1度だけ行う
+    clients.setup_logging()
     try:
         logging.info(f"Received request: {request}")
         request_json = request.get_json(silent=True)
@@ -54,6 +489,22 @@ def main(request: Request):
             logging.error("No JSON data provided in the request")
             return "Invalid request: No JSON data provided", 400
 
+        # Cloud Tasksから分析ジョブを実行する
+        # タスク以外からの呼び出しでジョブが実行されないよう、Cloud Tasksからのリクエストであることを確認する
+        if request_json.get("task") == "run_analysis_job":
+            if not analysis_jobs.verify_task_request(
+                    request.headers, analysis_task_url(request),
+                    os.getenv("ANALYSIS_QUEUE_NAME", "gemini-analysis"),
+                    os.getenv("ANALYSIS_TASK_SERVICE_ACCOUNT"),
+                    os.getenv("ANALYSIS_TASK_PLATFORM_AUTH", "false").lower() == "true"):
+                logging.warning("Rejected run_analysis_job request not sent by Cloud Tasks")
+                return {"error": "Forbidden"}, 403
+            return run_analysis_job(request_json.get("job_id"))
+
+        # 分析ジョブの状態の取得 (ポーリング)
+        if request_json.get("analysis_job_id"):
+            return get_analysis_job(request_json["analysis_job_id"])
+
         # Prompt and analysis_id are required parameters
         prompt = request_json.get("prompt")
         analysis_id = request_json.get("analysis_id")
@@ -64,63 +515,12 @@ def main(request: Request):
         if not all([prompt, analysis_id]):
             return "Invalid request: Missing prompt or analysis_id", 400
 
-        # Vertex AIの初期化
-        project_id = os.getenv("PROJECT_ID")
-        vertexai.init(project=project_id, location="asia-northeast1")
-        logging.info(f"Vertex AI initialized with project: {project_id}")
+        # 非同期モード: ジョブを登録してすぐにジョブIDを返し、分析はタスクとして実行する
+        if request_json.get("async", False):
+            return submit_analysis_job(request_json, analysis_task_url(request))
 
-        contents = [prompt]
-
-        # Handle strength PDF if strength_flag is "Y"
-        strength_flag = request_json.get("strength_flag", "N")
-        if strength_flag == "Y":
-            strength_pdf_path = request_json.get("strength_pdf_path")
-            if not strength_pdf_path:
-                logging.error("Missing strength_pdf_path in the request")
-                return "Invalid request: Missing strength_pdf_path", 400
-
-            logging.info(
-                f"Strength PDF Path from Cloud Storage: {strength_pdf_path}")
-            mime_type = get_mime_type(strength_pdf_path)
-            pdf_part = Part.from_uri(strength_pdf_path, mime_type=mime_type)
-            contents.append(pdf_part)
-
-        # Handle CSV files if analysis_target is "slack messages"
-        analysis_target = request_json.get("analysis_target")
-        if analysis_target == "slack messages":
-            logging.info(
-                f"Listing CSV files in GCS path: {request_json.get('target_file_path')}")
-            csv_file_uris = list_csv_files_in_gcs(
-                os.getenv("GCS_BUCKET_NAME"), request_json.get("target_file_path"))
-            if not csv_file_uris:
-                logging.error(
-                    f"No CSV files found at the specified path: {request_json.get('target_file_path')}")
-                return "No CSV files found at the specified path", 404
-
-            for csv_uri in csv_file_uris:
-                mime_type = get_mime_type(csv_uri)
-                part = Part.from_uri(csv_uri, mime_type=mime_type)
-                contents.append(part)
-
-        # Set up generation model configuration
-        generation_config = {
-            "temperature": 0,
-            "top_p": 0.95,
-            "top_k": 40,
-            "candidate_count": 1,
-            "max_output_tokens": 8192,
-        }
-        logging.info(f"Generation Config: {generation_config}")
-
-        model = GenerativeModel(
-            "gemini-1.5-pro", generation_config=generation_config)
-
-        # Generate content
-        logging.info(f"Generating content with prompt and files: {contents}")
-        response = model.generate_content(contents)
-
-        logging.info("Content generated successfully")
-        return {"status": "success", "generated_content": response.text}, 200
+        # ストリーミングモード: 生成されたテキストを順にServer-Sent Eventsで返す
+        return run_analysis(request_json, stream=request_json.get("stream", False))
 
     except Exception as e:
         logging.error(f"An error occurred: {e}", exc_info=True)
@@ -0,0 +1,159 @@
+import csv
+import io
+import logging
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import export_files
+import tracing
+
+# 分割した各チャンクに対するプロンプト
+MAP_PROMPT = """以下はSlackメッセージをCSV形式で分割したものの一部です (No.{index})。
+後で他の部分の結果と統合するため、次の分析の観点に沿って、根拠となる発言 (日時・ユーザー名・内容) を含めて要点をまとめてください。
+
+分析の観点:
+{prompt}"""
+
+# 部分的な分析結果を統合するプロンプト
+REDUCE_PROMPT = """{prompt}
+
+以下はSlackメッセージを分割して分析した部分的な結果です。これらを統合して最終的な分析結果を作成してください。"""
+
+# 最終結果ではない中間の統合に使うプロンプト
+INTERMEDIATE_REDUCE_PROMPT = """以下はSlackメッセージを分割して分析した部分的な結果です。
+後でさらに統合するため、次の分析の観点に沿って、根拠となる発言を残したまま1つにまとめてください。
+
+分析の観点:
+{prompt}"""
+
+
+# Vertex AIのGeminiを使うモデル
+class VertexAIModel:
+    """generate(contents) で生成したテキストを、generate_stream(contents) で生成途中のテキストを順に返す
+
+    contents は文字列またはPartのリスト。同じメソッドを持つオブジェクトであればローカルの代替モデルに差し替えられる
+    """
+
+    def __init__(self, model_name, generation_config):
+        from vertexai.generative_models import GenerativeModel
+
+        self.model = GenerativeModel(
+            model_name, generation_config=generation_config)
+
+    def generate(self, contents):
+        return self.model.generate_content(contents).text
+
+    def generate_stream(self, contents):
+        for response in self.model.generate_content(contents, stream=True):
+            # テキストを含まないチャンク (終了理由だけのものなど) は飛ばす
+            if response.candidates and response.candidates[0].content.parts:
+                yield response.text
+
+
+# トークン数の見積もり
+def estimate_tokens(text, chars_per_token):
+    return math.ceil(len(text) / chars_per_token)
+
+
+# エクスポートされたCSVファイルをトークン数の上限ごとのチャンクに分割する関数
+def iter_csv_chunks(csv_uris, max_tokens, chars_per_token):
+    """ヘッダー付きのCSV文字列を順に返す (ファイルは1つずつ読み込む)"""
+    header = None
+    rows = []
+    tokens = 0
+
+    def render():
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(rows)
+        return output.getvalue()
+
+    for uri in csv_uris:
+        reader = csv.reader(io.StringIO(export_files.read_export_text(uri)))
+        file_header = next(reader, None)
+        if file_header is None:
+            continue
+        header = header or file_header
+        for row in reader:
+            row_tokens = estimate_tokens(",".join(row), chars_per_token) + 1
+            if rows and tokens + row_tokens > max_tokens:
+                yield render()
+                rows, tokens = [], 0
+            rows.append(row)
+            tokens += row_tokens
+    if rows:
+        yield render()
+
+
+# 部分的な結果をトークン数の上限ごとのグループに分ける関数
+def group_by_tokens(texts, max_tokens, chars_per_token):
+    groups = [[]]
+    tokens = 0
+    for text in texts:
+        text_tokens = estimate_tokens(text, chars_per_token)
+        if groups[-1] and tokens + text_tokens > max_tokens:
+            groups.append([])
+            tokens = 0
+        groups[-1].append(text)
+        tokens += text_tokens
+    return groups
+
+
+def format_partials(partials):
+    return "\n\n".join(f"## 部分結果 {i + 1}\n{partial}" for i, partial in enumerate(partials))
+
+
+# 1回分の生成をトレースのスパンとして記録する関数
+def traced_generate(model, span_name, contents, **attributes):
+    with tracing.span(span_name, **attributes):
+        return model.generate(contents)
+
+
+# Map-Reduce方式で分析する関数
+def analyze_map_reduce(model, prompt, csv_uris, extra_parts=(), max_tokens=200000,
+                       chars_per_token=2.0, concurrency=4, stream=False):
+    """CSVをチャンクごとに並列に分析し (map)、部分的な結果を統合する (reduce)
+
+    extra_parts (強みのPDFなど) は最終的な統合の際にだけ渡す
+    stream の場合は最終的な統合の結果を順に返すイテレータを返す
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        partials = []
+        pending = deque()
+        # チャンクは必要になった時点で作成し、未完了のリクエストは同時実行数の2倍までにする
+        for index, chunk in enumerate(iter_csv_chunks(csv_uris, max_tokens, chars_per_token)):
+            if len(pending) >= concurrency * 2:
+                partials.append(pending.popleft().result())
+            map_prompt = MAP_PROMPT.format(index=index + 1, prompt=prompt)
+            # スレッドプールで実行する生成も現在のスパンの子として記録する
+            pending.append(executor.submit(
+                tracing.bind(traced_generate), model, "gemini.map", [map_prompt, chunk], chunk=index + 1))
+        partials.extend(future.result() for future in pending)
+        if not partials:
+            raise ValueError("No messages found in the CSV files")
+        logging.info(
+            f"Map-reduce analysis: {len(partials)} chunks analyzed with concurrency {concurrency}")
+
+        # 部分的な結果が上限を超える場合は段階的に統合する
+        while True:
+            groups = group_by_tokens(partials, max_tokens, chars_per_token)
+            # 1件ずつでも上限を超える場合はこれ以上まとめられない
+            if len(groups) == 1 or len(groups) == len(partials):
+                break
+            logging.info(
+                f"Reducing {len(partials)} partial results in {len(groups)} groups")
+            intermediate_prompt = INTERMEDIATE_REDUCE_PROMPT.format(
+                prompt=prompt)
+            futures = [executor.submit(
+                tracing.bind(traced_generate), model, "gemini.reduce",
+                [intermediate_prompt, format_partials(group)], partials=len(group))
+                for group in groups]
+            partials = [future.result() for future in futures]
+
+    final_contents = [REDUCE_PROMPT.format(prompt=prompt), *extra_parts,
+                      format_partials(partials)]
+    if stream:
+        return model.generate_stream(final_contents)
+    return traced_generate(model, "gemini.reduce", final_contents, partials=len(partials), final=True)
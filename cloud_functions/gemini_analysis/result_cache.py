@@ -0,0 +1,173 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import clients
+
+
+# 生成結果のキャッシュキーを作成する関数
+def cache_key(model_name, generation_config, prompt, inputs):
+    """モデル、生成設定、プロンプト、入力ファイルのURIと世代からキーを作成する
+
+    inputs は (gs:// のURI, オブジェクトの世代) のリスト。ファイルが更新されると世代が変わるためキーも変わる
+    """
+    payload = json.dumps({
+        "model": model_name,
+        "generation_config": generation_config,
+        "prompt": prompt,
+        "inputs": [[uri, str(generation)] for uri, generation in inputs],
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# ローカルディスクに保存するバックエンド
+class LocalDiskBackend:
+    """<directory>/<key>.json に保存し、件数が上限を超えたら最も長く参照されていないものから削除する"""
+
+    def __init__(self, directory, max_entries=256):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def read(self, key):
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # 更新日時を参照日時として使う (LRU)
+        os.utime(self._path(key))
+        return entry
+
+    def write(self, key, entry):
+        # 書き込み途中のファイルを読まないよう一時ファイルから置き換える
+        temporary_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(temporary_path, self._path(key))
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    path = os.path.join(self.directory, name)
+                    try:
+                        entries.append((os.path.getmtime(path), path))
+                    except FileNotFoundError:
+                        continue
+            entries.sort()
+            for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+# Cloud Storageに保存するバックエンド
+class GcsBackend:
+    """gs://<bucket>/<prefix>/<key>.json に保存し、インスタンス間でキャッシュを共有する
+
+    件数による削除は行わないため、古いオブジェクトはバケットのライフサイクルルールで削除する
+    """
+
+    def __init__(self, bucket_name, prefix="gemini_result_cache", client=None):
+        self.bucket = (client or clients.storage_client()).bucket(bucket_name)
+        self.prefix = prefix.strip("/")
+
+    def _name(self, key):
+        return f"{self.prefix}/{key}.json"
+
+    def read(self, key):
+        from google.api_core import exceptions as gcs_exceptions
+
+        try:
+            return json.loads(self.bucket.blob(self._name(key)).download_as_bytes())
+        except gcs_exceptions.NotFound:
+            return None
+
+    def write(self, key, entry):
+        self.bucket.blob(self._name(key)).upload_from_string(
+            json.dumps(entry, ensure_ascii=False), content_type="application/json")
+
+    def delete(self, key):
+        from google.api_core import exceptions as gcs_exceptions
+
+        try:
+            self.bucket.blob(self._name(key)).delete()
+        except gcs_exceptions.NotFound:
+            pass
+
+
+# 生成結果のキャッシュ
+class ResultCache:
+    """有効期間 (TTL) を過ぎた結果は返さずに削除する。キャッシュの読み書きに失敗しても処理は続行する"""
+
+    def __init__(self, backend, ttl_seconds=86400):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "errors": 0}
+
+    def get(self, key):
+        try:
+            entry = self.backend.read(key)
+        except Exception as e:
+            logging.warning(f"Failed to read result cache {key}: {e}")
+            self.counters["errors"] += 1
+            return None
+        # 途中までしか書かれていないエントリや、他の形式のエントリは無いものとして扱う
+        if not isinstance(entry, dict) or entry.get("value") is None:
+            self.counters["misses"] += 1
+            return None
+        if time.time() - entry.get("created_at", 0) > self.ttl_seconds:
+            self.counters["expired"] += 1
+            try:
+                self.backend.delete(key)
+            except Exception as e:
+                # 削除に失敗しても期限切れとして扱い、次回の書き込みで上書きする
+                logging.warning(f"Failed to delete expired result cache {key}: {e}")
+                self.counters["errors"] += 1
+            return None
+        self.counters["hits"] += 1
+        return entry.get("value")
+
+    def put(self, key, value):
+        try:
+            self.backend.write(key, {"created_at": time.time(), "value": value})
+        except Exception as e:
+            logging.warning(f"Failed to write result cache {key}: {e}")
+            self.counters["errors"] += 1
+
+
+# 環境変数の設定からキャッシュを作成する関数 (無効の場合はNoneを返す)
+def create_result_cache():
+    backend_name = os.getenv("RESULT_CACHE_BACKEND", "local")
+    ttl_seconds = float(os.getenv("RESULT_CACHE_TTL_SECONDS", 86400))
+    if backend_name == "none":
+        return None
+    if backend_name == "gcs":
+        bucket_name = os.getenv("RESULT_CACHE_BUCKET")
+        if not bucket_name:
+            logging.warning(
+                "RESULT_CACHE_BUCKET is not set, result cache is disabled")
+            return None
+        backend = GcsBackend(bucket_name, os.getenv(
+            "RESULT_CACHE_PREFIX", "gemini_result_cache"))
+    else:
+        backend = LocalDiskBackend(os.getenv("RESULT_CACHE_DIR", "/tmp/gemini_result_cache"),
+                                   int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 256)))
+    return ResultCache(backend, ttl_seconds)
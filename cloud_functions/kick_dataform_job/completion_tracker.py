@@ -0,0 +1,169 @@
+import json
+import logging
+import random
+import re
+import time
+
+# ポーリングの結果
+SUCCEEDED = "SUCCEEDED"
+FAILED = "FAILED"
+CANCELLED = "CANCELLED"
+TIMED_OUT = "TIMED_OUT"
+RESCHEDULED = "RESCHEDULED"
+
+# 完了とみなすDataformのワークフローの状態
+TERMINAL_STATES = {"SUCCEEDED": SUCCEEDED,
+                   "FAILED": FAILED, "CANCELLED": CANCELLED}
+
+
+# 指数バックオフとジッターで次のポーリングまでの秒数を計算する関数
+def next_delay(attempt, initial_delay=5, max_delay=60, multiplier=2.0, rng=random.random):
+    """attempt 回目の待ち時間の半分を固定、残りの半分をランダムにする (同時にキックしたジョブのポーリングを分散させる)"""
+    delay = min(max_delay, initial_delay * multiplier ** attempt)
+    return delay / 2 + delay / 2 * rng()
+
+
+# Dataformの状態を名前で返す (ライブラリの列挙型と代替実装の文字列の両方に対応する)
+def state_name(state):
+    return getattr(state, "name", state)
+
+
+def timestamp_seconds(value):
+    return value.timestamp() if value is not None and hasattr(value, "timestamp") else None
+
+
+# ポーリングのタスクを作成するクラス
+class TaskScheduler:
+    """タスク名をワークフローと試行回数から決めるため、同じポーリングのタスクを重複して作成しない"""
+
+    def __init__(self, tasks_client, project, location, queue, task_url, clock=time.time):
+        self.tasks_client = tasks_client
+        self.queue_path = tasks_client.queue_path(project, location, queue)
+        self.task_url = task_url
+        self.clock = clock
+
+    def task_name(self, payload):
+        invocation_id = payload["workflow_invocation_name"].rsplit("/", 1)[-1]
+        task_id = re.sub(r"[^A-Za-z0-9_-]", "-",
+                         f"poll-{invocation_id}-{payload.get('attempt', 0)}")
+        return f"{self.queue_path}/tasks/{task_id}"
+
+    def schedule(self, payload, delay_seconds):
+        from google.api_core import exceptions as api_exceptions
+        from google.cloud import tasks_v2
+        from google.protobuf import timestamp_pb2
+
+        scheduled_time = timestamp_pb2.Timestamp()
+        scheduled_time.FromSeconds(int(self.clock() + delay_seconds))
+        task = {
+            "name": self.task_name(payload),
+            "http_request": {
+                "http_method": tasks_v2.HttpMethod.POST,
+                "url": self.task_url,
+                "headers": {"Content-Type": "application/json"},
+                "body": json.dumps(payload).encode()
+            },
+            "schedule_time": scheduled_time,
+        }
+        try:
+            self.tasks_client.create_task(parent=self.queue_path, task=task)
+        except api_exceptions.AlreadyExists:
+            # 前回の呼び出しがタスクの作成後に失敗して再試行された場合
+            logging.info(f"Poll task already exists: {task['name']}")
+            return
+        logging.info(
+            f"Poll task scheduled in {delay_seconds:.1f}s: {task['name']}")
+
+
+# Dataformジョブの完了を追跡するクラス
+class CompletionTracker:
+    """ワークフローの状態を確認し、完了していなければバックオフして次のポーリングを予約する
+
+    payload は kick_dataform_job が作成したタスクの本文で、試行回数 (attempt)、
+    キックした時刻 (kicked_at)、期限 (deadline_at) を引き継ぐ
+    """
+
+    def __init__(self, dataform_client, scheduler, clock=time.time, rng=random.random,
+                 initial_delay=5, max_delay=60, multiplier=2.0, deadline_seconds=3600):
+        self.dataform_client = dataform_client
+        self.scheduler = scheduler
+        self.clock = clock
+        self.rng = rng
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.deadline_seconds = deadline_seconds
+
+    # キック時に最初のポーリングのタスクを作成する
+    def start(self, payload):
+        now = self.clock()
+        payload = dict(payload, attempt=0, kicked_at=now,
+                       deadline_at=now + self.deadline_seconds)
+        self.scheduler.schedule(payload, next_delay(
+            0, self.initial_delay, self.max_delay, self.multiplier, self.rng))
+        return payload
+
+    # 1回分のポーリングを行い、結果と詳細を返す
+    def poll(self, payload):
+        name = payload["workflow_invocation_name"]
+        invocation = self.dataform_client.get_workflow_invocation(name=name)
+        state = state_name(invocation.state)
+        now = self.clock()
+        attempt = int(payload.get("attempt", 0))
+        logging.info(f"Workflow {name} is {state} (attempt {attempt})")
+
+        if state in TERMINAL_STATES:
+            outcome = TERMINAL_STATES[state]
+            details = {"state": state}
+            if outcome == FAILED:
+                details["failure_reasons"] = self.failure_reasons(name)
+        # 以前のタスクには期限が無いため、その場合は今回から期限を設定する
+        elif now >= float(payload.get("deadline_at") or now + self.deadline_seconds):
+            outcome = TIMED_OUT
+            details = {"state": state}
+            self.cancel(name)
+        else:
+            delay = next_delay(attempt + 1, self.initial_delay,
+                               self.max_delay, self.multiplier, self.rng)
+            self.scheduler.schedule(dict(payload, attempt=attempt + 1,
+                                         deadline_at=payload.get("deadline_at") or now + self.deadline_seconds),
+                                    delay)
+            return RESCHEDULED, {"state": state, "next_poll_seconds": round(delay, 1)}
+
+        details["metrics"] = self.latency_metrics(payload, invocation, outcome, attempt, now)
+        logging.info(f"Dataform job latency metrics: {json.dumps(details['metrics'])}")
+        return outcome, details
+
+    # 失敗したアクションの理由を返す
+    def failure_reasons(self, name):
+        try:
+            actions = self.dataform_client.query_workflow_invocation_actions(
+                request={"name": name})
+            return [f"{getattr(action.target, 'name', '')}: {action.failure_reason}"
+                    for action in actions if state_name(action.state) == "FAILED"]
+        except Exception as e:
+            logging.error(f"Failed to query workflow invocation actions: {e}")
+            return []
+
+    def cancel(self, name):
+        try:
+            self.dataform_client.cancel_workflow_invocation(
+                request={"name": name})
+            logging.warning(f"Workflow {name} cancelled after the polling deadline")
+        except Exception as e:
+            logging.error(f"Failed to cancel workflow {name}: {e}")
+
+    # キックから完了の検知までの時間と、その内訳 (Dataformの実行時間、完了から検知までの遅れ)
+    def latency_metrics(self, payload, invocation, outcome, attempt, now):
+        kicked_at = payload.get("kicked_at")
+        timing = getattr(invocation, "invocation_timing", None)
+        started_at = timestamp_seconds(getattr(timing, "start_time", None))
+        ended_at = timestamp_seconds(getattr(timing, "end_time", None))
+        return {
+            "job_id": payload.get("job_id"),
+            "outcome": outcome,
+            "polls": attempt + 1,
+            "end_to_end_seconds": round(now - float(kicked_at), 1) if kicked_at else None,
+            "dataform_seconds": round(ended_at - started_at, 1) if started_at and ended_at else None,
+            "detection_delay_seconds": round(now - ended_at, 1) if ended_at else None,
+        }
@@ -1,59 +1,64 @@
 # -*- coding: utf-8 -*-
-from google.cloud import dataform_v1beta1, tasks_v2, secretmanager
 from flask import jsonify
 import functions_framework
 import os
-from google.protobuf import timestamp_pb2
+import csv
+import gzip
+import io
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import requests
-import google.cloud.logging
 import logging
-
-# Cloud Loggingクライアントの初期化とロギングの設定
-logging_client = google.cloud.logging.Client()
-logging_client.setup_logging()
+import clients
+import secret_cache
+import completion_tracker
+import tracing
 
 # シークレットマネージャーからAPIキーを取得する関数
+# 取得した値は SECRET_CACHE_TTL_SECONDS の間プロセス内にキャッシュする
 
 
 def get_secret(secret_name):
-    try:
-        client = secretmanager.SecretManagerServiceClient()
-        project_id = os.getenv('GCP_PROJECT_ID')
-        secret_path = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
-
-        # シークレットの値を取得
-        response = client.access_secret_version(name=secret_path)
-        logging.info(f"Secret fetched for {secret_name}.")
-        return response.payload.data.decode('UTF-8')
-    except Exception as e:
-        logging.error(f"Failed to retrieve secret: {e}")
-        raise
+    project_id = os.getenv('GCP_PROJECT_ID')
+    secret_path = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
+
+    def load():
+        try:
+            client = clients.secret_manager_client()
+
+            # シークレットの値を取得
+            response = client.access_secret_version(name=secret_path)
+            logging.info(f"Secret fetched for {secret_name}.")
+            return response.payload.data.decode('UTF-8')
+        except Exception as e:
+            logging.error(f"Failed to retrieve secret: {e}")
+            raise
+
+    return secret_cache.cache.get(secret_path, load)
+
+# 認証エラーになったシークレットをキャッシュから破棄する関数
+
+
+def invalidate_secret(secret_name, stale_value):
+    project_id = os.getenv('GCP_PROJECT_ID')
+    secret_path = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
+    return secret_cache.cache.invalidate(secret_path, stale_value)
 
 # AppSheetの特定の行を更新する関数 (job_idをPKとして使用)
 
 
-def update_appsheet_job_data(job_id, export_path, message):
+def update_appsheet_job_data(job_id, export_path, message, status="成功"):
     try:
         # 環境変数からAPP_IDを取得
         app_id = os.getenv('APP_ID')
         logging.info(
-            f"Updating AppSheet job data for job_id: {job_id}, export_path: {export_path}, message: {message}")
-
-        # シークレットマネージャーからAPPSHEET_API_KEYを取得
-        api_key = get_secret('appsheet-api-key')
+            f"Updating AppSheet job data for job_id: {job_id}, export_path: {export_path}, message: {message}, status: {status}")
 
         url = f'https://api.appsheet.com/api/v2/apps/{app_id}/tables/job/records'
         logging.info(f"AppSheet API URL: {url}")
 
-        headers = {
-            'ApplicationAccessKey': api_key,
-            'Content-Type': 'application/json',
-        }
-        logging.info(f"Headers: {headers}")
-
         # export_pathとmessageを一度に更新
         payload = {
             "Action": "Edit",
@@ -67,7 +72,7 @@ def update_appsheet_job_data(job_id, export_path, message):
                     "job_id": job_id,  # 更新したいレコードのjob_id (PK)
                     "export_path": export_path,  # Dataformのexport_pathをセット
                     "message": message,  # 更新するmessageカラム
-                    "status": "成功"  # 更新するstatusカラム
+                    "status": status  # 更新するstatusカラム
                 }
             ]
         }
@@ -75,7 +80,20 @@ def update_appsheet_job_data(job_id, export_path, message):
         logging.info(f"Payload: {json.dumps(payload, indent=2)}")
 
         # AppSheet APIを呼び出してデータを更新
-        response = requests.post(url, headers=headers, json=payload)
+        # 認証エラーの場合はAPIキーが更新された可能性があるため、取得し直して1度だけ再試行する
+        for attempt in range(2):
+            # シークレットマネージャーからAPPSHEET_API_KEYを取得
+            api_key = get_secret('appsheet-api-key')
+            headers = {
+                'ApplicationAccessKey': api_key,
+                'Content-Type': 'application/json',
+            }
+            response = requests.post(url, headers=headers, json=payload)
+            if response.status_code not in (401, 403) or attempt == 1:
+                break
+            logging.warning(
+                f"AppSheet API returned {response.status_code}, refreshing API key")
+            invalidate_secret('appsheet-api-key', api_key)
 
         if response.status_code == 200:
             logging.info(
@@ -84,16 +102,86 @@ def update_appsheet_job_data(job_id, export_path, message):
             logging.error(
                 f"Failed to update row with job_id {job_id}. Status code: {response.status_code}")
             logging.error(response.text)
+        logging.info(f"Secret cache metrics: {secret_cache.cache.stats()}")
     except Exception as e:
         logging.error(f"Failed to update AppSheet: {e}")
         raise
 
+# エクスポートされたCSVファイルの行数 (ヘッダーを除く) を数える関数
+# GZIP圧縮されたファイルはストリームで展開しながら数え、全体をメモリに読み込まない
+
+
+def count_csv_rows(blob):
+    with blob.open("rb") as f:
+        stream = gzip.GzipFile(fileobj=f) if blob.name.endswith(".gz") else f
+        reader = csv.reader(io.TextIOWrapper(stream, encoding="utf-8", newline=""))
+        return max(0, sum(1 for _ in reader) - 1)
+
+# エクスポートされたCSVファイルの一覧をマニフェストとして書き込む関数
+# gemini_analysis は一覧取得の代わりにこのファイルを読み込む
+
+
+def write_export_manifest(bucket_name, export_path):
+    try:
+        bucket = clients.storage_client().bucket(bucket_name)
+        blobs = list(bucket.list_blobs(prefix=f"{export_path}/", match_glob="**.{csv,csv.gz}",
+                                       fields="items(name,generation,size),nextPageToken"))
+        with ThreadPoolExecutor(max_workers=int(os.getenv('MANIFEST_ROW_COUNT_CONCURRENCY', 8))) as executor:
+            row_counts = list(executor.map(count_csv_rows, blobs))
+        files = [{"name": blob.name, "generation": blob.generation, "size": blob.size, "rows": rows}
+                 for blob, rows in zip(blobs, row_counts)]
+        manifest = {
+            "export_path": export_path,
+            "created_at": datetime.now().isoformat(),
+            "format": "CSV",
+            "compression": "GZIP" if any(blob.name.endswith(".gz") for blob in blobs) else "NONE",
+            "total_rows": sum(row_counts),
+            "total_bytes": sum(blob.size or 0 for blob in blobs),
+            "files": files,
+        }
+        bucket.blob(f"{export_path}/_manifest.json").upload_from_string(
+            json.dumps(manifest), content_type="application/json")
+        logging.info(
+            f"Export manifest written for {export_path}: {len(files)} files, "
+            f"{manifest['total_rows']} rows, {manifest['total_bytes']} bytes")
+    except Exception as e:
+        # マニフェストが無い場合は gemini_analysis が一覧を取得するため、処理は続行する
+        logging.error(f"Failed to write export manifest: {e}")
+
+# Dataformジョブの完了を追跡するオブジェクトを作成する関数
+# task_url はポーリングのタスクの呼び出し先 (poll_dataform_job のURL)
+
+
+def create_completion_tracker(task_url):
+    scheduler = completion_tracker.TaskScheduler(
+        clients.tasks_client(), os.getenv('GCP_PROJECT_ID'), os.getenv('REGION'),
+        os.getenv('DATAFORM_POLL_QUEUE', 'dataform-completion-checker'), task_url)
+    return completion_tracker.CompletionTracker(
+        clients.dataform_client(), scheduler,
+        initial_delay=float(os.getenv('POLL_INITIAL_DELAY_SECONDS', 5)),
+        max_delay=float(os.getenv('POLL_MAX_DELAY_SECONDS', 60)),
+        deadline_seconds=float(os.getenv('POLL_DEADLINE_SECONDS', 3600)))
+
 # Dataformジョブをキックするエンドポイント
 
 
 @functions_framework.http
 def kick_dataform_job(request):
+    # 処理全体をトレースのスパンとして記録する (同じjob_idのSlackの取り込みと同じトレースになる)
+    with tracing.start_request("kick_dataform_job", request.get_json(silent=True)) as root:
+        body, status_code = start_dataform_job(request)
+        root.set_attribute("http.status_code", status_code)
+        return body, status_code
+
+# Dataformのコンパイルとワークフローの実行を開始する関数
+
+
+def start_dataform_job(request):
+    # Cloud Loggingの設定は最初のリクエストで1度だけ行う
+    clients.setup_logging()
     try:
+        from google.cloud import dataform_v1beta1
+
         logging.info("Received request")
 
         # リクエストからparentとworkspace、job_idの値を取得
@@ -118,14 +206,16 @@ def kick_dataform_job(request):
 
         logging.info(f"Generated export path: {export_path}")
 
-        # Dataformクライアントの作成
-        client = dataform_v1beta1.DataformClient()
+        # Dataformクライアントの取得
+        client = clients.dataform_client()
 
         # コンパイル変数としてjob_idとexport_pathを渡す
         code_compilation_config = dataform_v1beta1.CodeCompilationConfig(
             vars={
                 "job_id": job_id,  # リクエストから受け取ったjob_id（デフォルトは"ALL"）
-                "export_path": export_path  # 動的に生成されたexport_pathを設定
+                "export_path": export_path,  # 動的に生成されたexport_pathを設定
+                # エクスポートの圧縮形式 (GZIP または NONE)
+                "export_compression": os.getenv('EXPORT_COMPRESSION', 'GZIP')
             }
         )
 
@@ -139,8 +229,9 @@ def kick_dataform_job(request):
         )
 
         # CompilationResults.createリクエストを送信し、コンパイル結果を作成
-        compilation_result_response = client.create_compilation_result(
-            request=create_compilation_request)
+        with tracing.span("dataform.compile"):
+            compilation_result_response = client.create_compilation_result(
+                request=create_compilation_request)
         compilation_result_id = compilation_result_response.name
         logging.info(f"Compilation result ID: {compilation_result_id}")
 
@@ -156,45 +247,25 @@ def kick_dataform_job(request):
         )
 
         # Dataformジョブをキック
-        response = client.create_workflow_invocation(
-            request=create_workflow_request)
+        with tracing.span("dataform.invoke") as invoke_span:
+            response = client.create_workflow_invocation(
+                request=create_workflow_request)
+            invoke_span.set_attribute("workflow_invocation_name", response.name)
         workflow_invocation_name = response.name
         logging.info(f"Workflow invocation name: {workflow_invocation_name}")
 
-        # Cloud Tasksクライアントの作成
-        tasks_client = tasks_v2.CloudTasksClient()
-        project = os.getenv('GCP_PROJECT_ID')  # プロジェクトIDを環境変数から取得
-        location = os.getenv('REGION')  # リージョンを環境変数から取得
-        queue = "dataform-completion-checker"  # Cloud Tasksのキュー名
+        # 完了を確認するタスクを作成 (完了するまでバックオフしながら poll_dataform_job が予約し直す)
         task_url = os.getenv('POLL_FUNCTION_URL')  # poll_dataform_jobのURL
-
-        logging.info(
-            f"Task details - Project: {project}, Location: {location}, Queue: {queue}, Task URL: {task_url}")
-
-        # タスクの作成
-        parent_path = tasks_client.queue_path(project, location, queue)
-        task = {
-            "http_request": {
-                "http_method": tasks_v2.HttpMethod.POST,
-                "url": task_url,  # poll_dataform_jobエンドポイント
-                "headers": {"Content-Type": "application/json"},
-                "body": json.dumps({
-                    "parent": parent,
-                    "workflow_invocation_name": workflow_invocation_name,
-                    "job_id": job_id,  # AppSheetのjob_idを指定
-                    "export_path": export_path
-                }).encode()
-            }
-        }
-
-        # 30秒後に実行するタスクをスケジュール
-        scheduled_time = timestamp_pb2.Timestamp()
-        scheduled_time.FromSeconds(int(time.time() + 30))
-        task['schedule_time'] = scheduled_time
-
-        # タスクをキューに追加
-        tasks_client.create_task(parent=parent_path, task=task)
-        logging.info(f"Task created successfully with name: {task_url}")
+        logging.info(f"Task URL: {task_url}")
+        # ポーリングのスパンをこの関数のスパンの子にするため traceparent を引き継ぐ
+        payload = tracing.inject({
+            "parent": parent,
+            "workflow_invocation_name": workflow_invocation_name,
+            "job_id": job_id,  # AppSheetのjob_idを指定
+            "export_path": export_path
+        })
+        with tracing.span("tasks.enqueue"):
+            create_completion_tracker(task_url).start(payload)
 
         # レスポンスを返す
         return jsonify({'message': 'Dataform job kicked successfully, polling scheduled', 'workflow_invocation_name': workflow_invocation_name}), 200
@@ -208,6 +279,22 @@ def kick_dataform_job(request):
 
 @functions_framework.http
 def poll_dataform_job(request):
+    # キック時のスパンの子として記録する (タスクの本文の traceparent を親にする)
+    request_json = request.get_json(silent=True)
+    # JSONがオブジェクトでない場合の検証は check_dataform_job に任せる
+    request_json = request_json if isinstance(request_json, dict) else {}
+    with tracing.start_request("poll_dataform_job", request_json,
+                               attempt=int(request_json.get('attempt', 0))) as root:
+        body, status_code = check_dataform_job(request)
+        root.set_attribute("http.status_code", status_code)
+        return body, status_code
+
+# Dataformジョブの状態を確認し、完了していれば結果をAppSheetに書き込む関数
+
+
+def check_dataform_job(request):
+    # Cloud Loggingの設定は最初のリクエストで1度だけ行う
+    clients.setup_logging()
     try:
         logging.info("Polling Dataform job")
 
@@ -225,30 +312,51 @@ def poll_dataform_job(request):
             logging.error("Missing required parameters in poll_dataform_job")
             return jsonify({'error': 'Missing required parameters: parent, workflow_invocation_name, job_id, or export_path'}), 400
 
-        # Dataformクライアントの作成
-        client = dataform_v1beta1.DataformClient()
-
-        # ワークフローのステータスを取得
-        response = client.get_workflow_invocation(
-            name=workflow_invocation_name)
-
-        # ステータスのチェック
-        logging.info(f"Current job status: {response.state}")
-
-        if response.state == dataform_v1beta1.WorkflowInvocation.State.SUCCEEDED:
+        # ワークフローのステータスを確認し、完了していなければ次のポーリングを予約する
+        # 次のタスクはこの関数自身を呼び出す
+        task_url = os.getenv('POLL_FUNCTION_URL') or f"https://{request.host}{request.path}"
+        with tracing.span("dataform.poll") as poll_span:
+            outcome, details = create_completion_tracker(
+                task_url).poll(request_data)
+            poll_span.set_attribute("outcome", outcome)
+
+        # 完了した場合は、キックしてから完了を検知するまでの待ち時間をキック時のスパンの子として記録する
+        if outcome != completion_tracker.RESCHEDULED and request_data.get('kicked_at'):
+            tracing.record_span(
+                "dataform.invocation_wait", float(request_data['kicked_at']), time.time(),
+                parent=tracing.parse_traceparent(request_data.get(tracing.TRACEPARENT_KEY)),
+                outcome=outcome, polls=int(request_data.get('attempt', 0)) + 1)
+
+        if outcome == completion_tracker.SUCCEEDED:
             message = 'ジョブが正常に完了しました'
-            update_appsheet_job_data(job_id, export_path, message)
+            export_bucket_name = os.getenv('EXPORT_BUCKET_NAME')
+            if export_bucket_name:
+                with tracing.span("export.manifest"):
+                    write_export_manifest(export_bucket_name, export_path)
+            with tracing.span("appsheet.update"):
+                update_appsheet_job_data(job_id, export_path, message)
             logging.info(
                 f"Dataform job completed successfully for workflow_invocation_name: {workflow_invocation_name}")
-            return jsonify({'status': 'COMPLETED', 'workflow_invocation_name': workflow_invocation_name}), 200
-        elif response.state == dataform_v1beta1.WorkflowInvocation.State.FAILED:
-            logging.error(
-                f"Dataform job failed for workflow_invocation_name: {workflow_invocation_name}")
-            return jsonify({'status': 'FAILED', 'workflow_invocation_name': workflow_invocation_name}), 200
-        else:
+            return jsonify({'status': 'COMPLETED', 'workflow_invocation_name': workflow_invocation_name, **details}), 200
+        elif outcome == completion_tracker.RESCHEDULED:
             logging.info(
                 f"Dataform job is still pending for workflow_invocation_name: {workflow_invocation_name}")
-            return jsonify({'status': 'PENDING', 'workflow_invocation_name': workflow_invocation_name}), 200
+            return jsonify({'status': 'PENDING', 'workflow_invocation_name': workflow_invocation_name, **details}), 200
+        else:
+            # 失敗・キャンセル・期限切れの場合はエラーとしてAppSheetに書き込む
+            messages = {
+                completion_tracker.FAILED: 'ジョブが失敗しました',
+                completion_tracker.CANCELLED: 'ジョブがキャンセルされました',
+                completion_tracker.TIMED_OUT: 'ジョブが期限内に完了しませんでした',
+            }
+            message = messages[outcome]
+            if details.get('failure_reasons'):
+                message += ': ' + '; '.join(details['failure_reasons'])
+            with tracing.span("appsheet.update"):
+                update_appsheet_job_data(job_id, export_path, message, status='エラー')
+            logging.error(
+                f"Dataform job {outcome} for workflow_invocation_name: {workflow_invocation_name}")
+            return jsonify({'status': outcome, 'workflow_invocation_name': workflow_invocation_name, **details}), 200
 
     except Exception as e:
         logging.error(f"Error in poll_dataform_job: {e}")
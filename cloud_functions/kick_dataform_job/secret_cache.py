@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+
+# キャッシュの有効期間の既定値 (秒)
+DEFAULT_TTL_SECONDS = 600
+
+
+# シークレットの値をプロセス内でキャッシュするクラス
+class SecretCache:
+    """有効期間内は同じ値を返し、同時に取得された場合はSecret Managerへの問い合わせを1回にまとめる"""
+
+    def __init__(self, ttl_seconds=DEFAULT_TTL_SECONDS, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.entries = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0,
+                         "waits": 0, "invalidations": 0}
+
+    def get(self, key, loader):
+        """キャッシュから値を返す。無い場合や期限切れの場合は loader() で取得する"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > self.clock():
+                self.counters["hits"] += 1
+                return entry[0]
+            flight = self.in_flight.get(key)
+            if flight is None:
+                flight = {"event": threading.Event(),
+                          "value": None, "error": None}
+                self.in_flight[key] = flight
+                self.counters["misses"] += 1
+                leader = True
+            else:
+                self.counters["waits"] += 1
+                leader = False
+
+        if not leader:
+            # 他のスレッドの取得結果を待つ
+            flight["event"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["value"]
+
+        try:
+            value = loader()
+            flight["value"] = value
+            with self.lock:
+                self.entries[key] = (value, self.clock() + self.ttl_seconds)
+            return value
+        except Exception as e:
+            # 取得に失敗した場合はキャッシュせず、待っていたスレッドにも同じ例外を返す
+            flight["error"] = e
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            flight["event"].set()
+
+    def invalidate(self, key, value=None):
+        """キャッシュを破棄する。value を指定した場合はキャッシュ中の値と一致するときだけ破棄する"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (value is not None and entry[0] != value):
+                return False
+            del self.entries[key]
+            self.counters["invalidations"] += 1
+            return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, size=len(self.entries))
+
+
+# プロセス内で共有するキャッシュ
+cache = SecretCache(
+    float(os.getenv("SECRET_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)))
@@ -0,0 +1,92 @@
+import threading
+
+# プロセス内で共有するクライアント (名前 -> クライアント)
+# Cloud Functions のインスタンスが生きている間は同じクライアントを使い回す
+_clients = {}
+_lock = threading.Lock()
+
+
+# クライアントを初回の呼び出し時に1度だけ作成して返す関数
+def get_client(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+    return client
+
+
+# 作成済みのクライアントを破棄する関数 (ローカル検証用)
+def reset_clients():
+    with _lock:
+        _clients.clear()
+
+
+# Cloud Loggingの初期化とロギングの設定を1度だけ行う関数
+def setup_logging():
+    def factory():
+        import google.cloud.logging
+
+        logging_client = google.cloud.logging.Client()
+        logging_client.setup_logging()
+        return logging_client
+
+    return get_client("logging", factory)
+
+
+def storage_client():
+    def factory():
+        from google.cloud import storage
+
+        return storage.Client()
+
+    return get_client("storage", factory)
+
+
+def bigquery_client():
+    def factory():
+        from google.cloud import bigquery
+
+        return bigquery.Client()
+
+    return get_client("bigquery", factory)
+
+
+def secret_manager_client():
+    def factory():
+        from google.cloud import secretmanager
+
+        return secretmanager.SecretManagerServiceClient()
+
+    return get_client("secretmanager", factory)
+
+
+def dataform_client():
+    def factory():
+        from google.cloud import dataform_v1beta1
+
+        return dataform_v1beta1.DataformClient()
+
+    return get_client("dataform", factory)
+
+
+def tasks_client():
+    def factory():
+        from google.cloud import tasks_v2
+
+        return tasks_v2.CloudTasksClient()
+
+    return get_client("tasks", factory)
+
+
+# Vertex AIの初期化を1度だけ行う関数
+def init_vertexai(project_id, location):
+    def factory():
+        import vertexai
+
+        vertexai.init(project=project_id, location=location)
+        return (project_id, location)
+
+    return get_client(f"vertexai:{project_id}:{location}", factory)
@@ -1,36 +1,244 @@
 import functions_framework
 import requests
-import pandas as pd
-from google.cloud import bigquery
-from google.cloud import secretmanager
 from datetime import datetime, timedelta, timezone
 import os
 import logging
-import google.cloud.logging
 import json
-
-# Cloud Loggingクライアントの初期化とロギングの設定
-logging_client = google.cloud.logging.Client()
-logging_client.setup_logging()
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from slack_client import SlackApiError, SlackClient
+from sync_state import GcsSyncStateStore
+from message_writer import MessageBatcher, MessageWriteError, create_message_writer
+import clients
+import secret_cache
+import tracing
 
 # シークレットマネージャーからシークレットを取得する関数
+# 取得した値は SECRET_CACHE_TTL_SECONDS の間プロセス内にキャッシュする
 
 
 def get_secret(secret_name, project_id):
+    secret_path = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
+
+    def load():
+        try:
+            client = clients.secret_manager_client()
+            response = client.access_secret_version(
+                request={"name": secret_path})
+            return response.payload.data.decode("UTF-8")
+        except Exception as e:
+            logging.error(f"Failed to retrieve secret: {e}")
+            raise
+
+    return secret_cache.cache.get(secret_path, load)
+
+# 認証エラーになったシークレットをキャッシュから破棄し、取得し直す関数
+
+
+def refresh_secret(secret_name, project_id, stale_value):
+    secret_path = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
+    # 他のスレッドが取得し直した新しい値は破棄しない
+    secret_cache.cache.invalidate(secret_path, stale_value)
+    return get_secret(secret_name, project_id)
+
+# スレッドの返信メッセージを取得する関数
+
+
+def fetch_thread_messages(slack_client, channel_id, thread_ts, oldest=None):
+    thread_params = {"channel": channel_id, "ts": thread_ts}
+    if oldest:
+        thread_params["oldest"] = oldest
     try:
-        client = secretmanager.SecretManagerServiceClient()
-        secret_path = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
-        response = client.access_secret_version(request={"name": secret_path})
-        return response.payload.data.decode("UTF-8")
-    except Exception as e:
-        logging.error(f"Failed to retrieve secret: {e}")
-        raise
+        thread_data = slack_client.call("conversations.replies", thread_params)
+    except requests.RequestException as e:
+        logging.error(f"Failed to fetch thread messages: {e}")
+        return []
+    except SlackApiError as e:
+        logging.error(f"Error from Slack API while fetching thread: {e}")
+        return []
+
+    return thread_data.get("messages", [])
+
+# クロール中の重複を排除するためのキャッシュ
+
+
+class CrawlDeduplicator:
+    """既出のメッセージ (channel, ts) と取得済みスレッドを記録し、省略した呼び出し数を数える"""
+
+    def __init__(self):
+        self.seen_messages = set()
+        self.fetched_threads = set()
+        self.deferred_threads = {}
+        self.counters = {
+            "duplicate_messages_skipped": 0,
+            "thread_fetches_skipped_duplicate": 0,
+            "thread_fetches_skipped_broadcast": 0,
+        }
+
+    def first_seen(self, channel_id, message):
+        key = (channel_id, message["ts"])
+        if key in self.seen_messages:
+            self.counters["duplicate_messages_skipped"] += 1
+            return False
+        self.seen_messages.add(key)
+        return True
+
+    def should_fetch_thread(self, channel_id, message):
+        key = (channel_id, message["thread_ts"])
+        if message["thread_ts"] != message["ts"]:
+            # チャネルにも投稿された返信は親メッセージ側でまとめて取得する
+            self.deferred_threads.setdefault(key, message)
+            return False
+        if key in self.fetched_threads:
+            self.counters["thread_fetches_skipped_duplicate"] += 1
+            return False
+        self.fetched_threads.add(key)
+        return True
+
+    def pop_deferred_threads(self, channel_id):
+        # 親メッセージが取得範囲外だったスレッドのみを返す
+        deferred = []
+        for key in [key for key in self.deferred_threads if key[0] == channel_id]:
+            message = self.deferred_threads.pop(key)
+            if key in self.fetched_threads:
+                self.counters["thread_fetches_skipped_broadcast"] += 1
+                continue
+            self.fetched_threads.add(key)
+            deferred.append(message)
+        return deferred
+
+# チャネルのメッセージとスレッド返信を返すジェネレーター
+# スレッド返信の取得はスレッドプールで並列に行い、履歴のページングと重ねて実行する
+# sync_stateが指定された場合は前回以降の新しいメッセージと返信のみを返す
+
+
+def iter_channel_messages(slack_client, channel_id, start_time, end_time, limit,
+                          executor, max_in_flight, sync_state=None, lookback_seconds=0,
+                          dedup=None):
+    if dedup is None:
+        dedup = CrawlDeduplicator()
+
+    # (メッセージ, スレッド返信のFuture, スレッドのts) を取得順に保持する
+    pending = deque()
+    in_flight = 0
+
+    def resolve_head():
+        nonlocal in_flight
+        message, future, thread_ts = pending.popleft()
+        if message is not None:
+            is_new = sync_state is None or sync_state.is_new_message(message)
+            if is_new and dedup.first_seen(channel_id, message):
+                yield message
+            if sync_state is not None:
+                sync_state.observe_message(message)
+        if future is not None:
+            in_flight -= 1
+            for thread_message in future.result():
+                is_new = sync_state is None or sync_state.is_new_reply(
+                    thread_message, thread_ts)
+                if is_new and dedup.first_seen(channel_id, thread_message):
+                    yield thread_message
+                if sync_state is not None and thread_message["ts"] != thread_ts:
+                    sync_state.observe_reply(thread_ts, thread_message["ts"])
+
+    def submit_thread(message):
+        nonlocal in_flight
+        thread_ts = message["thread_ts"]
+        replies_oldest = None
+        if sync_state is not None:
+            replies_oldest = sync_state.replies_oldest(thread_ts)
+        in_flight += 1
+        # スレッドプールで実行する取得も現在のスパンの子として記録する
+        return executor.submit(
+            tracing.bind(fetch_thread_messages), slack_client, channel_id, thread_ts, replies_oldest)
+
+    oldest = start_time
+    if sync_state is not None:
+        oldest = sync_state.history_oldest(start_time, lookback_seconds)
+
+    params = {
+        "channel": channel_id,
+        "oldest": oldest,
+        "latest": end_time,
+        "limit": limit,
+    }
+
+    for data in slack_client.paginate("conversations.history", params):
+        for message in data.get("messages", []):
+            future = None
+            if ("thread_ts" in message
+                    and (sync_state is None or sync_state.should_fetch_thread(message))
+                    and dedup.should_fetch_thread(channel_id, message)):
+                future = submit_thread(message)
+            pending.append((message, future, message.get("thread_ts")))
+
+            # 同時実行数の上限に達したら先頭から結果を確定させる
+            while in_flight > max_in_flight:
+                yield from resolve_head()
+
+        # 取得済みのものは次のページを取得する前に返しておく
+        while pending and (pending[0][1] is None or pending[0][1].done()):
+            yield from resolve_head()
+
+    # 親メッセージが見つからなかったスレッドを取得する
+    for message in dedup.pop_deferred_threads(channel_id):
+        pending.append((None, submit_thread(message), message["thread_ts"]))
+        while in_flight > max_in_flight:
+            yield from resolve_head()
+
+    while pending:
+        yield from resolve_head()
+
+# 対象ユーザーの指定をユーザーIDのリストに変換する関数
+# "ALL" が指定された場合は全メンバーを対象とする
+
+
+def parse_target_user_ids(request_json):
+    target_user_ids = request_json.get(
+        "target_user_ids", request_json.get("target_user_id"))
+    if isinstance(target_user_ids, str):
+        target_user_ids = target_user_ids.split(",")
+    return [user_id.strip() for user_id in target_user_ids or [] if user_id and user_id.strip()]
+
+# 差分取得の状態を保存するキーを決める関数
+
+
+def sync_state_key(target_user_ids):
+    if len(target_user_ids) == 1:
+        return target_user_ids[0]
+    digest = hashlib.sha1(",".join(sorted(target_user_ids)).encode()).hexdigest()[:16]
+    return f"users-{digest}"
+
+# 差分取得の状態を保存する関数
+
+
+def save_sync_states(state_store, sync_states, state_key, lookback_seconds):
+    if state_store is None:
+        return
+    for channel_id, sync_state in sync_states.items():
+        sync_state.prune(lookback_seconds)
+        state_store.save(channel_id, state_key, sync_state)
+        logging.info(
+            f"Saved sync state for channel_id: {channel_id}, latest_ts: {sync_state.next_latest_ts}")
 
 # Cloud Functions のエントリポイント
 
 
 @functions_framework.http
 def main(request):
+    # 処理全体をトレースのスパンとして記録する (job_idが同じ後続の処理と同じトレースになる)
+    with tracing.start_request("slack_messages_to_bigquery", request.get_json(silent=True)) as root:
+        body, status_code = sync_messages(request)
+        root.set_attribute("http.status_code", status_code)
+        return body, status_code
+
+# Slackのメッセージを取得してBigQueryに書き込む関数
+
+
+def sync_messages(request):
+    # Cloud Loggingの設定は最初のリクエストで1度だけ行う
+    clients.setup_logging()
     try:
         logging.info(request)
         logging.info("Request data: %s", request.data)
@@ -51,6 +259,13 @@ def main(request):
         dataset_id = os.getenv("BIGQUERY_DATASET_ID")
         table_id = os.getenv("BIGQUERY_TABLE_ID")
         slack_message_limit = int(os.getenv("SLACK_API_MESSAGE_LIMIT", 200))
+        thread_fetch_concurrency = int(
+            os.getenv("SLACK_THREAD_FETCH_CONCURRENCY", 8))
+        replies_rate_per_minute = int(
+            os.getenv("SLACK_REPLIES_RATE_PER_MINUTE", 50))
+        thread_lookback_seconds = int(
+            os.getenv("SLACK_THREAD_LOOKBACK_DAYS", 7)) * 86400
+        load_batch_size = int(os.getenv("BIGQUERY_LOAD_BATCH_SIZE", 20000))
 
         if not project_id or not secret_name or not dataset_id or not table_id:
             logging.error("Missing environment variables")
@@ -67,21 +282,36 @@ def main(request):
         channel_ids_str = request_json.get("channel_ids", "")
         channel_ids = [channel_id.strip()
                        for channel_id in channel_ids_str.split(",")]
-        target_user_id = request_json.get("target_user_id")
+        # 対象ユーザー (カンマ区切り・リスト・"ALL" のいずれか)
+        target_user_ids = parse_target_user_ids(request_json)
+        all_members = target_user_ids == ["ALL"]
         start_date_str = request_json.get("start_date")
         end_date_str = request_json.get("end_date")
         job_id = request_json.get("job_id")  # 新たに追加するjob_id
+        # ユーザーごとにjob_idを分ける場合は {user_id: job_id} で指定する
+        job_ids = request_json.get("job_ids") or {}
+        # 差分取得モード (前回取得以降のメッセージのみ取得)
+        incremental = bool(request_json.get("incremental", False))
 
         logging.info(f"channel_ids: {channel_ids}")
-        logging.info(f"target_user_id: {target_user_id}")
+        logging.info(f"target_user_ids: {target_user_ids}")
         logging.info(f"start_date_str: {start_date_str}")
         logging.info(f"end_date_str: {end_date_str}")
         logging.info(f"job_id: {job_id}")  # job_idのログ
+        logging.info(f"job_ids: {job_ids}")
+        logging.info(f"incremental: {incremental}")
 
-        if not slack_token or not channel_ids or not target_user_id or not start_date_str or not end_date_str or not job_id:
+        if not slack_token or not channel_ids or not target_user_ids or not start_date_str or not end_date_str:
             logging.error("Missing required parameters")
             return json.dumps({"status": "エラー", "export_path": None, "message": "必要なパラメータが不足しています"}), 400
 
+        # ユーザーIDからjob_idへの振り分け表 (集合の探索で1回のクロールで全ユーザーに振り分ける)
+        user_job_ids = {} if all_members else {
+            user_id: job_ids.get(user_id, job_id) for user_id in target_user_ids}
+        if (all_members and not job_id) or not all(user_job_ids.values()):
+            logging.error("Missing job_id for target users")
+            return json.dumps({"status": "エラー", "export_path": None, "message": "必要なパラメータが不足しています"}), 400
+
         def convert_to_unix_timestamp_jst(date_str):
             jst = timezone(timedelta(hours=9))
             date_obj = datetime.strptime(date_str, '%Y/%m/%d')
@@ -94,128 +324,95 @@ def main(request):
             logging.error(f"Invalid date format: {e}")
             return json.dumps({"status": "エラー", "export_path": None, "message": "無効な日付形式です"}), 400
 
-        history_url = "https://slack.com/api/conversations.history"
-        replies_url = "https://slack.com/api/conversations.replies"
-        headers = {"Authorization": f"Bearer {slack_token}"}
-
-        user_messages = []
-
-        for channel_id in channel_ids:
-
-            logging.info(f"channel_id: {channel_id}")
-
-            has_more = True
-            next_cursor = None
-
-            while has_more:
-                params = {
-                    "channel": channel_id,
-                    "oldest": start_time,
-                    "latest": end_time,
-                    "limit": slack_message_limit,
-                }
-                if next_cursor:
-                    params["cursor"] = next_cursor
-
-                try:
-                    response = requests.get(
-                        history_url, headers=headers, params=params)
-                    data = response.json()
-                except requests.RequestException as e:
-                    logging.error(f"Failed to fetch Slack data: {e}")
-                    return json.dumps({"status": "エラー", "export_path": None, "message": "Slackデータの取得に失敗しました"}), 500
-
-                if data.get("ok"):
-                    messages = data.get("messages", [])
-                    for message in messages:
-                        if message.get("user") == target_user_id:
-                            message['channel_id'] = channel_id
-                            user_messages.append(message)
-                        if "thread_ts" in message:
-                            thread_ts = message["thread_ts"]
-                            thread_params = {
-                                "channel": channel_id, "ts": thread_ts}
-                            try:
-                                thread_response = requests.get(
-                                    replies_url, headers=headers, params=thread_params)
-                                thread_data = thread_response.json()
-                            except requests.RequestException as e:
-                                logging.error(
-                                    f"Failed to fetch thread messages: {e}")
-                                continue
-
-                            if thread_data.get("ok"):
-                                thread_messages = thread_data.get(
-                                    "messages", [])
-                                for thread_message in thread_messages:
-                                    if thread_message.get("user") == target_user_id:
-                                        thread_message['channel_id'] = channel_id
-                                        user_messages.append(thread_message)
-
-                    has_more = data.get("has_more", False)
-                    next_cursor = data.get(
-                        "response_metadata", {}).get("next_cursor")
-                else:
-                    logging.error(f"Error from Slack API: {data.get('error')}")
-                    return json.dumps({"status": "エラー", "export_path": None, "message": f"Slack APIエラー: {data.get('error')}"}), 500
-
-        # メッセージが0件の場合は処理を中断して正常終了
-        if len(user_messages) == 0:
-            logging.info("No messages found for the given parameters")
-            return json.dumps({"status": "成功", "export_path": None, "message": "メッセージが見つかりませんでした"}), 200
-
-        sorted_messages = sorted(
-            user_messages, key=lambda msg: float(msg['ts']))
-        df = pd.DataFrame(sorted_messages)
-
-        logging.info("Initial dataframe columns: %s", df.columns)
-        logging.info("Initial dataframe sample: %s",
-                     df.head().to_dict(orient="records"))
-
-        def concatenate_reactions(reactions):
-            if isinstance(reactions, list):
-                return ', '.join([f"{reaction['name']}:{reaction['count']}" for reaction in reactions])
-            return ''
-
-        if 'reactions' in df.columns:
-            df['reactions_concatenated'] = df['reactions'].apply(
-                concatenate_reactions)
-        else:
-            logging.warning("'reactions' column not found in dataframe")
-            df['reactions_concatenated'] = ''
-
-        def convert_to_jst(timestamp):
-            utc_dt = datetime.fromtimestamp(float(timestamp), timezone.utc)
-            jst = timezone(timedelta(hours=9))
-            return utc_dt.astimezone(jst).strftime('%Y-%m-%d %H:%M:%S')
-
-        df['ts'] = df['ts'].apply(convert_to_jst)
-        df.rename(columns={'user': 'user_id'}, inplace=True)
-        df_cleaned = df[['ts', 'user_id', 'text',
-                         'reactions_concatenated', 'channel_id']].drop_duplicates()
-
-        # job_idを追加
-        df_cleaned['job_id'] = job_id
-
-        client = bigquery.Client()
-
-        table_ref = f"{client.project}.{dataset_id}.{table_id}"
-        job_config = bigquery.LoadJobConfig(
-            write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        # 差分取得モードの場合はチャネルごとの取得状態を読み込む
+        state_store = None
+        sync_states = {}
+        if incremental:
+            state_bucket = os.getenv("SYNC_STATE_BUCKET")
+            if not state_bucket:
+                logging.error("SYNC_STATE_BUCKET is not set for incremental mode")
+                return json.dumps({"status": "エラー", "export_path": None, "message": "差分取得用の環境変数が不足しています"}), 500
+            state_store = GcsSyncStateStore(
+                state_bucket, os.getenv("SYNC_STATE_PREFIX", "slack_sync_state"))
+            for channel_id in channel_ids:
+                sync_states[channel_id] = state_store.load(
+                    channel_id, sync_state_key(target_user_ids))
+
+        # pandasの読み込みは書き込みが必要になった時点まで遅らせる
+        from transform import messages_to_dataframe
+
+        # 取得したメッセージは一定件数ごとに変換してBigQueryへ書き込む
+        writer = create_message_writer(
+            dataset_id, table_id, os.getenv("LOCAL_MESSAGE_SINK_PATH"))
+        batcher = MessageBatcher(
+            writer, messages_to_dataframe, load_batch_size)
+        dedup = CrawlDeduplicator()
+
+        # 接続を使い回すSlackクライアントとスレッド返信取得用のスレッドプール
+        slack_client = SlackClient(
+            slack_token, pool_size=thread_fetch_concurrency + 1,
+            rate_overrides={"conversations.replies": replies_rate_per_minute},
+            token_refresher=lambda stale_token: refresh_secret(secret_name, project_id, stale_token))
+        executor = ThreadPoolExecutor(max_workers=thread_fetch_concurrency)
 
         try:
-            job = client.load_table_from_dataframe(
-                df_cleaned, table_ref, job_config=job_config)
-            job.result()
-        except Exception as e:
+            for channel_id in channel_ids:
+
+                logging.info(f"channel_id: {channel_id}")
+
+                for message in iter_channel_messages(
+                        slack_client, channel_id, start_time, end_time, slack_message_limit,
+                        executor, thread_fetch_concurrency,
+                        sync_states.get(channel_id), thread_lookback_seconds, dedup):
+                    user_id = message.get("user")
+                    if all_members and user_id:
+                        message_job_id = job_id
+                    else:
+                        message_job_id = user_job_ids.get(user_id)
+                    if message_job_id:
+                        message['channel_id'] = channel_id
+                        message['job_id'] = message_job_id
+                        batcher.add(message)
+
+            batcher.flush()
+        except requests.RequestException as e:
+            logging.error(f"Failed to fetch Slack data: {e}")
+            return json.dumps({"status": "エラー", "export_path": None, "message": "Slackデータの取得に失敗しました"}), 500
+        except SlackApiError as e:
+            logging.error(f"Error from Slack API: {e}")
+            return json.dumps({"status": "エラー", "export_path": None, "message": f"Slack APIエラー: {e}"}), 500
+        except MessageWriteError as e:
             logging.error(f"Failed to load data to BigQuery: {e}")
+            logging.error(
+                f"Rows already loaded before the failure: {batcher.rows_written}")
             return json.dumps({"status": "エラー", "export_path": None, "message": "BigQueryへのデータ書き込みに失敗しました"}), 500
+        finally:
+            # 未開始の取得は取り消し、実行中の取得が終わってからセッションを閉じる
+            executor.shutdown(wait=True, cancel_futures=True)
+            logging.info("Slack API metrics: %s",
+                         json.dumps(slack_client.metrics_summary()))
+            logging.info("Crawl dedup metrics: %s",
+                         json.dumps(dedup.counters))
+            logging.info("Secret cache metrics: %s",
+                         json.dumps(secret_cache.cache.stats()))
+            slack_client.close()
+
+        # BigQueryへの書き込みが成功してから取得状態を更新する
+        save_sync_states(state_store, sync_states,
+                         sync_state_key(target_user_ids), thread_lookback_seconds)
+
+        # メッセージが0件の場合は正常終了
+        if batcher.rows_written == 0:
+            logging.info("No messages found for the given parameters")
+            return json.dumps({"status": "成功", "export_path": None, "message": "メッセージが見つかりませんでした"}), 200
 
-        logging.info("Total processed messages: %d", len(user_messages))
-        logging.info("Total rows in dataframe: %d", len(df_cleaned))
+        logging.info("Total processed messages: %d",
+                     batcher.messages_received)
+        logging.info("Total rows loaded: %d in %d batches",
+                     batcher.rows_written, batcher.batches_written)
 
-        response = {"status": "実行中", "export_path": table_ref,
-                    "message": f"中間データ作成が完了しました。{len(df_cleaned)} 件のメッセージをアップロードしました。"}
+        response = {"status": "実行中", "export_path": writer.table_ref,
+                    "message": f"中間データ作成が完了しました。{batcher.rows_written} 件のメッセージをアップロードしました。"}
         return json.dumps(response), 200
 
     except Exception as e:
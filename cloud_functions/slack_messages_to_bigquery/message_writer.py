@@ -0,0 +1,145 @@
+import json
+import logging
+
+import clients
+import tracing
+
+
+# BigQueryのメッセージのテーブルのスキーマ (列名, 型)
+MESSAGE_SCHEMA = [
+    ("ts", "TIMESTAMP"),
+    ("user_id", "STRING"),
+    ("team", "STRING"),
+    ("text", "STRING"),
+    ("text_hash", "STRING"),
+    ("reactions_concatenated", "STRING"),
+    ("channel_id", "STRING"),
+    ("job_id", "STRING"),
+]
+
+# テーブルを作成する場合のパーティションとクラスタリングの列
+# job_idで絞り込むDataformのクエリが対象のジョブのブロックだけを読むようにする
+PARTITION_FIELD = "ts"
+CLUSTERING_FIELDS = ["job_id", "user_id", "channel_id"]
+
+# 従来の形式のテーブルを移行するスクリプト (ロードジョブでは既存のテーブルのパーティションや列の型を変更できない)
+MIGRATION_SCRIPT = "migrations/partition_messages_table.py"
+
+
+# メッセージの書き込みに失敗した場合の例外
+class MessageWriteError(Exception):
+    pass
+
+
+# BigQueryにバッチ単位でロードするライター
+class BigQueryBatchWriter:
+    """DataFrameのバッチごとにWRITE_APPENDのロードジョブを実行する"""
+
+    def __init__(self, dataset_id, table_id, client=None):
+        from google.cloud import bigquery
+
+        self.client = client or clients.bigquery_client()
+        self.table_ref = f"{self.client.project}.{dataset_id}.{table_id}"
+        # スキーマは自動検出せずに明示する。テーブルが無い場合は日単位のパーティションとクラスタリングを設定して作成する
+        # 既存のテーブルに無い列 (text_hash など) は追加する
+        self.job_config = bigquery.LoadJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            schema=[bigquery.SchemaField(name, field_type)
+                    for name, field_type in MESSAGE_SCHEMA],
+            time_partitioning=bigquery.TimePartitioning(
+                type_=bigquery.TimePartitioningType.DAY, field=PARTITION_FIELD),
+            clustering_fields=CLUSTERING_FIELDS,
+            schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION])
+        self.table_checked = False
+
+    # 既存のテーブルが移行済みかを確認する (最初のロードの前に1度だけ)
+    # tsが文字列のテーブルにはロードできないため、移行するまで書き込まない
+    def check_table(self):
+        from google.api_core import exceptions as api_exceptions
+
+        try:
+            table = self.client.get_table(self.table_ref)
+        except api_exceptions.NotFound:
+            # ロードジョブでパーティションとクラスタリングを設定して作成する
+            return
+        except Exception as e:
+            raise MessageWriteError(e) from e
+        ts_type = next(
+            (field.field_type for field in table.schema if field.name == PARTITION_FIELD), None)
+        if ts_type not in (None, "TIMESTAMP"):
+            raise MessageWriteError(
+                f"{self.table_ref}.{PARTITION_FIELD} is {ts_type}, not TIMESTAMP. Run {MIGRATION_SCRIPT} before loading")
+        partitioning = table.time_partitioning
+        if partitioning is None or partitioning.field != PARTITION_FIELD:
+            logging.warning(
+                f"{self.table_ref} is not partitioned by {PARTITION_FIELD}. Run {MIGRATION_SCRIPT} to partition it")
+
+    def write_batch(self, df):
+        if not self.table_checked:
+            self.check_table()
+            self.table_checked = True
+        try:
+            job = self.client.load_table_from_dataframe(
+                df, self.table_ref, job_config=self.job_config)
+            job.result()
+        except Exception as e:
+            raise MessageWriteError(e) from e
+
+
+# ローカルの改行区切りJSONファイルに書き込むライター (ローカル検証用)
+class JsonlBatchWriter:
+    """BigQueryの代わりにバッチを改行区切りJSONとして追記する"""
+
+    def __init__(self, path):
+        self.path = path
+        self.table_ref = path
+
+    def write_batch(self, df):
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for record in df.to_dict(orient="records"):
+                    # タイムスタンプはISO 8601形式の文字列にする
+                    f.write(json.dumps(record, ensure_ascii=False, default=lambda value: value.isoformat()) + "\n")
+        except OSError as e:
+            raise MessageWriteError(e) from e
+
+
+# メッセージを一定件数ごとに変換して書き込むバッファ
+class MessageBatcher:
+    """バッファのメッセージ数がbatch_sizeに達するたびに変換・書き込みを行う"""
+
+    def __init__(self, writer, transform, batch_size):
+        self.writer = writer
+        self.transform = transform
+        self.batch_size = batch_size
+        self.buffer = []
+        self.messages_received = 0
+        self.rows_written = 0
+        self.batches_written = 0
+
+    def add(self, message):
+        self.buffer.append(message)
+        self.messages_received += 1
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        with tracing.span("dataframe.build", messages=len(self.buffer)):
+            df = self.transform(self.buffer)
+        with tracing.span("bigquery.load", rows=len(df), table=self.writer.table_ref):
+            self.writer.write_batch(df)
+        self.rows_written += len(df)
+        self.batches_written += 1
+        logging.info(
+            f"Flushed batch {self.batches_written} with {len(df)} rows to {self.writer.table_ref}")
+        self.buffer = []
+
+
+# 書き込み先のライターを作成する関数
+# LOCAL_MESSAGE_SINK_PATHが設定されている場合はローカルファイルに書き込む
+def create_message_writer(dataset_id, table_id, local_sink_path=None):
+    if local_sink_path:
+        return JsonlBatchWriter(local_sink_path)
+    return BigQueryBatchWriter(dataset_id, table_id)
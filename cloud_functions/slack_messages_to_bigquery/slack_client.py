@@ -0,0 +1,253 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import tracing
+
+DEFAULT_BASE_URL = "https://slack.com/api"
+
+# Slack Web APIのティアごとの1分あたりのリクエスト数
+# https://api.slack.com/apis/rate-limits
+TIER_RATES_PER_MINUTE = {
+    1: 1,
+    2: 20,
+    3: 50,
+    4: 100,
+}
+
+# 利用するメソッドとティアの対応
+METHOD_TIERS = {
+    "conversations.history": 3,
+    "conversations.replies": 3,
+    "conversations.members": 4,
+    "users.list": 2,
+}
+
+
+# トークンの再取得で解消する可能性がある認証エラー
+AUTH_ERRORS = {"invalid_auth", "not_authed",
+               "token_revoked", "token_expired"}
+
+
+# Slack APIがok: falseを返した場合の例外
+class SlackApiError(Exception):
+    def __init__(self, error, method=None):
+        super().__init__(error)
+        self.error = error
+        self.method = method
+
+
+# メソッドごとのトークンバケット
+class TokenBucket:
+    """一定レートでトークンを補充し、Retry-After受信時はレートを下げて待機させる"""
+
+    def __init__(self, rate_per_minute, burst):
+        self.base_rate = rate_per_minute / 60.0
+        self.rate = self.base_rate
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = max(self.blocked_until - now,
+                                (1 - self.tokens) / self.rate)
+            time.sleep(wait_time)
+
+    def penalize(self, retry_after):
+        # Retry-Afterの間はメソッド全体を止め、レートを半分に落とす
+        with self.lock:
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            self.rate = max(self.base_rate / 8, self.rate / 2)
+            self.tokens = 0.0
+            self.updated = now
+
+    def reward(self):
+        # 成功したリクエストごとに元のレートへ少しずつ戻す
+        with self.lock:
+            if self.rate < self.base_rate:
+                self.rate = min(self.base_rate, self.rate +
+                                self.base_rate / 20)
+
+
+# Slack Web APIクライアント
+class SlackClient:
+    """HTTPセッションを再利用し、レート制限とリトライを扱うSlack Web APIクライアント"""
+
+    def __init__(self, token, base_url=None, pool_size=10, max_retries=5,
+                 burst=None, rate_overrides=None, timeout=30, token_refresher=None):
+        self.base_url = (base_url or os.getenv(
+            "SLACK_API_BASE_URL", DEFAULT_BASE_URL)).rstrip("/")
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.burst = burst
+        self.rate_overrides = rate_overrides or {}
+        # 認証エラー時に失効したトークンを受け取り、新しいトークンを返す関数
+        self.token_refresher = token_refresher
+        self.token = token
+        self.token_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Authorization"] = f"Bearer {token}"
+
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+
+        self.metrics_lock = threading.Lock()
+        self.metrics = defaultdict(lambda: {
+            "calls": 0, "retries": 0, "rate_limited": 0, "errors": 0,
+            "latency_total": 0.0, "latency_max": 0.0})
+
+    def _bucket(self, method):
+        with self.buckets_lock:
+            bucket = self.buckets.get(method)
+            if bucket is None:
+                rate = self.rate_overrides.get(
+                    method, TIER_RATES_PER_MINUTE[METHOD_TIERS.get(method, 3)])
+                # バースト量の既定値は1分あたりのレートの1/5 (最低1)
+                burst = self.burst if self.burst is not None else rate / 5
+                bucket = TokenBucket(rate, burst)
+                self.buckets[method] = bucket
+            return bucket
+
+    def _record(self, method, latency=None, **counts):
+        with self.metrics_lock:
+            metric = self.metrics[method]
+            if latency is not None:
+                metric["calls"] += 1
+                metric["latency_total"] += latency
+                metric["latency_max"] = max(metric["latency_max"], latency)
+            for name, value in counts.items():
+                metric[name] += value
+
+    def call(self, method, params):
+        """Slack APIを呼び出し、ok: trueのレスポンスを返す"""
+        # 呼び出しごとのスパンは数が多いため、チャネルとメソッドごとに集計して記録する
+        with tracing.call(f"slack.{method}", channel=params.get("channel")):
+            return self._call(method, params)
+
+    def _call(self, method, params):
+        bucket = self._bucket(method)
+        url = f"{self.base_url}/{method}"
+        token_refreshed = False
+
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            sent_token = self.token
+            started = time.monotonic()
+            try:
+                response = self.session.get(
+                    url, params=params, timeout=self.timeout)
+            except requests.ConnectionError as e:
+                self._record(method, time.monotonic() - started)
+                if attempt == self.max_retries:
+                    self._record(method, errors=1)
+                    raise
+                logging.warning(
+                    f"Connection error on {method}, retrying: {e}")
+                self._record(method, retries=1)
+                time.sleep(self._backoff(attempt))
+                continue
+            self._record(method, time.monotonic() - started)
+
+            if response.status_code == 429:
+                retry_after = float(response.headers.get("Retry-After", 1))
+                self._record(method, rate_limited=1)
+                bucket.penalize(retry_after)
+                if attempt == self.max_retries:
+                    self._record(method, errors=1)
+                    raise SlackApiError("ratelimited", method)
+                logging.warning(
+                    f"Rate limited on {method}, retrying after {retry_after}s")
+                self._record(method, retries=1)
+                continue
+
+            if response.status_code >= 500:
+                if attempt == self.max_retries:
+                    self._record(method, errors=1)
+                    response.raise_for_status()
+                logging.warning(
+                    f"Server error {response.status_code} on {method}, retrying")
+                self._record(method, retries=1)
+                time.sleep(self._backoff(attempt))
+                continue
+
+            data = response.json()
+            if not data.get("ok") and data.get("error") in AUTH_ERRORS \
+                    and self.token_refresher and not token_refreshed:
+                # トークンがローテーションされた可能性があるため1度だけ取得し直す
+                token_refreshed = True
+                if self._refresh_token(sent_token):
+                    logging.warning(
+                        f"{data.get('error')} on {method}, retrying with a refreshed token")
+                    self._record(method, retries=1)
+                    continue
+            if not data.get("ok"):
+                self._record(method, errors=1)
+                raise SlackApiError(data.get("error"), method)
+
+            bucket.reward()
+            return data
+
+    def _refresh_token(self, stale_token):
+        with self.token_lock:
+            # 他のスレッドが既に取得し直している場合はその値で再試行する
+            if self.token != stale_token:
+                return True
+            token = self.token_refresher(stale_token)
+            if not token or token == stale_token:
+                return False
+            self.token = token
+            self.session.headers["Authorization"] = f"Bearer {token}"
+            return True
+
+    def _backoff(self, attempt):
+        return min(30.0, 2 ** attempt) * (0.5 + random.random() / 2)
+
+    def paginate(self, method, params):
+        """カーソルページングで各ページのレスポンスを順に返す"""
+        params = dict(params)
+        while True:
+            data = self.call(method, params)
+            yield data
+            next_cursor = data.get("response_metadata", {}).get("next_cursor")
+            if not data.get("has_more", False) or not next_cursor:
+                return
+            params["cursor"] = next_cursor
+
+    def metrics_summary(self):
+        """エンドポイントごとの呼び出し回数、レイテンシ、リトライ回数を返す"""
+        with self.metrics_lock:
+            summary = {}
+            for method, metric in self.metrics.items():
+                summary[method] = dict(metric)
+                summary[method]["latency_avg"] = (
+                    metric["latency_total"] / metric["calls"] if metric["calls"] else 0.0)
+            return summary
+
+    def close(self):
+        self.session.close()
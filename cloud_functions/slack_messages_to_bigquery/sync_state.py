@@ -0,0 +1,100 @@
+import json
+import logging
+
+import clients
+
+
+# チャネル・ユーザー単位の差分取得の状態
+class ChannelSyncState:
+    """最後に取得したメッセージのtsと、スレッドごとの最新返信のtsを保持する"""
+
+    def __init__(self, latest_ts=None, threads=None, generation=0):
+        self.latest_ts = latest_ts
+        self.threads = dict(threads or {})
+        self.generation = generation
+        # 今回の取得で観測した値 (commit() で反映する)
+        self.next_latest_ts = latest_ts
+        self.next_threads = dict(self.threads)
+
+    @classmethod
+    def from_dict(cls, data, generation=0):
+        return cls(data.get("latest_ts"), data.get("threads"), generation)
+
+    def to_dict(self):
+        return {"latest_ts": self.next_latest_ts, "threads": self.next_threads}
+
+    def history_oldest(self, start_time, lookback_seconds):
+        # 既存スレッドの latest_reply を確認するため、最終取得時刻より少し前から取得する
+        if self.latest_ts is None:
+            return start_time
+        return max(start_time, int(float(self.latest_ts) - lookback_seconds))
+
+    def is_new_message(self, message):
+        return self.latest_ts is None or float(message["ts"]) > float(self.latest_ts)
+
+    def should_fetch_thread(self, message):
+        known_reply = self.threads.get(message["thread_ts"])
+        if known_reply is None:
+            return True
+        # latest_reply が変わっていないスレッドは取得しない
+        return message.get("latest_reply") != known_reply
+
+    def replies_oldest(self, thread_ts):
+        return self.threads.get(thread_ts)
+
+    def is_new_reply(self, message, thread_ts):
+        known_reply = self.threads.get(thread_ts)
+        if known_reply is not None and float(message["ts"]) <= float(known_reply):
+            return False
+        if message["ts"] == thread_ts:
+            return self.is_new_message(message)
+        return True
+
+    def observe_message(self, message):
+        if self.next_latest_ts is None or float(message["ts"]) > float(self.next_latest_ts):
+            self.next_latest_ts = message["ts"]
+
+    def observe_reply(self, thread_ts, reply_ts):
+        known_reply = self.next_threads.get(thread_ts)
+        if known_reply is None or float(reply_ts) > float(known_reply):
+            self.next_threads[thread_ts] = reply_ts
+
+    def prune(self, lookback_seconds):
+        # 以降の実行で参照されない古いスレッドを削除する
+        if self.next_latest_ts is None:
+            return
+        threshold = float(self.next_latest_ts) - lookback_seconds
+        self.next_threads = {thread_ts: reply_ts for thread_ts, reply_ts in self.next_threads.items()
+                             if float(thread_ts) >= threshold}
+
+
+# 差分取得の状態をCloud Storageに保存するストア
+class GcsSyncStateStore:
+    """gs://<bucket>/<prefix>/<channel_id>/<user_id>.json に状態を保存する"""
+
+    def __init__(self, bucket_name, prefix="slack_sync_state", client=None):
+        self.bucket = (client or clients.storage_client()).bucket(bucket_name)
+        self.prefix = prefix.strip("/")
+
+    def _blob(self, channel_id, user_id):
+        return self.bucket.blob(f"{self.prefix}/{channel_id}/{user_id}.json")
+
+    def load(self, channel_id, user_id):
+        blob = self.bucket.get_blob(
+            f"{self.prefix}/{channel_id}/{user_id}.json")
+        if blob is None:
+            return ChannelSyncState()
+        data = json.loads(blob.download_as_bytes())
+        return ChannelSyncState.from_dict(data, blob.generation)
+
+    def save(self, channel_id, user_id, state):
+        from google.api_core import exceptions as gcs_exceptions
+
+        blob = self._blob(channel_id, user_id)
+        try:
+            # 同時に実行された別ジョブの状態を上書きしないよう世代を条件にする
+            blob.upload_from_string(json.dumps(state.to_dict()), content_type="application/json",
+                                    if_generation_match=state.generation)
+        except gcs_exceptions.PreconditionFailed:
+            logging.warning(
+                f"Sync state for {channel_id}/{user_id} was updated concurrently, skipping save")
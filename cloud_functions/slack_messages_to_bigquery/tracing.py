@@ -0,0 +1,354 @@
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+import urllib.request
+
+# 1つのジョブの処理 (Slackの取り込み、Dataform、Gemini) を通して計測するためのトレース
+# 関数をまたぐ場合は W3C Trace Context の traceparent をリクエストのJSONやCloud Tasksの本文で引き継ぐ
+# 各関数は別々のZIPとしてデプロイするため、このファイルは関数ごとにコピーしている
+
+TRACEPARENT_KEY = "traceparent"
+
+# 現在のスパン (スレッドプールで実行する処理には bind で引き継ぐ)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+# スパン (1つの処理の区間)
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = "OK"
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def end(self, end_ns=None):
+        if self.end_ns is None:
+            self.end_ns = end_ns or time.time_ns()
+            tracer.record(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "service_name": tracer.service_name,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+# 外部から渡されたスパンの情報 (親としてのみ使う)
+class RemoteSpanContext:
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+
+# traceparent の文字列を解析する関数 (不正な場合はNone)
+def parse_traceparent(value):
+    parts = (value or "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return RemoteSpanContext(parts[1], parts[2])
+
+
+# job_idからトレースIDを決める関数
+# traceparent を引き継げない呼び出し (AppSheetからの呼び出しなど) でも同じジョブは同じトレースになる
+def trace_id_for_job(job_id):
+    return hashlib.sha256(f"job:{job_id}".encode("utf-8")).hexdigest()[:32]
+
+
+# 改行区切りのJSONとして標準のloggingに書き込むエクスポーター (Cloud Loggingから検索できる)
+class LoggingExporter:
+    def export(self, spans):
+        for span in spans:
+            logging.info(f"Trace span: {json.dumps(span, ensure_ascii=False, default=str)}")
+
+
+# 改行区切りのJSONファイルに追記するエクスポーター (ローカルのコレクターの代わり)
+class JsonLinesExporter:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span, ensure_ascii=False, default=str) + "\n")
+
+
+# OTLP/HTTP (JSON) でコレクターに送信するエクスポーター
+class OtlpHttpExporter:
+    def __init__(self, endpoint, timeout=5):
+        self.endpoint = endpoint.rstrip("/") + "/v1/traces"
+        self.timeout = timeout
+
+    def export(self, spans):
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            if isinstance(value, float):
+                return {"key": key, "value": {"doubleValue": value}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [attribute("service.name", tracer.service_name)]},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [{
+                "traceId": span["trace_id"],
+                "spanId": span["span_id"],
+                "parentSpanId": span["parent_span_id"] or "",
+                "name": span["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(span["start_time_unix_nano"]),
+                "endTimeUnixNano": str(span["end_time_unix_nano"]),
+                "attributes": [attribute(key, value) for key, value in span["attributes"].items()],
+                "status": {"code": 2, "message": span["error"] or ""} if span["status"] == "ERROR" else {"code": 1},
+            } for span in spans]}],
+        }]}
+        request = urllib.request.Request(
+            self.endpoint, data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+# プロセス内にスパンを保持するエクスポーター (ローカル検証用)
+class InMemoryExporter:
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        with self.lock:
+            self.spans.extend(spans)
+
+
+# 呼び出し回数の多い処理 (Slack APIの呼び出しなど) を、親のスパンと名前、属性ごとにまとめた集計
+# 1回ごとにスパンを記録する代わりに、親のスパンの終了時に回数と所要時間を1つのスパンとして記録する
+class CallAggregate:
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.calls = 0
+        self.errors = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.start_ns = None
+        self.end_ns = None
+        self.last_error = None
+
+    def add(self, start_ns, end_ns, error):
+        self.calls += 1
+        self.total_ns += end_ns - start_ns
+        self.max_ns = max(self.max_ns, end_ns - start_ns)
+        self.start_ns = start_ns if self.start_ns is None else min(self.start_ns, start_ns)
+        self.end_ns = end_ns if self.end_ns is None else max(self.end_ns, end_ns)
+        if error is not None:
+            self.errors += 1
+            self.last_error = error
+
+    def to_span(self):
+        summary = Span(self.name, self.parent.trace_id if self.parent else secrets.token_hex(16),
+                       self.parent.span_id if self.parent else None, dict(
+                           self.attributes, aggregated=True, calls=self.calls, errors=self.errors,
+                           total_ms=round(self.total_ns / 1e6, 3), max_ms=round(self.max_ns / 1e6, 3)))
+        summary.start_ns = self.start_ns
+        if self.errors:
+            summary.status = "ERROR"
+            summary.error = self.last_error
+        return summary
+
+
+# 終了したスパンを溜めておき、flush でまとめてエクスポートする
+# 溜めたスパンが max_buffered_spans に達した場合は処理の途中でもエクスポートしてメモリの使用量を抑える
+class Tracer:
+    def __init__(self):
+        self.exporter = None
+        self.service_name = os.getenv("K_SERVICE", "local")
+        self.max_buffered_spans = int(os.getenv("TRACE_MAX_BUFFERED_SPANS", 512))
+        self.buffer = []
+        self.aggregates = {}
+        self.lock = threading.Lock()
+
+    def record(self, span):
+        if self.get_exporter() is None:
+            return
+        with self.lock:
+            self.buffer.append(span.to_dict())
+            # 終了したスパンの子の集計を記録する
+            finished = [key for key in self.aggregates if key[0] == span.span_id]
+            ready = [self.aggregates.pop(key) for key in finished]
+            full = len(self.buffer) >= self.max_buffered_spans
+        for aggregate in ready:
+            aggregate.to_span().end(aggregate.end_ns)
+        if full:
+            self.flush()
+
+    def aggregate(self, name, parent, start_ns, end_ns, error, attributes):
+        if self.get_exporter() is None:
+            return
+        key = (parent.span_id if parent else None, name, tuple(sorted(attributes.items())))
+        with self.lock:
+            aggregate = self.aggregates.get(key)
+            if aggregate is None:
+                aggregate = self.aggregates[key] = CallAggregate(name, parent, attributes)
+            aggregate.add(start_ns, end_ns, error)
+
+    def get_exporter(self):
+        if self.exporter is None:
+            self.exporter = create_exporter()
+        return self.exporter or None
+
+    def flush(self, drain_aggregates=False):
+        if drain_aggregates:
+            # 親のスパンが終了していない集計 (親が別の関数のスパンの場合など) も記録する
+            with self.lock:
+                pending, self.aggregates = list(self.aggregates.values()), {}
+            for aggregate in pending:
+                aggregate.to_span().end(aggregate.end_ns)
+        with self.lock:
+            spans, self.buffer = self.buffer, []
+        if not spans:
+            return
+        try:
+            self.get_exporter().export(spans)
+        except Exception as e:
+            # トレースの送信に失敗しても本来の処理は続行する
+            logging.error(f"Failed to export {len(spans)} trace spans: {e}")
+
+
+# 環境変数の設定からエクスポーターを作成する関数
+# TRACE_EXPORTER: log (既定) / jsonl / otlp / none
+def create_exporter():
+    kind = os.getenv("TRACE_EXPORTER", "log")
+    if kind == "jsonl":
+        return JsonLinesExporter(os.getenv("TRACE_JSONL_PATH", "traces.jsonl"))
+    if kind == "otlp":
+        return OtlpHttpExporter(os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"))
+    if kind == "none":
+        return False
+    return LoggingExporter()
+
+
+tracer = Tracer()
+
+
+# エクスポーターを差し替える関数 (ローカル検証用)
+def set_exporter(exporter, service_name=None):
+    tracer.flush()
+    tracer.exporter = exporter
+    if service_name:
+        tracer.service_name = service_name
+
+
+def current_span():
+    return _current_span.get()
+
+
+# スパンを開始し、ブロックを抜けたら終了するコンテキストマネージャー
+# 親は parent (Span / RemoteSpanContext)、指定が無い場合は現在のスパン、どちらも無い場合は新しいトレースを始める
+@contextlib.contextmanager
+def span(name, parent=None, trace_id=None, **attributes):
+    parent = parent or current_span()
+    if parent is not None:
+        trace_id = parent.trace_id
+    new_span = Span(name, trace_id or secrets.token_hex(16),
+                    parent.span_id if parent is not None else None, attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.status = "ERROR"
+        new_span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end()
+
+
+# 呼び出し回数の多い処理を集計として記録するコンテキストマネージャー
+# 1回ごとのスパンは作らず、現在のスパンが終了したときに名前と属性ごとの回数、合計・最大の所要時間、エラーの数を記録する
+@contextlib.contextmanager
+def call(name, **attributes):
+    parent = current_span()
+    start_ns = time.time_ns()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        tracer.aggregate(name, parent, start_ns, time.time_ns(), error, attributes)
+
+
+# 関数の処理全体のスパンを開始するコンテキストマネージャー
+# request_json の traceparent を親にし、無い場合は job_id からトレースIDを決める。終了時にエクスポートする
+@contextlib.contextmanager
+def start_request(name, request_json=None, job_id=None, **attributes):
+    # JSONがオブジェクトでない場合 (配列や文字列) の検証は各関数の処理に任せる
+    request_json = request_json if isinstance(request_json, dict) else {}
+    parent = parse_traceparent(request_json.get(TRACEPARENT_KEY))
+    job_id = job_id or request_json.get("job_id")
+    trace_id = trace_id_for_job(job_id) if job_id and job_id != "ALL" else None
+    if job_id:
+        attributes["job_id"] = job_id
+    try:
+        with span(name, parent=parent, trace_id=trace_id, **attributes) as root:
+            yield root
+    finally:
+        tracer.flush(drain_aggregates=True)
+
+
+# 子のスパンとして記録するための traceparent を payload に追加して返す関数
+def inject(payload, parent=None):
+    parent = parent or current_span()
+    if parent is None:
+        return payload
+    return dict(payload, **{TRACEPARENT_KEY: parent.traceparent})
+
+
+# 関数を現在のスパンの中で実行するようにする関数 (スレッドプールに渡す処理用)
+def bind(func):
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+
+# 開始時刻と終了時刻が分かっている区間をスパンとして記録する関数 (Dataformの実行の待ち時間など)
+def record_span(name, start_seconds, end_seconds, parent=None, **attributes):
+    parent = parent or current_span()
+    recorded = Span(name, parent.trace_id if parent else secrets.token_hex(16),
+                    parent.span_id if parent else None, attributes)
+    recorded.start_ns = int(start_seconds * 1e9)
+    recorded.end(int(end_seconds * 1e9))
+    return recorded
@@ -0,0 +1,53 @@
+import hashlib
+import logging
+
+import pandas as pd
+
+# BigQueryに書き込む列
+OUTPUT_COLUMNS = ['ts', 'user_id', 'team', 'text', 'text_hash',
+                  'reactions_concatenated', 'channel_id', 'job_id']
+
+
+# テキストのSHA-256を16進数の文字列にした列を返す関数
+# BigQueryの TO_HEX(SHA256(text)) と同じ値になり、Dataformの感情分析の結果をこの値で引き当てる
+def hash_texts(texts):
+    return pd.Series([hashlib.sha256(text.encode('utf-8')).hexdigest() if isinstance(text, str) else None
+                      for text in texts], index=texts.index, dtype=object)
+
+
+# リアクションの列を "name:count, ..." 形式の文字列の列に変換する関数
+def concatenate_reactions(reactions):
+    # リストの要素が少ないため、explode と groupby で集約するよりも1回のリスト内包表記で作成する方が速い
+    return pd.Series([', '.join([f"{reaction['name']}:{reaction['count']}" for reaction in value])
+                      if isinstance(value, list) else '' for value in reactions],
+                     index=reactions.index, dtype=object)
+
+
+# Slackのts ("秒.マイクロ秒") の列をUTCのタイムスタンプの列に変換する関数
+# 秒単位の浮動小数点数のまま変換するとマイクロ秒がずれるため、マイクロ秒の整数に丸めてから変換する
+# (現在のtsの値の範囲では浮動小数点数の誤差は1マイクロ秒未満のため、丸めると元の値に戻る)
+def convert_to_timestamp(ts):
+    micros = (ts.astype(float) * 1000000).round().astype('int64')
+    return pd.to_datetime(micros, unit='us', utc=True)
+
+
+# Slackのメッセージ一覧をBigQueryに書き込むDataFrameに変換する関数
+def messages_to_dataframe(messages):
+    df = pd.DataFrame(messages)
+    df = df.iloc[df['ts'].astype(float).argsort(kind='stable')]
+    df = df.reset_index(drop=True)
+
+    if 'reactions' in df.columns:
+        df['reactions_concatenated'] = concatenate_reactions(df['reactions'])
+    else:
+        logging.warning("'reactions' column not found in dataframe")
+        df['reactions_concatenated'] = ''
+
+    # Dataformの dwh.messages が参照する team が無いメッセージは空にする
+    if 'team' not in df.columns:
+        df['team'] = None
+
+    df['ts'] = convert_to_timestamp(df['ts'])
+    df['text_hash'] = hash_texts(df['text'])
+    df.rename(columns={'user': 'user_id'}, inplace=True)
+    return df[OUTPUT_COLUMNS]
@@ -61,12 +61,34 @@ resource "google_storage_bucket" "slack_messages_assets" {
   name          = "${var.project_id}-slack-messages-assets"
   location      = "us-central1"
   force_destroy = false
+
+  # 有効期間を過ぎたGeminiの生成結果のキャッシュを削除する
+  lifecycle_rule {
+    action {
+      type = "Delete"
+    }
+    condition {
+      age            = max(1, ceil(var.result_cache_ttl_seconds / 86400))
+      matches_prefix = ["gemini_result_cache/"]
+    }
+  }
 }
 
 resource "google_storage_bucket" "strengthsfinder_assets_2024" {
   name          = "${var.project_id}-strengthsfinder-assets-2024"
   location      = "us-central1"
   force_destroy = false
+
+  # アップロードに失敗して残った一時オブジェクトを削除する
+  lifecycle_rule {
+    action {
+      type = "Delete"
+    }
+    condition {
+      age            = 1
+      matches_prefix = [".staging/"]
+    }
+  }
 }
 
 
@@ -165,9 +187,10 @@ resource "google_cloudfunctions2_function" "function_download" {
     timeout_seconds       = 600
     service_account_email = google_service_account.function_service_account.email
     environment_variables = {
-      GCP_PROJECT_ID    = var.project_id
-      BUCKET_NAME = google_storage_bucket.strengthsfinder_assets_2024.name
-      APP_ID      = var.app_id # App ID
+      GCP_PROJECT_ID         = var.project_id
+      BUCKET_NAME            = google_storage_bucket.strengthsfinder_assets_2024.name
+      APP_ID                 = var.app_id # App ID
+      TRANSFER_CHUNK_SIZE_MB = var.transfer_chunk_size_mb
     }
   }
 
@@ -207,9 +230,19 @@ resource "google_cloudfunctions2_function" "function_gemini" {
     timeout_seconds       = 600
     service_account_email = google_service_account.function_service_account.email
     environment_variables = {
-      GCP_PROJECT_ID  = var.project_id
-      GCS_BUCKET_NAME = google_storage_bucket.slack_messages_assets.name # ここでバケット名を参照
-      APP_ID          = var.app_id                                       # App ID
+      GCP_PROJECT_ID                = var.project_id
+      GCS_BUCKET_NAME               = google_storage_bucket.slack_messages_assets.name # ここでバケット名を参照
+      APP_ID                        = var.app_id                                       # App ID
+      RESULT_CACHE_BACKEND          = "gcs"                                            # インスタンス間で生成結果のキャッシュを共有する
+      RESULT_CACHE_BUCKET           = google_storage_bucket.slack_messages_assets.name
+      RESULT_CACHE_TTL_SECONDS      = var.result_cache_ttl_seconds
+      REGION                        = var.region
+      ANALYSIS_QUEUE_NAME           = google_cloud_tasks_queue.gemini_analysis.name          # 非同期モードの分析ジョブ用のキュー
+      ANALYSIS_TASK_SERVICE_ACCOUNT = google_service_account.function_service_account.email # タスクからの呼び出しに使うサービスアカウント
+      ANALYSIS_TASK_PLATFORM_AUTH   = "true"                                                 # 呼び出しは gemini_analysis_invoker のみに許可し、トークンの署名はCloud Runが検証する
+      APPSHEET_ANALYSIS_TABLE       = var.appsheet_analysis_table                           # 非同期モードの分析結果の書き込み先
+      SECRET_CACHE_TTL_SECONDS      = var.secret_cache_ttl_seconds
+      TRACE_EXPORTER                = var.trace_exporter # ジョブのトレースの出力先
     }
   }
 
@@ -273,11 +306,18 @@ resource "google_cloudfunctions2_function" "function_slack_messages" {
     available_memory = "2048Mi"
     timeout_seconds  = 600
     environment_variables = {
-      GCP_PROJECT_ID          = var.project_id
-      SLACK_TOKEN_SECRET_NAME = var.slack_token_secret_name
-      BIGQUERY_DATASET_ID     = var.bigquery_dataset_id
-      BIGQUERY_TABLE_ID       = var.bigquery_table_id
-      SLACK_API_MESSAGE_LIMIT = var.slack_api_message_limit
+      GCP_PROJECT_ID                 = var.project_id
+      SLACK_TOKEN_SECRET_NAME        = var.slack_token_secret_name
+      BIGQUERY_DATASET_ID            = var.bigquery_dataset_id
+      BIGQUERY_TABLE_ID              = var.bigquery_table_id
+      SLACK_API_MESSAGE_LIMIT        = var.slack_api_message_limit
+      SLACK_THREAD_FETCH_CONCURRENCY = var.slack_thread_fetch_concurrency
+      SLACK_REPLIES_RATE_PER_MINUTE  = var.slack_replies_rate_per_minute
+      SLACK_THREAD_LOOKBACK_DAYS     = var.slack_thread_lookback_days
+      SYNC_STATE_BUCKET              = google_storage_bucket.slack_messages_assets.name
+      BIGQUERY_LOAD_BATCH_SIZE       = var.bigquery_load_batch_size
+      SECRET_CACHE_TTL_SECONDS       = var.secret_cache_ttl_seconds
+      TRACE_EXPORTER                 = var.trace_exporter # ジョブのトレースの出力先
     }
     service_account_email = google_service_account.function_service_account.email
   }
@@ -336,8 +376,11 @@ resource "google_cloudfunctions2_function" "function_kick_dataform_job" {
     environment_variables = {
       GCP_PROJECT_ID    = var.project_id
       REGION            = var.region
-      POLL_FUNCTION_URL = google_cloudfunctions2_function.function_poll_dataform_job.service_config[0].uri # poll_dataform_jobのURL
-      APP_ID            = var.app_id                                                                       # App IDは環境変数から取得
+      POLL_FUNCTION_URL     = google_cloudfunctions2_function.function_poll_dataform_job.service_config[0].uri # poll_dataform_jobのURL
+      APP_ID                = var.app_id                                                                       # App IDは環境変数から取得
+      POLL_DEADLINE_SECONDS = var.dataform_poll_deadline_seconds                                               # 完了の確認を打ち切るまでの秒数
+      EXPORT_COMPRESSION    = var.export_compression                                                           # Gemini用のエクスポートの圧縮形式
+      TRACE_EXPORTER        = var.trace_exporter                                                               # ジョブのトレースの出力先
     }
   }
 
@@ -389,9 +432,13 @@ resource "google_cloudfunctions2_function" "function_poll_dataform_job" {
     timeout_seconds       = 600
     service_account_email = google_service_account.function_service_account.email
     environment_variables = {
-      GCP_PROJECT_ID = var.project_id # プロジェクトID
-      REGION         = var.region     # リージョン
-      APP_ID         = var.app_id     # App ID
+      GCP_PROJECT_ID           = var.project_id                                    # プロジェクトID
+      REGION                   = var.region                                        # リージョン
+      APP_ID                   = var.app_id                                        # App ID
+      SECRET_CACHE_TTL_SECONDS = var.secret_cache_ttl_seconds                      # APIキーのキャッシュ有効期間
+      EXPORT_BUCKET_NAME       = google_storage_bucket.slack_messages_assets.name # エクスポート先のバケット (マニフェストの書き込み用)
+      POLL_MAX_DELAY_SECONDS   = var.dataform_poll_max_delay_seconds              # 完了の確認の間隔の上限
+      TRACE_EXPORTER           = var.trace_exporter                               # ジョブのトレースの出力先
     }
   }
 
@@ -435,6 +482,23 @@ resource "google_cloud_tasks_queue" "dataform_completion_checker" {
   }
 }
 
+# Gemini分析の非同期ジョブ用のCloud Tasksキュー
+resource "google_cloud_tasks_queue" "gemini_analysis" {
+  name     = "gemini-analysis"
+  location = var.region
+
+  rate_limits {
+    max_concurrent_dispatches = 10 # Geminiへの同時リクエスト数を抑える
+  }
+
+  retry_config {
+    max_attempts  = 3 # 完了済みのジョブは再実行されないため、タイムアウト時だけ再試行する
+    min_backoff   = "30s"
+    max_backoff   = "300s"
+    max_doublings = 3
+  }
+}
+
 # Cloud Tasksキューにタスクを追加するためのサービスアカウントに必要なIAMロールを付与
 resource "google_project_iam_member" "task_queue_invoker" {
   project = var.project_id
@@ -456,6 +520,21 @@ resource "google_cloudfunctions2_function_iam_member" "poll_dataform_job_invoker
   ]
 }
 
+# Cloud Tasksから gemini_analysis を呼び出す権限を付与
+# gemini_analysis は未認証の呼び出しを許可しない (ANALYSIS_TASK_PLATFORM_AUTH はこの前提でトークンの署名の検証をCloud Runに任せる)
+resource "google_cloudfunctions2_function_iam_member" "gemini_analysis_invoker" {
+  project        = google_cloudfunctions2_function.function_gemini.project
+  location       = google_cloudfunctions2_function.function_gemini.location
+  cloud_function = google_cloudfunctions2_function.function_gemini.name
+  role           = "roles/cloudfunctions.invoker"
+  member         = "serviceAccount:${google_service_account.function_service_account.email}"
+
+  depends_on = [
+    google_service_account.function_service_account,
+    google_cloudfunctions2_function.function_gemini
+  ]
+}
+
 # 必要なAPIを有効化
 resource "google_project_service" "cloudfunctions" {
   service            = "cloudfunctions.googleapis.com"
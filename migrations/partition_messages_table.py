@@ -0,0 +1,114 @@
+# Slackのメッセージのテーブル (lake.messages) を、tsがTIMESTAMPで日単位のパーティションと
+# job_id, user_id, channel_id のクラスタリングを設定したテーブルに移行する
+# ロードジョブでは既存のテーブルのパーティションや列の型を変更できないため、新しいテーブルを作成して入れ替える
+#
+# 使い方:
+#   # 実行するSQLを表示する (テーブルは変更しない)
+#   python migrations/partition_messages_table.py --project my-project
+#   # 移行する (元のテーブルは messages_legacy_YYYYMMDD として残す)
+#   python migrations/partition_messages_table.py --project my-project --execute
+#
+# 移行の手順 (取り込みの停止、Dataformの完全更新など) は README の「メッセージテーブルの移行」を参照
+import argparse
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "slack_messages_to_bigquery"))
+from message_writer import CLUSTERING_FIELDS, MESSAGE_SCHEMA, PARTITION_FIELD  # noqa: E402
+
+
+def field_types(table):
+    return {field.name: field.field_type for field in table.schema}
+
+
+# 移行済み (tsがTIMESTAMPでパーティションを設定済み) かを返す関数
+def is_migrated(table):
+    partitioning = table.time_partitioning
+    return field_types(table).get(PARTITION_FIELD) == "TIMESTAMP" and \
+        partitioning is not None and partitioning.field == PARTITION_FIELD
+
+
+# 従来のテーブルから移行先のテーブルを作成するDDLを返す関数
+# 従来のtsはJSTの "YYYY-MM-DD HH:MM:SS" の文字列、無い列 (team, text_hash など) はNULLにする
+def create_partitioned_copy_sql(table, destination, replace=False):
+    existing = field_types(table)
+    columns = []
+    for name, field_type in MESSAGE_SCHEMA:
+        if name not in existing:
+            columns.append(f"CAST(NULL AS {field_type}) AS {name}")
+        elif name == PARTITION_FIELD and existing[name] == "STRING":
+            columns.append(f"TIMESTAMP({name}, 'Asia/Tokyo') AS {name}")
+        else:
+            columns.append(name)
+    # スキーマに無い列も残す
+    schema_names = {name for name, _ in MESSAGE_SCHEMA}
+    columns.extend(name for name in existing if name not in schema_names)
+
+    select_list = ",\n  ".join(columns)
+    return f"""
+CREATE {"OR REPLACE " if replace else ""}TABLE `{destination}`
+PARTITION BY DATE({PARTITION_FIELD})
+CLUSTER BY {", ".join(CLUSTERING_FIELDS)}
+AS
+SELECT
+  {select_list}
+FROM
+  `{table.project}.{table.dataset_id}.{table.table_id}`"""
+
+
+# 移行のSQLを順に返す関数 (作成、件数の確認、入れ替え)
+def migration_steps(table, suffix):
+    source = f"{table.project}.{table.dataset_id}.{table.table_id}"
+    staging = f"{source}_migrating"
+    legacy_name = f"{table.table_id}_legacy_{suffix}"
+    return [
+        ("create", create_partitioned_copy_sql(table, staging)),
+        ("verify", f"""
+SELECT
+  (SELECT COUNT(*) FROM `{source}`) AS source_rows,
+  (SELECT COUNT(*) FROM `{staging}`) AS migrated_rows"""),
+        ("swap", f"""
+ALTER TABLE `{source}` RENAME TO `{legacy_name}`;
+ALTER TABLE `{staging}` RENAME TO `{table.table_id}`"""),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", required=True)
+    parser.add_argument("--table", default="lake.messages",
+                        help="移行するテーブル (dataset.table)")
+    parser.add_argument("--execute", action="store_true",
+                        help="SQLを表示するだけでなく実際に移行する")
+    args = parser.parse_args()
+
+    from google.cloud import bigquery
+
+    client = bigquery.Client(project=args.project)
+    table = client.get_table(f"{args.project}.{args.table}")
+    if is_migrated(table):
+        print(f"{args.table} is already partitioned by {PARTITION_FIELD}")
+        return 0
+
+    steps = migration_steps(table, datetime.now().strftime("%Y%m%d%H%M%S"))
+    for name, sql in steps:
+        print(f"-- {name}{sql};\n")
+        if not args.execute:
+            continue
+        rows = list(client.query(sql).result())
+        if name == "verify":
+            source_rows, migrated_rows = rows[0]["source_rows"], rows[0]["migrated_rows"]
+            print(f"-- source_rows={source_rows}, migrated_rows={migrated_rows}\n")
+            if source_rows != migrated_rows:
+                # 入れ替えずに終了する (作成したテーブルは確認用に残す)
+                print("Row counts differ, the tables were not swapped", file=sys.stderr)
+                return 1
+    if not args.execute:
+        print("-- Dry run: re-run with --execute to migrate")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+# gemini_analysis の分析ジョブ (タスクの認証、実行権の取得、状態の遷移) のテスト
+import base64
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "gemini_analysis"))
+# 各関数の main.py は同じモジュール名のため、このディレクトリのものを読み込み直す
+sys.modules.pop("main", None)
+import analysis_jobs  # noqa: E402
+import clients  # noqa: E402
+import fakes  # noqa: E402
+import main  # noqa: E402
+
+SERVICE_ACCOUNT = "tasks@example.iam.gserviceaccount.com"
+TASK_URL = "https://example.com/gemini_analysis"
+
+
+# 署名を取り除いた形式のトークン (Cloud Runが検証した後のトークンと同じ形式) を作成する
+def stripped_token(email):
+    def encode(value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+    claims = {"email": email, "email_verified": True, "aud": TASK_URL}
+    return f"{encode({'alg': 'RS256'})}.{encode(claims)}.SIGNATURE_REMOVED_BY_GOOGLE"
+
+
+def task_headers(token):
+    return {"X-CloudTasks-QueueName": "gemini-analysis", "Authorization": f"Bearer {token}"}
+
+
+def verify(headers, trust_platform_auth=False):
+    return analysis_jobs.verify_task_request(
+        headers, TASK_URL, "gemini-analysis", SERVICE_ACCOUNT, trust_platform_auth)
+
+
+def test_forged_stripped_token_is_rejected_without_platform_auth():
+    assert not verify(task_headers(stripped_token(SERVICE_ACCOUNT)))
+
+
+def test_stripped_token_is_accepted_with_platform_auth():
+    assert verify(task_headers(stripped_token(SERVICE_ACCOUNT)), trust_platform_auth=True)
+    assert not verify(task_headers(stripped_token("someone@example.com")), trust_platform_auth=True)
+
+
+def test_unsigned_token_and_missing_headers_are_rejected():
+    assert not verify(task_headers("header.payload.signature"))
+    assert not verify({"Authorization": f"Bearer {stripped_token(SERVICE_ACCOUNT)}"}, trust_platform_auth=True)
+    assert not verify({"X-CloudTasks-QueueName": "gemini-analysis"}, trust_platform_auth=True)
+
+
+@pytest.fixture
+def gcs_store():
+    fakes.InMemoryStorageClient.buckets.clear()
+    return analysis_jobs.GcsJobStore("jobs", client=fakes.InMemoryStorageClient())
+
+
+def test_second_claim_loses_until_lease_expires(gcs_store, monkeypatch):
+    now = [1700000000.0]
+    monkeypatch.setattr(analysis_jobs.time, "time", lambda: now[0])
+    job = analysis_jobs.new_job({"analysis_id": "a1"})
+    gcs_store.save(job)
+
+    outcome, claimed = gcs_store.claim(job["job_id"], lease_seconds=600)
+    assert outcome == analysis_jobs.CLAIMED
+    assert claimed["status"] == analysis_jobs.RUNNING
+    assert claimed["lease_expires_at"] == now[0] + 600
+    assert gcs_store.claim(job["job_id"], lease_seconds=600)[0] == analysis_jobs.ALREADY_RUNNING
+
+    # 実行中の呼び出しが期限までに終わらなかった場合は再実行できる
+    now[0] += 601
+    outcome, reclaimed = gcs_store.claim(job["job_id"], lease_seconds=600)
+    assert outcome == analysis_jobs.CLAIMED
+    assert reclaimed["attempts"] == 2
+    assert gcs_store.load(job["job_id"])["lease_expires_at"] == now[0] + 600
+
+    reclaimed["status"] = analysis_jobs.SUCCEEDED
+    gcs_store.save(reclaimed)
+    assert gcs_store.claim(job["job_id"], lease_seconds=600)[0] == analysis_jobs.ALREADY_FINISHED
+    assert gcs_store.claim("missing", lease_seconds=600) == (analysis_jobs.NOT_FOUND, None)
+
+
+def test_concurrent_claim_loses_on_generation_mismatch(gcs_store, monkeypatch):
+    job = analysis_jobs.new_job({"analysis_id": "a1"})
+    gcs_store.save(job)
+    try_claim = analysis_jobs.try_claim
+    concurrent = []
+
+    # 読み込んでから書き込むまでの間に、別の呼び出しが実行権を取得する
+    def claim_concurrently(job, lease_seconds):
+        monkeypatch.setattr(analysis_jobs, "try_claim", try_claim)
+        concurrent.append(gcs_store.claim(job["job_id"], lease_seconds))
+        return try_claim(job, lease_seconds)
+
+    monkeypatch.setattr(analysis_jobs, "try_claim", claim_concurrently)
+
+    assert gcs_store.claim(job["job_id"], lease_seconds=600) == (analysis_jobs.ALREADY_RUNNING, None)
+    assert [outcome for outcome, _ in concurrent] == [analysis_jobs.CLAIMED]
+    assert gcs_store.load(job["job_id"])["attempts"] == 1
+
+
+def test_job_status_transitions_with_in_process_queue(monkeypatch):
+    monkeypatch.delenv("APP_ID", raising=False)
+    started, entered, finish = threading.Event(), threading.Event(), threading.Event()
+
+    def run_analysis(request_json):
+        entered.set()
+        finish.wait(5)
+        if request_json["prompt"] == "fail":
+            return {"error": "Generation failed"}, 500
+        return {"generated_content": f"result for {request_json['prompt']}"}, 200
+
+    # キューに登録された直後 (PENDING) を確認できるよう、タスクの開始を待たせる
+    def handler(payload):
+        started.wait(5)
+        return main.handle_analysis_task(payload)
+
+    queue = analysis_jobs.InProcessQueue(handler)
+    monkeypatch.setattr(main, "run_analysis", run_analysis)
+    monkeypatch.setitem(clients._clients, "analysis_job_store", analysis_jobs.InMemoryJobStore())
+    monkeypatch.setitem(clients._clients, "analysis_task_queue", queue)
+
+    body, status_code = main.submit_analysis_job(
+        {"analysis_id": "a1", "prompt": "strengths", "async": True}, TASK_URL)
+    assert status_code == 202
+    job_id = body["job_id"]
+    assert main.get_analysis_job(job_id) == (
+        {"job_id": job_id, "analysis_id": "a1", "status": analysis_jobs.PENDING}, 200)
+
+    started.set()
+    assert entered.wait(5)
+    assert main.get_analysis_job(job_id)[0]["status"] == analysis_jobs.RUNNING
+
+    finish.set()
+    queue.join()
+    assert main.get_analysis_job(job_id) == (
+        {"job_id": job_id, "analysis_id": "a1", "status": analysis_jobs.SUCCEEDED,
+         "generated_content": "result for strengths"}, 200)
+    # 完了したジョブのタスクが再送されても実行し直さない
+    assert main.run_analysis_job(job_id) == ({"job_id": job_id, "status": analysis_jobs.SUCCEEDED}, 200)
+
+    body, _ = main.submit_analysis_job({"analysis_id": "a2", "prompt": "fail"}, TASK_URL)
+    queue.join()
+    assert main.get_analysis_job(body["job_id"]) == (
+        {"job_id": body["job_id"], "analysis_id": "a2", "status": analysis_jobs.FAILED,
+         "error": "Generation failed"}, 200)
+    assert main.get_analysis_job("missing")[1] == 404
@@ -0,0 +1,99 @@
+# gemini_analysis のエクスポートファイルの圧縮 (辞書化、再利用) のテスト
+import csv
+import gzip
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "gemini_analysis"))
+import clients  # noqa: E402
+import compaction  # noqa: E402
+import fakes  # noqa: E402
+
+BUCKET_NAME = "exports"
+TARGET_PATH = "exports/job123_20240101000000000"
+COLUMNS = ["ts", "user_name", "channel_name", "text", "reactions_concatenated"]
+
+SOURCE_ROWS = [
+    ["2024-01-01 10:00:00", "山田", "general", "おはようございます", "+1:2"],
+    ["2024-01-01 09:00:00", "佐藤", "random", "改行を含む\n\"引用\", カンマ", ""],
+    ["2024-01-01 11:00:00", "山田", "random", "了解です", "eyes:1, tada:3"],
+]
+
+
+def csv_text(rows):
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    writer.writerows(rows)
+    return output.getvalue()
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    fakes.InMemoryStorageClient.buckets.clear()
+    storage_client = fakes.InMemoryStorageClient()
+    monkeypatch.setitem(clients._clients, "storage", storage_client)
+    bucket = storage_client.bucket(BUCKET_NAME)
+    bucket.put(f"{TARGET_PATH}/000000000000.csv", csv_text(SOURCE_ROWS[:2]).encode())
+    # 空のメッセージと、別のファイルに重複して出力されたメッセージを含める
+    bucket.put(f"{TARGET_PATH}/000000000001.csv.gz", gzip.compress(csv_text(
+        [SOURCE_ROWS[2], SOURCE_ROWS[0], ["2024-01-01 12:00:00", "佐藤", "general", "  ", ""]]).encode()))
+    return bucket
+
+
+def csv_files(bucket):
+    return [(f"gs://{BUCKET_NAME}/{blob.name}", blob.generation, blob.size)
+            for blob in bucket.list_blobs(prefix=TARGET_PATH) if blob.name.endswith((".csv", ".csv.gz"))]
+
+
+# 圧縮後のテキストの略称を辞書で元の名前に戻し、エクスポートと同じ列の行にする
+def decode(compacted):
+    lines = compacted.split("\n", 3)
+    users = dict(pair.split("=", 1) for pair in lines[1][len("# users: "):].split(", "))
+    channels = dict(pair.split("=", 1) for pair in lines[2][len("# channels: "):].split(", "))
+    reader = csv.reader(io.StringIO(lines[3]))
+    assert next(reader) == ["ts", "user", "channel", "text", "reactions"]
+    return [[ts, users[user], channels[channel], text, reactions]
+            for ts, user, channel, text, reactions in reader]
+
+
+def test_compacted_export_decodes_to_source_rows(bucket):
+    result = compaction.compact_export(BUCKET_NAME, TARGET_PATH, csv_files(bucket))
+
+    compacted = bucket.objects[f"{TARGET_PATH}/{compaction.COMPACT_OBJECT_NAME}"]["data"].decode()
+    assert result.uri == f"gs://{BUCKET_NAME}/{TARGET_PATH}/{compaction.COMPACT_OBJECT_NAME}"
+    assert not result.reused
+    assert decode(compacted) == sorted(SOURCE_ROWS)
+    # 略称は最初に現れた順に付ける
+    assert compacted.startswith("# Slackメッセージ (ユーザーとチャネルは以下の略称で表記)\n"
+                                "# users: u1=山田, u2=佐藤\n# channels: c1=general, c2=random\n")
+    assert result.stats["input_rows"] == 5
+    assert result.stats["output_rows"] == 3
+    assert result.stats["empty_removed"] == 1
+    assert result.stats["duplicates_removed"] == 1
+
+
+def test_unchanged_fingerprint_skips_rewrite(bucket):
+    files = csv_files(bucket)
+    first = compaction.compact_export(BUCKET_NAME, TARGET_PATH, files)
+    compact_blob = bucket.get_blob(f"{TARGET_PATH}/{compaction.COMPACT_OBJECT_NAME}")
+    generation = compact_blob.generation
+
+    second = compaction.compact_export(BUCKET_NAME, TARGET_PATH, files)
+
+    assert second.reused
+    assert second.stats == first.stats
+    assert compact_blob.generation == generation
+
+    # 入力ファイルが更新されると世代が変わり、作成し直す
+    bucket.put(f"{TARGET_PATH}/000000000000.csv", csv_text(SOURCE_ROWS[:1]).encode())
+    third = compaction.compact_export(BUCKET_NAME, TARGET_PATH, csv_files(bucket))
+
+    assert not third.reused
+    assert compact_blob.generation != generation
+    assert third.stats["output_rows"] == 2
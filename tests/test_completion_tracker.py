@@ -0,0 +1,110 @@
+# kick_dataform_job のDataformジョブの完了の追跡 (バックオフ、タスク名、終了状態) のテスト
+import json
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "kick_dataform_job"))
+# 各関数の main.py は同じモジュール名のため、このディレクトリのものを読み込み直す
+sys.modules.pop("main", None)
+import clients  # noqa: E402
+import completion_tracker  # noqa: E402
+import fakes  # noqa: E402
+import main  # noqa: E402
+
+INVOCATION_NAME = "projects/p/locations/asia-northeast1/repositories/r/workflowInvocations/inv-1"
+PAYLOAD = {"parent": "projects/p/locations/asia-northeast1/repositories/r",
+           "workflow_invocation_name": INVOCATION_NAME,
+           "job_id": "job123", "export_path": "exports/job123_20240101000000000"}
+
+
+def test_next_delay_backs_off_with_half_jitter():
+    assert [completion_tracker.next_delay(attempt, rng=lambda: 0.0) for attempt in range(6)] == [
+        2.5, 5.0, 10.0, 20.0, 30.0, 30.0]
+    assert [completion_tracker.next_delay(attempt, rng=lambda: 1.0) for attempt in range(6)] == [
+        5.0, 10.0, 20.0, 40.0, 60.0, 60.0]
+    assert completion_tracker.next_delay(1, initial_delay=1, max_delay=100, multiplier=3.0,
+                                         rng=lambda: 0.5) == 2.25
+
+
+def create_tracker(clock, dataform_client, tasks_client, deadline_seconds=3600):
+    scheduler = completion_tracker.TaskScheduler(
+        tasks_client, "p", "asia-northeast1", "dataform-completion-checker",
+        "https://example.com/poll_dataform_job", clock=clock)
+    return completion_tracker.CompletionTracker(
+        dataform_client, scheduler, clock=clock, rng=lambda: 1.0, deadline_seconds=deadline_seconds)
+
+
+def test_task_names_are_deterministic_and_deduplicated():
+    clock = fakes.VirtualClock()
+    tasks_client = fakes.FakeTasksClient()
+    tracker = create_tracker(clock, fakes.FakeDataformClient(clock, duration=60), tasks_client)
+
+    payload = tracker.start(PAYLOAD)
+    # キックの再試行などで同じ試行回数のポーリングを予約しても、タスクは1つだけ作成される
+    tracker.start(PAYLOAD)
+    tracker.scheduler.schedule(payload, 5)
+
+    assert [task["name"] for task in tasks_client.tasks] == [
+        "projects/p/locations/asia-northeast1/queues/dataform-completion-checker/tasks/poll-inv-1-0"]
+    assert tracker.scheduler.task_name(dict(payload, attempt=3)).endswith("/tasks/poll-inv-1-3")
+
+
+def test_poll_reschedules_until_the_workflow_finishes():
+    clock = fakes.VirtualClock()
+    tasks_client = fakes.FakeTasksClient()
+    tracker = create_tracker(clock, fakes.FakeDataformClient(clock, duration=20), tasks_client)
+    tracker.start(PAYLOAD)
+
+    outcomes = []
+    while (task := tasks_client.pop_next()) is not None:
+        clock.now = task["schedule_time"].seconds
+        outcome, details = tracker.poll(json.loads(task["http_request"]["body"]))
+        outcomes.append(outcome)
+
+    # 5秒後、10秒後 (計15秒) のポーリングでは実行中、20秒後 (計35秒) に完了を検知する
+    assert outcomes == [completion_tracker.RESCHEDULED] * 2 + [completion_tracker.SUCCEEDED]
+    assert details["metrics"]["polls"] == 3
+    assert details["metrics"]["end_to_end_seconds"] == 35.0
+    assert details["metrics"]["detection_delay_seconds"] == 15.0
+
+
+@pytest.mark.parametrize("final_state, deadline_at, status, message", [
+    ("SUCCEEDED", None, "成功", "ジョブが正常に完了しました"),
+    ("FAILED", None, "エラー", "ジョブが失敗しました: messages_export: syntax error"),
+    ("CANCELLED", None, "エラー", "ジョブがキャンセルされました"),
+    ("SUCCEEDED", 1.0, "エラー", "ジョブが期限内に完了しませんでした"),
+])
+def test_terminal_states_update_appsheet(monkeypatch, final_state, deadline_at, status, message):
+    clock = fakes.VirtualClock()
+    # 期限切れの場合はワークフローを実行中にしておく
+    dataform_client = fakes.FakeDataformClient(
+        clock, duration=0 if deadline_at is None else 3600, final_state=final_state,
+        failure_reason="syntax error")
+    posted = []
+
+    def post(url, headers=None, json=None, **kwargs):
+        posted.append(json)
+        return type("Response", (), {"status_code": 200, "text": ""})()
+
+    monkeypatch.setitem(clients._clients, "logging", object())
+    monkeypatch.setitem(clients._clients, "dataform", dataform_client)
+    monkeypatch.setitem(clients._clients, "tasks", fakes.FakeTasksClient())
+    monkeypatch.delenv("EXPORT_BUCKET_NAME", raising=False)
+    monkeypatch.setattr(main, "get_secret", lambda secret_name: "api-key")
+    monkeypatch.setattr(main.requests, "post", post)
+
+    app = Flask(__name__)
+    request_json = dict(PAYLOAD, attempt=2, deadline_at=deadline_at)
+    with app.test_request_context("/", method="POST", json=request_json) as context:
+        _, status_code = main.check_dataform_job(context.request)
+
+    assert status_code == 200
+    assert [row["status"] for payload in posted for row in payload["Rows"]] == [status]
+    assert posted[0]["Rows"][0]["message"] == message
+    assert posted[0]["Rows"][0]["job_id"] == "job123"
+    assert dataform_client.cancelled == (deadline_at is not None)
@@ -0,0 +1,99 @@
+# Dataformの定義 (SQLX) のテスト
+# Dataform CLI を使わずに、増分の実行に必要な記述と変数をテキストとして確認する
+import os
+import re
+
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), "..")
+DEFINITIONS_DIR = os.path.join(ROOT_DIR, "dataform", "definitions")
+KICK_MAIN = os.path.join(ROOT_DIR, "cloud_functions", "kick_dataform_job", "main.py")
+
+# kick_dataform_job が渡さず、Dataformのリポジトリの設定 (workflow_settings.yaml の vars) で設定する変数
+REPOSITORY_VARS = {"bucket_name"}
+
+# when(incremental(), `増分の実行の場合`, `初回 (全件) の場合`) の増分の実行の場合の部分
+INCREMENTAL_BRANCH = re.compile(r"\$\{when\(incremental\(\),\s*`([^`]*)`", re.DOTALL)
+
+
+def read_definition(name):
+    with open(os.path.join(DEFINITIONS_DIR, name), encoding="utf-8") as f:
+        return f.read()
+
+
+def definitions():
+    return sorted(name for name in os.listdir(DEFINITIONS_DIR) if name.endswith(".sqlx"))
+
+
+def incremental_definitions():
+    return [name for name in definitions()
+            if re.search(r'type:\s*"incremental"', read_definition(name))]
+
+
+# ブロック (config や pre_operations) の中身を返す関数 (無い場合はNone)
+def block(text, name):
+    match = re.search(rf"^{name}\s*\{{", text, re.MULTILINE)
+    if match is None:
+        return None
+    depth = 0
+    for index in range(match.end() - 1, len(text)):
+        if text[index] == "{":
+            depth += 1
+        elif text[index] == "}":
+            depth -= 1
+            if depth == 0:
+                return text[match.end():index]
+    raise AssertionError(f"{name} block is not closed")
+
+
+def test_incremental_definitions_are_found():
+    assert incremental_definitions() == [
+        "analyzed_messages_sentiment.sqlx", "messages_dwh.sqlx", "sentiment_memo.sqlx"]
+
+
+@pytest.mark.parametrize("name", incremental_definitions())
+def test_incremental_definitions_merge_on_unique_key(name):
+    config = block(read_definition(name), "config")
+
+    assert re.search(r"uniqueKey:\s*\[[^\]]+\]", config)
+
+
+@pytest.mark.parametrize("name", definitions())
+def test_self_is_referenced_only_in_incremental_runs(name):
+    # 初回 (全件) の実行ではテーブルがまだ無いため、自身を参照できない
+    text = INCREMENTAL_BRANCH.sub("", read_definition(name))
+
+    assert "${self()}" not in text
+
+
+def test_analyzed_messages_sentiment_watermark():
+    text = read_definition("analyzed_messages_sentiment.sqlx")
+    pre_operations = block(text, "pre_operations")
+    assert pre_operations is not None
+    query = text[text.index(pre_operations) + len(pre_operations):]
+
+    # ウォーターマークは増分の実行の場合のみ自身から読み、初回はNULLにする
+    assert "DECLARE watermark TIMESTAMP" in pre_operations
+    assert INCREMENTAL_BRANCH.findall(pre_operations) == ["SELECT MAX(ts) FROM ${self()}"]
+    assert "`SELECT CAST(NULL AS TIMESTAMP)`" in pre_operations
+
+    # 差分のメッセージと、同じメッセージの保存済みの行をあわせて順位を付ける
+    branches = INCREMENTAL_BRANCH.findall(query)
+    assert any("ts > IFNULL(watermark" in branch for branch in branches)
+    assert any("${self()}" in branch and "1 AS is_existing" in branch for branch in branches)
+    assert "0 AS is_existing" in query
+    assert re.search(r'uniqueKey:\s*\["message_key"\]', block(text, "config"))
+
+
+def test_project_config_vars_are_provided():
+    with open(KICK_MAIN, encoding="utf-8") as f:
+        kick_main = f.read()
+    compilation_vars = re.search(r"CodeCompilationConfig\(\s*vars=\{(.*?)\}", kick_main, re.DOTALL).group(1)
+    provided = set(re.findall(r'"(\w+)":', compilation_vars)) | REPOSITORY_VARS
+
+    used = set()
+    for name in definitions():
+        used |= set(re.findall(r"dataform\.projectConfig\.vars\.(\w+)", read_definition(name)))
+
+    assert used == {"job_id", "export_path", "export_compression", "bucket_name"}
+    assert used <= provided
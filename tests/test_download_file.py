@@ -0,0 +1,148 @@
+# download_file_from_drive のファイルの転送と置き換え (チェックサム、条件付きリクエスト、削除の順序) のテスト
+import hashlib
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "download_file_from_drive"))
+# 各関数の main.py は同じモジュール名のため、このディレクトリのものを読み込み直す
+sys.modules.pop("main", None)
+import clients  # noqa: E402
+import fakes  # noqa: E402
+import main  # noqa: E402
+import transfer  # noqa: E402
+
+BUCKET_NAME = "user-files"
+USER_ID = "U1"
+BLOB_NAME = f"{USER_ID}/report.pdf"
+
+
+@pytest.fixture
+def file_server():
+    server = fakes.FakeAppSheetFileServer(300 * 1024).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    fakes.InMemoryStorageClient.buckets.clear()
+    storage_client = fakes.InMemoryStorageClient()
+    monkeypatch.setitem(clients._clients, "storage", storage_client)
+    monkeypatch.setitem(clients._clients, "logging", object())
+    monkeypatch.setenv("BUCKET_NAME", BUCKET_NAME)
+    monkeypatch.setenv("TRANSFER_CHUNK_SIZE_MB", "0.25")
+    bucket = storage_client.bucket(BUCKET_NAME)
+    bucket.put(BLOB_NAME, b"old content", metadata={"sha256": hashlib.sha256(b"old content").hexdigest()})
+    return bucket
+
+
+def download(file_server):
+    app = Flask(__name__)
+    request_json = {"target_table_name": "users", "dest_column_name": "file_path",
+                    "appsheet_file_path": file_server.file_url("report.pdf"),
+                    "key_name": "user_id", "key_value": USER_ID}
+    with app.test_request_context("/", method="POST", json=request_json) as context:
+        return main.main(context.request)
+
+
+def test_checksum_mismatch_aborts_before_replacing(file_server, bucket, monkeypatch):
+    # アップロードされたオブジェクトの最後の1バイトが欠ける
+    def close(writer):
+        if not writer.closed:
+            writer.closed = True
+            writer.blob.upload_from_string(b"".join(writer.parts)[:-1])
+
+    monkeypatch.setattr(fakes.InMemoryBlobWriter, "close", close)
+    generation = bucket.objects[BLOB_NAME]["generation"]
+
+    body, status_code = download(file_server)
+
+    assert status_code == 500
+    assert "Checksum mismatch" in body["error"]
+    # ユーザーのファイルはそのまま残り、一時オブジェクトは削除されている
+    assert sorted(bucket.objects) == [BLOB_NAME]
+    assert bucket.objects[BLOB_NAME]["data"] == b"old content"
+    assert bucket.objects[BLOB_NAME]["generation"] == generation
+
+
+def test_not_modified_file_is_left_untouched(file_server, bucket):
+    body, status_code = download(file_server)
+    assert status_code == 200
+    assert body["file_path"] == f"gs://{BUCKET_NAME}/{BLOB_NAME}"
+    stored = dict(bucket.objects[BLOB_NAME])
+    assert stored["data"] == file_server.content
+    assert stored["metadata"]["appsheet_etag"]
+
+    fakes.CALLS.clear()
+    body, status_code = download(file_server)
+
+    assert status_code == 200
+    assert body["file_path"] == f"gs://{BUCKET_NAME}/{BLOB_NAME}"
+    assert fakes.CALLS["appsheet.not_modified"] == 1
+    assert bucket.objects[BLOB_NAME] == stored
+    assert sorted(bucket.objects) == [BLOB_NAME]
+    assert not any(fakes.CALLS[name] for name in ["gcs.upload", "gcs.copy", "gcs.patch", "gcs.delete"])
+
+
+@pytest.fixture
+def operations(monkeypatch):
+    operations = []
+    copy_blob, delete = fakes.InMemoryBucket.copy_blob, fakes.InMemoryBlob.delete
+
+    def record_copy(bucket, blob, destination_bucket, new_name=None, **kwargs):
+        copied = copy_blob(bucket, blob, destination_bucket, new_name, **kwargs)
+        operations.append(("copy", new_name))
+        return copied
+
+    def record_delete(blob, *args, **kwargs):
+        operations.append(("delete", blob.name))
+        return delete(blob, *args, **kwargs)
+
+    monkeypatch.setattr(fakes.InMemoryBucket, "copy_blob", record_copy)
+    monkeypatch.setattr(fakes.InMemoryBlob, "delete", record_delete)
+    return operations
+
+
+def stage(bucket, data):
+    staging_blob = bucket.blob(f"{main.STAGING_PREFIX}/{USER_ID}/staging")
+    staging_blob.upload_from_string(data)
+    result = transfer.TransferResult(len(data), staging_blob.md5_hash, hashlib.sha256(data).hexdigest())
+    return staging_blob, result
+
+
+def test_old_files_are_deleted_after_copy(bucket, operations):
+    bucket.put(f"{USER_ID}/old.pdf", b"older content")
+    existing_blobs = bucket.list_blobs(prefix=f"{USER_ID}/")
+    staging_blob, result = stage(bucket, b"new content")
+
+    kept_name = main.replace_user_file(bucket, USER_ID, existing_blobs, staging_blob, BLOB_NAME,
+                                       result, {"appsheet_file_path": "url"})
+
+    assert kept_name == BLOB_NAME
+    assert operations[0] == ("copy", BLOB_NAME)
+    assert sorted(operations[1:]) == [("delete", staging_blob.name), ("delete", f"{USER_ID}/old.pdf")]
+    assert sorted(bucket.objects) == [BLOB_NAME]
+    assert bucket.objects[BLOB_NAME]["data"] == b"new content"
+    assert bucket.objects[BLOB_NAME]["metadata"]["sha256"] == result.sha256
+
+
+def test_failed_copy_keeps_old_files(bucket, operations, monkeypatch):
+    existing_blobs = bucket.list_blobs(prefix=f"{USER_ID}/")
+    staging_blob, result = stage(bucket, b"new content")
+
+    def fail_copy(*args, **kwargs):
+        raise RuntimeError("copy failed")
+
+    monkeypatch.setattr(fakes.InMemoryBucket, "copy_blob", fail_copy)
+
+    with pytest.raises(RuntimeError):
+        main.replace_user_file(bucket, USER_ID, existing_blobs, staging_blob, BLOB_NAME,
+                               result, {"appsheet_file_path": "url"})
+
+    assert operations == []
+    assert bucket.objects[BLOB_NAME]["data"] == b"old content"
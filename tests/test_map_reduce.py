@@ -0,0 +1,140 @@
+# gemini_analysis のMap-Reduce方式の分析 (CSVの分割、部分結果の統合) のテスト
+import csv
+import io
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "gemini_analysis"))
+import export_files  # noqa: E402
+import map_reduce  # noqa: E402
+
+HEADER = ["ts", "user", "text"]
+
+
+# generate / generate_stream を持つモデルの代替 (受け取った内容を記録する)
+class RecordingModel:
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def generate(self, contents):
+        with self.lock:
+            self.calls.append(contents)
+        if is_map_prompt(contents[0]):
+            # プロンプトのチャンクの番号を部分結果に含める
+            return f"partial {contents[0].split('(No.')[1].split(')')[0]}"
+        return f"merged {len(self.calls)}"
+
+    def generate_stream(self, contents):
+        yield self.generate(contents)
+
+
+def is_map_prompt(text):
+    return text.startswith(map_reduce.MAP_PROMPT.split("{index}")[0])
+
+
+def csv_text(rows):
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(HEADER)
+    writer.writerows(rows)
+    return output.getvalue()
+
+
+@pytest.fixture
+def csv_files(monkeypatch):
+    files = {
+        "gs://bucket/export/000000000000.csv": csv_text(
+            [[f"2024-01-01 00:00:{i:02d}", f"U{i}", "x" * 20] for i in range(10)]),
+        "gs://bucket/export/000000000001.csv": csv_text(
+            [[f"2024-01-02 00:00:{i:02d}", f"U{i}", "y" * 20] for i in range(7)]),
+        "gs://bucket/export/000000000002.csv": csv_text([]),
+    }
+    monkeypatch.setattr(export_files, "read_export_text", files.__getitem__)
+    return files
+
+
+def parse(chunk):
+    return list(csv.reader(io.StringIO(chunk)))
+
+
+def test_iter_csv_chunks_splits_rows_within_token_limit(csv_files):
+    # 1行は 43文字 + 1 = 44 トークンのため、1チャンクは3行まで
+    chunks = list(map_reduce.iter_csv_chunks(csv_files, max_tokens=150, chars_per_token=1.0))
+
+    rows = [row for chunk in chunks for row in parse(chunk)[1:]]
+    assert [len(parse(chunk)) - 1 for chunk in chunks] == [3, 3, 3, 3, 3, 2]
+    assert all(parse(chunk)[0] == HEADER for chunk in chunks)
+    # ファイルの境界をまたいでも行の順序は変わらず、2つ目のファイルのヘッダーは行に含めない
+    assert rows == [row for text in csv_files.values() for row in parse(text)[1:]]
+    for chunk in chunks:
+        tokens = sum(map_reduce.estimate_tokens(",".join(row), 1.0) + 1 for row in parse(chunk)[1:])
+        assert tokens <= 150
+
+
+def test_iter_csv_chunks_keeps_oversized_row_in_its_own_chunk(monkeypatch):
+    monkeypatch.setattr(export_files, "read_export_text", lambda uri: csv_text(
+        [["1", "U1", "short"], ["2", "U2", "z" * 500], ["3", "U3", "short"]]))
+
+    chunks = list(map_reduce.iter_csv_chunks(["gs://bucket/a.csv"], max_tokens=100, chars_per_token=1.0))
+
+    assert [[row[0] for row in parse(chunk)[1:]] for chunk in chunks] == [["1"], ["2"], ["3"]]
+
+
+def test_group_by_tokens():
+    texts = ["a" * 40, "b" * 40, "c" * 40, "d" * 100, "e" * 10]
+
+    groups = map_reduce.group_by_tokens(texts, max_tokens=50, chars_per_token=1.0)
+
+    assert groups == [["a" * 40], ["b" * 40], ["c" * 40], ["d" * 100], ["e" * 10]]
+    assert map_reduce.group_by_tokens(texts, max_tokens=100, chars_per_token=1.0) == [
+        ["a" * 40, "b" * 40], ["c" * 40], ["d" * 100], ["e" * 10]]
+    assert map_reduce.group_by_tokens([], max_tokens=100, chars_per_token=1.0) == [[]]
+
+
+def test_analyze_map_reduce_maps_each_chunk_once(csv_files):
+    model = RecordingModel()
+    chunks = list(map_reduce.iter_csv_chunks(csv_files, max_tokens=150, chars_per_token=1.0))
+
+    result = map_reduce.analyze_map_reduce(
+        model, "強みを分析してください", csv_files, extra_parts=["strengths.pdf"],
+        max_tokens=150, chars_per_token=1.0, concurrency=2)
+
+    map_calls = [contents for contents in model.calls if is_map_prompt(contents[0])]
+    assert sorted(map_calls) == sorted(
+        [map_reduce.MAP_PROMPT.format(index=i + 1, prompt="強みを分析してください"), chunk]
+        for i, chunk in enumerate(chunks))
+
+    # 部分結果は上限内に収まるため中間の統合は行わず、チャンクの順に最終的な統合に渡す
+    partials = [f"partial {i + 1}" for i in range(len(chunks))]
+    assert model.calls[-1] == [
+        map_reduce.REDUCE_PROMPT.format(prompt="強みを分析してください"),
+        "strengths.pdf",
+        map_reduce.format_partials(partials),
+    ]
+    assert len(model.calls) == len(chunks) + 1
+    assert result == f"merged {len(chunks) + 1}"
+
+
+def test_analyze_map_reduce_reduces_in_stages(csv_files):
+    model = RecordingModel()
+
+    list(map_reduce.analyze_map_reduce(
+        model, "強みを分析してください", csv_files, max_tokens=60, chars_per_token=1.0,
+        concurrency=2, stream=True))
+
+    chunks = list(map_reduce.iter_csv_chunks(csv_files, max_tokens=60, chars_per_token=1.0))
+    intermediate_calls = [contents for contents in model.calls
+                          if contents[0] == map_reduce.INTERMEDIATE_REDUCE_PROMPT.format(
+                              prompt="強みを分析してください")]
+    final_contents = model.calls[-1]
+    assert intermediate_calls
+    assert len(model.calls) == len(chunks) + len(intermediate_calls) + 1
+    assert final_contents[0] == map_reduce.REDUCE_PROMPT.format(prompt="強みを分析してください")
+    # 最終的な統合には中間の統合結果だけを渡す
+    assert "partial" not in final_contents[-1]
+    assert final_contents[-1].count("## 部分結果") < len(chunks)
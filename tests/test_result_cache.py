@@ -0,0 +1,58 @@
+# gemini_analysis の生成結果のキャッシュ (有効期間、LRUでの削除、壊れたエントリ) のテスト
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "gemini_analysis"))
+import result_cache  # noqa: E402
+from result_cache import LocalDiskBackend, ResultCache  # noqa: E402
+
+
+def test_expired_entry_is_deleted(tmp_path, monkeypatch):
+    now = [1700000000.0]
+    monkeypatch.setattr(result_cache.time, "time", lambda: now[0])
+    backend = LocalDiskBackend(str(tmp_path))
+    cache = ResultCache(backend, ttl_seconds=60)
+
+    cache.put("key", "result")
+    now[0] += 60
+    assert cache.get("key") == "result"
+
+    now[0] += 1
+    assert cache.get("key") is None
+    assert not (tmp_path / "key.json").exists()
+    assert cache.counters == {"hits": 1, "misses": 0, "expired": 1, "errors": 0}
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    backend = LocalDiskBackend(str(tmp_path), max_entries=2)
+    cache = ResultCache(backend)
+    cache.put("a", "result a")
+    cache.put("b", "result b")
+    # 書き込んだ順に参照日時を古くしておき、aを参照して最新にする
+    os.utime(tmp_path / "a.json", (1000, 1000))
+    os.utime(tmp_path / "b.json", (2000, 2000))
+    assert cache.get("a") == "result a"
+
+    cache.put("c", "result c")
+
+    assert sorted(os.listdir(tmp_path)) == ["a.json", "c.json"]
+    assert cache.get("b") is None
+    assert cache.get("a") == "result a"
+    assert cache.get("c") == "result c"
+
+
+def test_malformed_entries_are_misses(tmp_path):
+    backend = LocalDiskBackend(str(tmp_path))
+    cache = ResultCache(backend)
+    (tmp_path / "truncated.json").write_text('{"created_at": 1700000000.0, "val')
+    (tmp_path / "foreign.json").write_text('{"created_at": 1700000000.0, "result": "x"}')
+    (tmp_path / "list.json").write_text('["x"]')
+
+    for key in ["truncated", "foreign", "list"]:
+        assert cache.get(key) is None
+    assert cache.counters == {"hits": 0, "misses": 3, "expired": 0, "errors": 0}
+
+    # 壊れたエントリは次の書き込みで置き換える
+    cache.put("truncated", "result")
+    assert cache.get("truncated") == "result"
@@ -0,0 +1,99 @@
+# シークレットのキャッシュ (同時取得のまとめ、有効期間、破棄) のテスト
+# secret_cache.py は各関数に同じ内容をコピーしているため、slack_messages_to_bigquery のものを使う
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "slack_messages_to_bigquery"))
+from secret_cache import SecretCache  # noqa: E402
+
+KEY = "projects/p/secrets/slack-token/versions/latest"
+
+
+# 時刻を進められる時計
+class ManualClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_concurrent_getters_share_one_fetch():
+    cache = SecretCache(ttl_seconds=60)
+    getters = 8
+    loads = []
+
+    # 他のスレッドがすべて取得を待ち始めてから値を返す
+    def load():
+        loads.append(threading.get_ident())
+        deadline = time.monotonic() + 5
+        while cache.stats()["waits"] < getters - 1 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        return "xoxb-1"
+
+    with ThreadPoolExecutor(max_workers=getters) as executor:
+        values = list(executor.map(lambda _: cache.get(KEY, load), range(getters)))
+
+    assert values == ["xoxb-1"] * getters
+    assert len(loads) == 1
+    assert cache.stats() == {"hits": 0, "misses": 1, "waits": getters - 1,
+                             "invalidations": 0, "size": 1}
+
+
+def test_failed_fetch_is_raised_to_waiters_and_not_cached():
+    cache = SecretCache(ttl_seconds=60)
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise RuntimeError("permission denied")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(cache.get, KEY, fail)
+        while not cache.in_flight:
+            time.sleep(0.001)
+        waiter = executor.submit(cache.get, KEY, fail)
+        while cache.stats()["waits"] < 1:
+            time.sleep(0.001)
+        release.set()
+        for future in (leader, waiter):
+            with pytest.raises(RuntimeError):
+                future.result()
+
+    assert cache.get(KEY, lambda: "xoxb-1") == "xoxb-1"
+
+
+def test_expired_value_is_fetched_again():
+    clock = ManualClock()
+    cache = SecretCache(ttl_seconds=60, clock=clock)
+    values = iter(["xoxb-1", "xoxb-2"])
+
+    assert cache.get(KEY, lambda: next(values)) == "xoxb-1"
+    clock.now += 59
+    assert cache.get(KEY, lambda: next(values)) == "xoxb-1"
+    clock.now += 1
+    assert cache.get(KEY, lambda: next(values)) == "xoxb-2"
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["hits"] == 1
+
+
+def test_getter_after_invalidate_fetches_again():
+    cache = SecretCache(ttl_seconds=60)
+    values = iter(["xoxb-1", "xoxb-2", "xoxb-3"])
+    assert cache.get(KEY, lambda: next(values)) == "xoxb-1"
+
+    # 失効した値と異なる値がキャッシュされている場合 (他のスレッドが取得し直した後) は破棄しない
+    assert not cache.invalidate(KEY, "xoxb-0")
+    assert cache.get(KEY, lambda: next(values)) == "xoxb-1"
+
+    assert cache.invalidate(KEY, "xoxb-1")
+    assert cache.get(KEY, lambda: next(values)) == "xoxb-2"
+    assert cache.invalidate(KEY)
+    assert cache.get(KEY, lambda: next(values)) == "xoxb-3"
+    assert cache.stats()["invalidations"] == 2
@@ -0,0 +1,115 @@
+# slack_messages_to_bigquery のSlack APIクライアント (リトライ、レート制限、トークンの再取得) のテスト
+# benchmarks/fakes.py のSlack APIの代替サーバーに対して呼び出す
+import os
+import sys
+import time
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "slack_messages_to_bigquery"))
+import fakes  # noqa: E402
+from slack_client import SlackApiError, SlackClient  # noqa: E402
+
+METHOD = "conversations.history"
+PARAMS = {"channel": "C0000", "limit": 10}
+
+
+@pytest.fixture
+def server():
+    workspace = fakes.SlackWorkspace(channels=1, messages=5, threads=0, replies=0)
+    server = fakes.FakeSlackServer(workspace, token="xoxb-current").start()
+    yield server
+    server.stop()
+
+
+def create_client(server, token="xoxb-current", max_retries=3, **kwargs):
+    # Retry-After後の待機がトークンの補充で延びないよう、レートを十分に高くする
+    client = SlackClient(token, base_url=server.url, max_retries=max_retries,
+                         rate_overrides={METHOD: 6000}, **kwargs)
+    # 5xxと接続エラーの指数バックオフは待たない
+    client._backoff = lambda attempt: 0
+    return client
+
+
+def test_retries_rate_limit_server_error_and_connection_error(server):
+    server.fail_next(status=429, headers={"Retry-After": "0"}, error="ratelimited")
+    server.fail_next(status=503, error="service_unavailable")
+    server.fail_next(disconnect=True)
+    client = create_client(server)
+
+    data = client.call(METHOD, PARAMS)
+
+    assert len(data["messages"]) == 5
+    assert len(server.received) == 4
+    metric = client.metrics_summary()[METHOD]
+    assert metric["retries"] == 3
+    assert metric["rate_limited"] == 1
+    assert metric["errors"] == 0
+    client.close()
+
+
+def test_waits_for_retry_after(server):
+    server.fail_next(status=429, headers={"Retry-After": "0.3"}, error="ratelimited")
+    client = create_client(server)
+
+    client.call(METHOD, PARAMS)
+
+    (_, _, limited_at), (_, _, retried_at) = server.received
+    assert retried_at - limited_at >= 0.3
+    client.close()
+
+
+def test_refreshes_token_on_invalid_auth(server):
+    refreshed = []
+
+    def refresh(stale_token):
+        refreshed.append(stale_token)
+        return "xoxb-current"
+
+    client = create_client(server, token="xoxb-rotated", token_refresher=refresh)
+
+    client.call(METHOD, PARAMS)
+
+    assert refreshed == ["xoxb-rotated"]
+    assert [authorization for _, authorization, _ in server.received] == [
+        "Bearer xoxb-rotated", "Bearer xoxb-current"]
+    client.close()
+
+
+def test_invalid_auth_without_new_token_raises(server):
+    client = create_client(server, token="xoxb-rotated", token_refresher=lambda stale: stale)
+
+    with pytest.raises(SlackApiError) as error:
+        client.call(METHOD, PARAMS)
+
+    assert error.value.error == "invalid_auth"
+    assert len(server.received) == 1
+    client.close()
+
+
+@pytest.mark.parametrize("fault, expected", [
+    ({"status": 429, "headers": {"Retry-After": "0"}, "error": "ratelimited"}, SlackApiError),
+    ({"status": 500, "error": "internal_error"}, requests.HTTPError),
+    ({"disconnect": True}, requests.ConnectionError),
+])
+def test_raises_after_retries_are_exhausted(server, fault, expected):
+    for _ in range(3):
+        server.fail_next(**fault)
+    client = create_client(server, max_retries=2)
+
+    started = time.monotonic()
+    with pytest.raises(expected):
+        client.call(METHOD, PARAMS)
+
+    assert time.monotonic() - started < 5
+    assert len(server.received) == 3
+    metric = client.metrics_summary()[METHOD]
+    assert metric["retries"] == 2
+    assert metric["errors"] == 1
+    # 障害を使い切っていれば、後続の呼び出しは成功する
+    assert server.faults == []
+    assert client.call(METHOD, PARAMS)["ok"]
+    client.close()
@@ -0,0 +1,164 @@
+# slack_messages_to_bigquery のチャネルのクロール (差分取得、重複排除) のテスト
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "slack_messages_to_bigquery"))
+# 各関数の main.py は同じモジュール名のため、このディレクトリのものを読み込み直す
+sys.modules.pop("main", None)
+import fakes  # noqa: E402
+import main  # noqa: E402
+from slack_client import SlackClient  # noqa: E402
+from sync_state import GcsSyncStateStore  # noqa: E402
+
+CHANNEL_ID = "C0000"
+USER_ID = "U0000"
+LOOKBACK_SECONDS = 7 * 86400
+
+
+@pytest.fixture
+def workspace():
+    return fakes.SlackWorkspace(channels=1, messages=6, threads=3, replies=2)
+
+
+@pytest.fixture
+def server(workspace):
+    server = fakes.FakeSlackServer(workspace).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def state_store():
+    fakes.InMemoryStorageClient.buckets.clear()
+    return GcsSyncStateStore("sync-state", client=fakes.InMemoryStorageClient())
+
+
+# 前回の状態から差分を取得して状態を保存し、(取得したメッセージ, conversations.replies の呼び出し数) を返す
+def crawl(server, state_store):
+    slack_client = SlackClient("xoxb-test", base_url=server.url, rate_overrides={
+        "conversations.history": 6000, "conversations.replies": 6000})
+    received = len(server.received)
+    sync_state = state_store.load(CHANNEL_ID, USER_ID)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        messages = list(main.iter_channel_messages(
+            slack_client, CHANNEL_ID, 0, 2000000000, 2, executor, 2,
+            sync_state=sync_state, lookback_seconds=LOOKBACK_SECONDS))
+    main.save_sync_states(state_store, {CHANNEL_ID: sync_state}, USER_ID, LOOKBACK_SECONDS)
+    slack_client.close()
+    replies_calls = sum(method == "conversations.replies"
+                        for method, _, _ in server.received[received:])
+    return messages, replies_calls
+
+
+def add_late_reply(workspace, text):
+    (channel_id, thread_ts), thread = next(iter(workspace.threads.items()))
+    parent = thread[0]
+    reply = {"type": "message", "ts": f"{float(thread[-1]['ts']) + 60:.6f}",
+             "user": USER_ID, "text": text, "thread_ts": thread_ts}
+    thread.append(reply)
+    parent["reply_count"] += 1
+    parent["latest_reply"] = reply["ts"]
+    return reply
+
+
+def test_incremental_crawl_fetches_only_changed_threads(workspace, server, state_store):
+    messages, replies_calls = crawl(server, state_store)
+    assert len(messages) == 6 + 3 * 2
+    assert len({message["ts"] for message in messages}) == len(messages)
+    assert replies_calls == 3
+
+    # 変更が無ければメッセージも返信も取得しない
+    messages, replies_calls = crawl(server, state_store)
+    assert messages == []
+    assert replies_calls == 0
+
+    # 既存スレッドへの返信は、そのスレッドのみ取得し直す
+    reply = add_late_reply(workspace, "late reply")
+    messages, replies_calls = crawl(server, state_store)
+    assert [message["ts"] for message in messages] == [reply["ts"]]
+    assert replies_calls == 1
+
+    messages, replies_calls = crawl(server, state_store)
+    assert messages == []
+    assert replies_calls == 0
+
+
+def test_sync_state_save_rejects_conflicting_generation(server, state_store):
+    crawl(server, state_store)
+    stale_state = state_store.load(CHANNEL_ID, USER_ID)
+
+    # 別のジョブが先に状態を保存した場合、古い世代からの保存は反映しない
+    add_late_reply(server.workspace, "late reply")
+    crawl(server, state_store)
+    saved = state_store.load(CHANNEL_ID, USER_ID)
+    assert saved.generation != stale_state.generation
+
+    stale_state.next_threads = {}
+    state_store.save(CHANNEL_ID, USER_ID, stale_state)
+
+    current = state_store.load(CHANNEL_ID, USER_ID)
+    assert current.generation == saved.generation
+    assert current.threads == saved.threads
+    assert current.threads
+
+
+# 指定したページをそのまま返すSlackクライアント
+class PagedSlackClient:
+    def __init__(self, pages, threads):
+        self.pages = pages
+        self.threads = threads
+        self.replies_calls = []
+
+    def paginate(self, method, params):
+        yield from ({"ok": True, "messages": page} for page in self.pages)
+
+    def call(self, method, params):
+        self.replies_calls.append(params["ts"])
+        return {"ok": True, "messages": self.threads[params["ts"]]}
+
+
+def message(ts, thread_ts=None, subtype=None):
+    message = {"type": "message", "ts": ts, "text": f"message {ts}"}
+    if thread_ts:
+        message["thread_ts"] = thread_ts
+    if subtype:
+        message["subtype"] = subtype
+    return message
+
+
+def test_crawl_deduplicator_across_overlapping_pages():
+    parent = message("100.000000", "100.000000")
+    broadcast = message("102.000000", "100.000000", "thread_broadcast")
+    orphan_broadcast = message("201.000000", "200.000000", "thread_broadcast")
+    threads = {
+        "100.000000": [parent, message("101.000000", "100.000000"), broadcast],
+        "200.000000": [message("200.000000", "200.000000"), orphan_broadcast],
+    }
+    # ページの境界が重なり、親メッセージと通常のメッセージが2つのページに現れる
+    pages = [
+        [broadcast, parent],
+        [parent, message("99.000000"), orphan_broadcast],
+        [message("99.000000")],
+    ]
+    slack_client = PagedSlackClient(pages, threads)
+    dedup = main.CrawlDeduplicator()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        messages = list(main.iter_channel_messages(
+            slack_client, CHANNEL_ID, 0, 2000000000, 2, executor, 2, dedup=dedup))
+
+    assert sorted(message["ts"] for message in messages) == [
+        "100.000000", "101.000000", "102.000000", "200.000000", "201.000000", "99.000000"]
+    # スレッドは親メッセージ側で1回ずつ取得し、親が範囲外のスレッドは返信から取得する
+    assert sorted(slack_client.replies_calls) == ["100.000000", "200.000000"]
+    assert dedup.counters == {
+        # 重なったページの親と通常のメッセージ、スレッドの返信に含まれる親と2件のブロードキャスト
+        "duplicate_messages_skipped": 5,
+        "thread_fetches_skipped_duplicate": 1,
+        "thread_fetches_skipped_broadcast": 1,
+    }
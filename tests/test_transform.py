@@ -0,0 +1,81 @@
+# slack_messages_to_bigquery のメッセージ変換処理のテスト
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "cloud_functions", "slack_messages_to_bigquery"))
+from transform import concatenate_reactions, convert_to_timestamp, messages_to_dataframe  # noqa: E402
+
+
+# 従来の行ごとの apply で使っていた変換 (期待値)
+def legacy_concatenate_reactions(reactions):
+    if isinstance(reactions, list):
+        return ', '.join([f"{reaction['name']}:{reaction['count']}" for reaction in reactions])
+    return ''
+
+
+def test_concatenate_reactions_matches_legacy_output():
+    reactions = pd.Series([
+        [],
+        None,
+        float("nan"),
+        [{"name": "+1", "count": 2, "users": []}],
+        [{"name": "eyes", "count": 1, "users": []},
+         {"name": "tada", "count": 3, "users": []},
+         {"name": "pray", "count": 5, "users": []}],
+    ], index=[10, 11, 12, 13, 14], dtype=object)
+
+    result = concatenate_reactions(reactions)
+
+    assert result.index.tolist() == reactions.index.tolist()
+    assert result.tolist() == [legacy_concatenate_reactions(value) for value in reactions]
+    assert result.tolist() == ['', '', '', '+1:2', 'eyes:1, tada:3, pray:5']
+
+
+def test_messages_without_reactions_key():
+    messages = [
+        {"ts": "1704034800.000200", "user": "U1", "text": "b", "channel_id": "C1", "job_id": "j",
+         "reactions": [{"name": "+1", "count": 1, "users": []}]},
+        {"ts": "1704034800.000100", "user": "U2", "text": "a", "channel_id": "C1", "job_id": "j"},
+    ]
+
+    df = messages_to_dataframe(messages)
+
+    assert df["text"].tolist() == ["a", "b"]
+    assert df["reactions_concatenated"].tolist() == ["", "+1:1"]
+
+
+def test_messages_without_reactions_column():
+    messages = [{"ts": "1704034800.000100", "user": "U1", "text": "a", "channel_id": "C1", "job_id": "j"}]
+
+    df = messages_to_dataframe(messages)
+
+    assert df["reactions_concatenated"].tolist() == [""]
+
+
+def test_messages_keep_team():
+    messages = [
+        {"ts": "1704034800.000100", "user": "U1", "team": "T1", "text": "a", "channel_id": "C1", "job_id": "j"},
+        {"ts": "1704034800.000200", "user": "U2", "text": "b", "channel_id": "C1", "job_id": "j"},
+    ]
+
+    df = messages_to_dataframe(messages)
+
+    assert df["team"].tolist()[0] == "T1"
+    assert pd.isna(df["team"].tolist()[1])
+
+
+def test_convert_to_timestamp_keeps_microseconds():
+    ts = pd.Series(["1704034800.000001", "1704034800.999999", "1704034800.1", "1704034800"])
+
+    result = convert_to_timestamp(ts)
+
+    assert str(result.dt.tz) == "UTC"
+    assert result.tolist() == [
+        pd.Timestamp("2023-12-31 15:00:00.000001", tz="UTC"),
+        pd.Timestamp("2023-12-31 15:00:00.999999", tz="UTC"),
+        pd.Timestamp("2023-12-31 15:00:00.100000", tz="UTC"),
+        pd.Timestamp("2023-12-31 15:00:00", tz="UTC"),
+    ]
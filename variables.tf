@@ -56,6 +56,78 @@ variable "slack_api_message_limit" {
   default     = 200 # デフォルト値として200を設定
 }
 
+variable "slack_thread_fetch_concurrency" {
+  description = "Slackのスレッド返信を並列に取得する際の最大同時リクエスト数"
+  type        = number
+  default     = 8
+}
+
+variable "slack_replies_rate_per_minute" {
+  description = "Slack API conversations.replies の1分あたりの最大リクエスト数"
+  type        = number
+  default     = 50
+}
+
+variable "slack_thread_lookback_days" {
+  description = "差分取得時に返信の更新を確認する既存スレッドの遡り日数"
+  type        = number
+  default     = 7
+}
+
+variable "bigquery_load_batch_size" {
+  description = "BigQueryへ1回のロードジョブで書き込むメッセージの最大件数"
+  type        = number
+  default     = 20000
+}
+
+variable "transfer_chunk_size_mb" {
+  description = "AppSheetからCloud Storageへファイルを転送する際のチャンクサイズ (MB)"
+  type        = number
+  default     = 8
+}
+
+variable "result_cache_ttl_seconds" {
+  description = "Geminiの生成結果をキャッシュする秒数"
+  type        = number
+  default     = 86400
+}
+
+variable "secret_cache_ttl_seconds" {
+  description = "Secret Managerから取得したシークレットをプロセス内でキャッシュする秒数"
+  type        = number
+  default     = 600
+}
+
+variable "appsheet_analysis_table" {
+  description = "非同期モードのGemini分析結果を書き込むAppSheetのテーブル名 (空の場合は書き込まない)"
+  type        = string
+  default     = ""
+}
+
+variable "dataform_poll_deadline_seconds" {
+  description = "Dataformジョブの完了の確認を打ち切り、ジョブをキャンセルするまでの秒数"
+  type        = number
+  default     = 3600
+}
+
+variable "dataform_poll_max_delay_seconds" {
+  description = "Dataformジョブの完了を確認する間隔の上限 (秒)。間隔は5秒から指数的に延ばす"
+  type        = number
+  default     = 60
+}
+
+variable "export_compression" {
+  description = "Gemini分析用にエクスポートするCSVの圧縮形式 (GZIP または NONE)"
+  type        = string
+  default     = "GZIP"
+}
+
+variable "trace_exporter" {
+  description = "ジョブのトレースの出力先 (log: Cloud Logging, otlp: OTLP/HTTPのコレクター, none: 出力しない)"
+  type        = string
+  default     = "log"
+}
+
 variable "appsheet_api_key" {
   description = "AppSheet APIキー"
   type        = string